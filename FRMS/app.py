@@ -22,19 +22,30 @@ Example:
     >>> uvicorn.run(app, host='0.0.0.0', port=5000)
 """
 
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Query, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse, JSONResponse, Response
+from fastapi.encoders import jsonable_encoder
+from starlette.datastructures import UploadFile
 from fastapi.middleware.cors import CORSMiddleware
-from typing import List, Tuple, Dict, Union
-import base64
-import io
-from PIL import Image
-from torch import Tensor
-from FRMS.utils.face_detector import FaceDetector
-from FRMS.utils.feature_extractor import FeatureExtractor
-from FRMS.utils.feature_matcher import FeatureMatcher
-from FRMS.datamodels import RequestModel, ResponseModel
+from typing import Any, List, Dict, Optional, Union, AsyncIterator, Tuple, Type
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
+from FRMS.utils.tracker import FaceTracker
+from FRMS.pipeline import RecognitionPipeline, PipelineSaturated, InvalidImage
+from FRMS.service import Service
+from FRMS.utils.sharding import ShardedMatcher, ShardUnavailable, decode_embeddings, encode_embeddings
+from FRMS.metrics import stage, start_timings, server_timing, registry, GALLERY_SIZE, QUEUE_DEPTH, PENDING_REQUESTS, \
+    CACHE_SIZE, MULTIPROCESS_DIR
+from FRMS.datamodels import RequestModel, ResponseModel, BatchRequestModel, BatchResponseModel, \
+    TrackResponseModel, CandidatesResponseModel, VerifyRequestModel, VerifyResponseModel, ShardSearchRequestModel, \
+    ShardSearchResponseModel, EmbeddingResponseModel, MatchRequestModel
+from FRMS.config import MAX_BATCH_IMAGES, TRACK_REFRESH_FRAMES, TRACK_MIN_IOU, PRELOAD_MODELS, \
+    SERVER_TIMING, MAX_CANDIDATES, MAX_MATCH_FEATURES
+from pydantic import ValidationError
 from FRMS import __version__
-import os
+import threading
+import asyncio
+import torch
+import time
 
 app: FastAPI = FastAPI(title='Face Recognition Microservice', version=__version__)
 
@@ -48,14 +59,216 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-try:
-    THRESHOLD: float = float(os.environ['THRESHOLD'])
-except KeyError:
-    THRESHOLD: float = 1.0
+service: Service = Service()
+if PRELOAD_MODELS:
+    service.load_models()
 
-detector: FaceDetector = FaceDetector()
-feature_extractor: FeatureExtractor = FeatureExtractor()
-feature_matcher: FeatureMatcher = FeatureMatcher(max_distance=THRESHOLD)
+
+def update_gauges() -> None:
+    """Set gauges of gallery size, extraction queue depth, requests in progress and cache size.
+
+    Return:
+        None
+    """
+    GALLERY_SIZE.set(service.feature_matcher.size if service.ready else 0)
+    QUEUE_DEPTH.set(service.batch_scheduler.qsize() if service.ready else 0)
+    PENDING_REQUESTS.set(service.pipeline.pending if service.ready else 0)
+    CACHE_SIZE.set(len(service.cache) if service.ready else 0)
+
+
+def update_gauges_forever(interval: float = 1.0) -> None:
+    """Update gauges of worker periodically, so they are fresh when another worker is scraped.
+
+    Args:
+        interval: Interval between updates in seconds.
+
+    Return:
+        None
+    """
+    while True:
+        update_gauges()
+        time.sleep(interval)
+
+
+async def add_server_timing(request: Request, call_next):
+    """Middleware adding Server-Timing header with stage timings of request.
+
+    Args:
+        request: HTTP request.
+        call_next: Next handler.
+
+    Return:
+        Response with Server-Timing header.
+    """
+    timings: Dict[str, float] = start_timings()
+    response: Response = await call_next(request)
+    if timings:
+        response.headers['Server-Timing'] = server_timing(timings)
+    return response
+
+
+if SERVER_TIMING:
+    app.middleware('http')(add_server_timing)
+
+
+@app.exception_handler(InvalidImage)
+async def invalid_image(request: Request, error: InvalidImage) -> JSONResponse:
+    """Answer 400 Bad Request to request with image which can not be decoded.
+
+    Args:
+        request: HTTP request.
+        error: Error of image decoding.
+
+    Return:
+        JSON response with error detail.
+    """
+    return JSONResponse({'detail': str(error)}, status_code=400)
+
+
+@app.exception_handler(ShardUnavailable)
+async def shard_unavailable(request: Request, error: ShardUnavailable) -> JSONResponse:
+    """Answer 503 Service Unavailable to request which needs shard which is not available.
+
+    Args:
+        request: HTTP request.
+        error: Error of shard.
+
+    Return:
+        JSON response with error detail.
+    """
+    return JSONResponse({'detail': str(error)}, status_code=503)
+
+
+@app.on_event('startup')
+async def startup():
+    """Start service in background thread, so the server binds before warm-up is completed.
+
+    Return:
+        None
+    """
+    asyncio.get_running_loop().run_in_executor(None, service.start)
+    if MULTIPROCESS_DIR:
+        threading.Thread(target=update_gauges_forever, name='gauges', daemon=True).start()
+
+
+def get_pipeline() -> RecognitionPipeline:
+    """Get pipeline of started service.
+
+    Return:
+        Pipeline of face recognition.
+    """
+    if not service.ready:
+        raise HTTPException(status_code=503, detail='Service is not ready.')
+    return service.pipeline
+
+
+def serialize(content: Any) -> JSONResponse:
+    """Serialize response content to JSON in timed serialize stage.
+
+    Args:
+        content: Pydantic models or JSON-compatible data.
+
+    Return:
+        JSON response.
+    """
+    with stage('serialize'):
+        return JSONResponse(jsonable_encoder(content))
+
+
+def batch_item(index: int, faces: Union[List[Dict[str, Union[List[int], int, str]]], InvalidImage]
+               ) -> BatchResponseModel:
+    """Create item of batch response.
+
+    Args:
+        index: Index of image in request.
+        faces: List of dicts of person info or error of image.
+
+    Return:
+        Item of batch response.
+    """
+    if isinstance(faces, InvalidImage):
+        return BatchResponseModel(index=index, faces=[], error=str(faces))
+    return BatchResponseModel(index=index, faces=faces)
+
+
+async def ndjson(results: AsyncIterator[Tuple[int, Union[List[Dict[str, Union[List[int], int, str]]], InvalidImage]]]
+                 ) -> AsyncIterator[str]:
+    """Serialize results of batch as newline-delimited JSON.
+
+    Args:
+        results: Async iterator of image index and its list of dicts of person info or error.
+
+    Return:
+        Async iterator of JSON lines.
+    """
+    async for i, faces in results:
+        with stage('serialize'):
+            line: str = batch_item(i, faces).json() + '\n'
+        yield line
+
+
+async def recognize(data: Union[str, bytes], k: int = 0) -> JSONResponse:
+    """Recognize faces on image, reject request if pipeline is saturated.
+
+    Args:
+        data: Base64 string or bytes of image file.
+        k: Number of candidate persons of every face, 0 to find only the nearest person.
+
+    Return:
+        JSON response with list of person info with bounding boxes.
+    """
+    try:
+        answers: List[Dict[str, Union[List[int], int, str]]] = await get_pipeline().recognize(data, k)
+    except PipelineSaturated:
+        raise HTTPException(status_code=503, detail='Too many requests in progress.')
+    model: Type[ResponseModel] = CandidatesResponseModel if k > 0 else ResponseModel
+    return serialize([model(**answer) for answer in answers])
+
+
+async def extract(data: Union[str, bytes]) -> JSONResponse:
+    """Extract features of faces on image, reject request if pipeline is saturated.
+
+    Args:
+        data: Base64 string or bytes of image file.
+
+    Return:
+        JSON response with list of base64 features with bounding boxes.
+    """
+    try:
+        answers: List[Dict[str, Union[List[int], torch.Tensor]]] = await get_pipeline().embed(data)
+    except PipelineSaturated:
+        raise HTTPException(status_code=503, detail='Too many requests in progress.')
+    with stage('serialize'):
+        content: List[EmbeddingResponseModel] = [
+            EmbeddingResponseModel(bbox=answer['bbox'], features=encode_embeddings(answer['features'].cpu().numpy()))
+            for answer in answers
+        ]
+    return serialize(content)
+
+
+async def recognize_batch(images: List[Union[str, bytes]], stream: bool):
+    """Recognize faces on many images, reject request if pipeline is saturated.
+
+    Args:
+        images: Base64 strings or bytes of image files.
+        stream: Stream results as newline-delimited JSON in order of completion.
+
+    Return:
+        List of results or streaming response.
+    """
+    if len(images) > MAX_BATCH_IMAGES:
+        raise HTTPException(status_code=413, detail='Batch has more than %d images.' % MAX_BATCH_IMAGES)
+    try:
+        if stream:
+            results: AsyncIterator[Tuple[int, Union[List[Dict[str, Union[List[int], int, str]]], InvalidImage]]] = \
+                get_pipeline().recognize_many(images)
+            return StreamingResponse(ndjson(results), media_type='application/x-ndjson')
+        data: List[Union[List[Dict[str, Union[List[int], int, str]]], InvalidImage]] = \
+            await get_pipeline().recognize_batch(images)
+    except PipelineSaturated:
+        raise HTTPException(status_code=503, detail='Too many requests in progress.')
+
+    return serialize([batch_item(i, faces) for i, faces in enumerate(data)])
 
 
 @app.post('/', response_model=List[ResponseModel])
@@ -68,15 +281,340 @@ async def main(request: RequestModel):
     Return:
         Response in JSON-format.
     """
-    simg: str = request.image
-    byte_img: bytes = base64.b64decode(simg)
-    img: Image.Image = Image.open(io.BytesIO(byte_img)).convert('RGB')
-    faces: List[Tuple[Tensor, List[int]]] = detector.find_faces(img)
-    data: List[Dict[str, Union[List[int], int, str]]] = []
-    for face, bb in faces:
-        features = feature_extractor.extract_features(face)
-        answer = feature_matcher.match_features(features)
-        answer['bbox'] = bb
-        data.append(answer)
+    return await recognize(request.image)
+
+
+@app.post('/candidates', response_model=List[CandidatesResponseModel])
+async def candidates(request: RequestModel, k: int = Query(5, ge=1, le=MAX_CANDIDATES)):
+    """Route for candidate persons of every face.
+
+    Candidates are k nearest persons ranked by distance, they are
+    returned even if distance is greater than threshold.
+
+    Args:
+        request: Request in JSON-format.
+        k: Number of candidates.
+
+    Return:
+        Response in JSON-format.
+    """
+    return await recognize(request.image, k)
+
+
+@app.post('/verify', response_model=List[VerifyResponseModel])
+async def verify(request: VerifyRequestModel):
+    """Route for verification of the claimed person.
+
+    Every face on image is compared only with faces of the person,
+    so time of verification does not depend on gallery size.
+
+    Args:
+        request: Request in JSON-format.
 
+    Return:
+        Response in JSON-format.
+    """
+    try:
+        answers: List[Dict[str, Union[List[int], float, bool, None]]] = await get_pipeline().verify(
+            request.image, request.person_id
+        )
+    except PipelineSaturated:
+        raise HTTPException(status_code=503, detail='Too many requests in progress.')
+    return serialize([VerifyResponseModel(**answer) for answer in answers])
+
+
+IMAGE_BODY: Dict[str, Dict] = {
+    'requestBody': {
+        'required': True,
+        'content': {
+            'application/octet-stream': {'schema': {'type': 'string', 'format': 'binary'}},
+            'multipart/form-data': {
+                'schema': {'type': 'object', 'properties': {'file': {'type': 'string', 'format': 'binary'}}}
+            }
+        }
+    }
+}
+
+
+BATCH_IMAGE_BODY: Dict[str, Dict] = {
+    'requestBody': {
+        'required': True,
+        'content': {
+            'multipart/form-data': {
+                'schema': {
+                    'type': 'object',
+                    'properties': {'files': {'type': 'array', 'items': {'type': 'string', 'format': 'binary'}}}
+                }
+            }
+        }
+    }
+}
+
+
+MATCH_BODY: Dict[str, Dict] = {
+    'requestBody': {
+        'required': True,
+        'content': {
+            'application/octet-stream': {'schema': {'type': 'string', 'format': 'binary'}},
+            'application/json': {'schema': MatchRequestModel.schema()}
+        }
+    }
+}
+
+
+@app.post('/image', response_model=List[ResponseModel], openapi_extra=IMAGE_BODY)
+async def image(request: Request):
+    """Route for binary image upload.
+
+    Body is either image file (application/octet-stream or image/*)
+    or multipart form with image file in the first file field.
+
+    Args:
+        request: Request with image file.
+
+    Return:
+        Response in JSON-format.
+    """
+    return await recognize(await read_image(request))
+
+
+async def read_image(request: Request) -> bytes:
+    """Read image file from body or multipart form of request.
+
+    Args:
+        request: Request with image file.
+
+    Return:
+        Bytes of image file.
+    """
+    if request.headers.get('content-type', '').startswith('multipart/form-data'):
+        form = await request.form()
+        files: List[UploadFile] = [value for value in form.values() if isinstance(value, UploadFile)]
+        data: bytes = await files[0].read() if files else b''
+    else:
+        data: bytes = await request.body()
+
+    if not data:
+        raise HTTPException(status_code=400, detail='Image file is empty.')
     return data
+
+
+@app.post('/embed', response_model=List[EmbeddingResponseModel])
+async def embed(request: RequestModel):
+    """Route for features of faces without matching.
+
+    Features are returned as base64 little-endian float32 vectors,
+    which can be matched later by match route of any instance.
+
+    Args:
+        request: Request in JSON-format.
+
+    Return:
+        Response in JSON-format.
+    """
+    return await extract(request.image)
+
+
+@app.post('/embed/image', response_model=List[EmbeddingResponseModel], openapi_extra=IMAGE_BODY)
+async def embed_image(request: Request):
+    """Route for features of faces on binary image without matching.
+
+    Args:
+        request: Request with image file.
+
+    Return:
+        Response in JSON-format.
+    """
+    return await extract(await read_image(request))
+
+
+@app.post('/match', response_model=List[ResponseModel], openapi_extra=MATCH_BODY)
+async def match(request: Request, k: int = Query(0, ge=0, le=MAX_CANDIDATES)):
+    """Route for matching features extracted elsewhere with gallery.
+
+    Body is either raw little-endian float32 features matrix with
+    shape (N, 512) (application/octet-stream) or JSON with the same
+    matrix in base64. Bounding boxes of answers are empty.
+
+    Args:
+        request: Request with features.
+        k: Number of candidate persons of every features vector, 0 to find only the nearest person.
+
+    Return:
+        Response in JSON-format, one item per features vector.
+    """
+    pipeline: RecognitionPipeline = get_pipeline()
+    if request.headers.get('content-type', '').startswith('application/json'):
+        try:
+            data: Union[str, bytes] = MatchRequestModel.parse_raw(await request.body()).features
+        except ValidationError as e:
+            raise HTTPException(status_code=422, detail=e.errors())
+    else:
+        data: Union[str, bytes] = await request.body()
+    try:
+        features: torch.Tensor = torch.from_numpy(decode_embeddings(data))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if features.shape[0] > MAX_MATCH_FEATURES:
+        raise HTTPException(status_code=413, detail='Request has more than %d features vectors.' % MAX_MATCH_FEATURES)
+    try:
+        answers: List[Dict[str, Union[List[int], int, str]]] = await pipeline.match(features, k)
+    except PipelineSaturated:
+        raise HTTPException(status_code=503, detail='Too many requests in progress.')
+    model: Type[ResponseModel] = CandidatesResponseModel if k > 0 else ResponseModel
+    return serialize([model(**answer) for answer in answers])
+
+
+@app.post('/batch', response_model=List[BatchResponseModel])
+async def batch(request: BatchRequestModel, stream: bool = False):
+    """Route for batch of base64 images.
+
+    Args:
+        request: Request in JSON-format.
+        stream: Stream results as newline-delimited JSON in order of completion.
+
+    Return:
+        Response in JSON-format, one item per image.
+    """
+    return await recognize_batch(request.images, stream)
+
+
+@app.post('/batch/image', response_model=List[BatchResponseModel], openapi_extra=BATCH_IMAGE_BODY)
+async def batch_image(request: Request, stream: bool = False):
+    """Route for batch of binary images in multipart form.
+
+    Every file field of form is an image, indexes of images in
+    response follow order of files in form.
+
+    Args:
+        request: Request with multipart form.
+        stream: Stream results as newline-delimited JSON in order of completion.
+
+    Return:
+        Response in JSON-format, one item per image.
+    """
+    form = await request.form()
+    files: List[UploadFile] = [value for _, value in form.multi_items() if isinstance(value, UploadFile)]
+    if not files:
+        raise HTTPException(status_code=400, detail='Form has no image files.')
+    return await recognize_batch([await file.read() for file in files], stream)
+
+
+@app.post('/shard/search', response_model=ShardSearchResponseModel)
+async def shard_search(request: ShardSearchRequestModel):
+    """Route for search of gallery shard served by this instance.
+
+    Front service with SHARDS sends features of faces to every shard
+    and merges nearest persons found by shards. Front service itself
+    answers 409, so searches are never forwarded from front to front.
+
+    Args:
+        request: Request in JSON-format.
+
+    Return:
+        Response in JSON-format.
+    """
+    pipeline: RecognitionPipeline = get_pipeline()
+    if isinstance(service.feature_matcher, ShardedMatcher):
+        raise HTTPException(status_code=409, detail='Instance is a front of shards, not a shard.')
+    try:
+        features: torch.Tensor = torch.from_numpy(decode_embeddings(request.features))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if features.shape[0] > MAX_MATCH_FEATURES:
+        raise HTTPException(status_code=413, detail='Request has more than %d features vectors.' % MAX_MATCH_FEATURES)
+    try:
+        answers: List[Dict[str, Union[List[int], int, str]]] = await pipeline.match(features, request.k)
+    except PipelineSaturated:
+        raise HTTPException(status_code=503, detail='Too many requests in progress.')
+    return serialize(ShardSearchResponseModel(shard=service.shard(), version=service.feature_matcher.version,
+                                              size=service.feature_matcher.size,
+                                              candidates=[answer['candidates'] for answer in answers]))
+
+
+@app.websocket('/stream')
+async def stream(websocket: WebSocket):
+    """Route for video stream.
+
+    Client sends every frame as binary message with image file and
+    receives JSON list of faces with bounding boxes, person IDs and
+    track IDs. Faces are tracked across frames and recognized again
+    only for new tracks, moved faces or every TRACK_REFRESH_FRAMES frames.
+    Frame sent while pipeline is saturated or shard is not available,
+    frame which can not be decoded and text message are answered with
+    error detail, the stream and its tracks are kept. Connection is
+    closed with code 1013 if service is not ready.
+
+    Args:
+        websocket: WebSocket connection.
+
+    Return:
+        None
+    """
+    if not service.ready:
+        await websocket.close(code=1013)
+        return
+    await websocket.accept()
+    tracker: FaceTracker = FaceTracker(min_iou=TRACK_MIN_IOU, refresh_interval=TRACK_REFRESH_FRAMES)
+    try:
+        while True:
+            received: Dict[str, Any] = await websocket.receive()
+            if received['type'] == 'websocket.disconnect':
+                break
+            frame: Optional[bytes] = received.get('bytes')
+            if frame is None:
+                await websocket.send_json({'detail': 'Frame must be binary message with image file.'})
+                continue
+            try:
+                data: List[Dict[str, Union[List[int], int, str]]] = await service.pipeline.recognize_frame(
+                    tracker, frame
+                )
+            except PipelineSaturated:
+                await websocket.send_json({'detail': 'Too many requests in progress.'})
+                continue
+            except (InvalidImage, ShardUnavailable) as e:
+                await websocket.send_json({'detail': str(e)})
+                continue
+            with stage('serialize'):
+                message: List[Dict[str, Union[List[int], int]]] = [
+                    TrackResponseModel(**answer).dict() for answer in data
+                ]
+            await websocket.send_json(message)
+    except WebSocketDisconnect:
+        pass
+
+
+@app.get('/health')
+async def health():
+    """Route for liveness probe.
+
+    Return:
+        Status of process, status code is 503 if all start attempts failed,
+        so the process is restarted by orchestrator.
+    """
+    if service.failed:
+        return JSONResponse({'status': 'failed', 'error': service.error}, status_code=503)
+    return {'status': 'ok'}
+
+
+@app.get('/ready')
+async def ready():
+    """Route for readiness probe.
+
+    Return:
+        State of service, status code is 503 until models are warmed up.
+    """
+    return JSONResponse(service.status(), status_code=200 if service.ready else 503)
+
+
+@app.get('/metrics')
+async def metrics():
+    """Route for Prometheus metrics.
+
+    In multiprocess mode metrics of all workers are returned.
+
+    Return:
+        Metrics in Prometheus text format.
+    """
+    update_gauges()
+    return Response(generate_latest(registry()), media_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,117 @@
+# FRMS/config.py
+#
+# Copyright (C) 2021-2022  Дмитрий Кузнецов
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""This module contains settings of microservice.
+
+Every setting is read from environment variable with the same name,
+default value is used if variable is not set.
+
+Attributes:
+    THRESHOLD: Max distance between features of the same person.
+    INDEX: Gallery index, 'flat' (exact) or 'ivf' (approximate).
+    IVF_NLIST: Number of clusters of IVF index, 0 to choose automatically.
+    IVF_NPROBE: Number of clusters scanned by IVF index for every query.
+    TEMPLATES: Max number of templates of every person searched instead of raw features, 0 to disable.
+    RERANK_PERSONS: Number of nearest persons re-ranked by raw features in template mode.
+    MAX_CANDIDATES: Max number of candidate persons of face in candidates request.
+    FEATURES_DTYPE: Type of features stored in database, 'float32' or 'float16'.
+    SYNC_INTERVAL: Interval in seconds between gallery updates, 0 to disable.
+    SNAPSHOT_PATH: Path to gallery snapshot shared by workers, empty to load gallery from database.
+    SNAPSHOT_TOP_UP: Load gallery from snapshot once and update it from database instead of following snapshot.
+    SHARD_INDEX: Index of the gallery shard served by this instance.
+    SHARD_COUNT: Number of gallery shards, 0 to serve the whole gallery.
+    SHARDS: Comma-separated base URLs of instances serving shards in order of shard index, empty to disable.
+    LOCAL_SHARDS: Number of local processes serving gallery shards, 0 to disable.
+    BATCH_MAX_SIZE: Max number of faces in feature extraction batch.
+    BATCH_MAX_WAIT_MS: Max time in milliseconds to wait for more faces to batch.
+    EMBED_MODE: Inference mode of feature extractor, 'fp32' or 'script'.
+    EMBED_MODEL: Path to TorchScript model saved by validate_extractor.py, empty to use EMBED_MODE.
+    MODEL_CACHE: Directory of serialized TorchScript models of 'script' mode, empty to disable.
+    PRELOAD_MODELS: Load models on import of application, e.g. in gunicorn master with --preload.
+    START_RETRIES: Number of retries of failed service start, after the last one health check fails.
+    START_RETRY_DELAY: Delay in seconds before the first retry of service start, doubled after every retry.
+    EMBED_THREADS: Number of PyTorch threads for feature extraction, 0 for PyTorch default.
+    PIPELINE_WORKERS: Number of threads for image decoding, face detection and matching.
+    PIPELINE_MAX_PENDING: Max number of requests in progress, next requests get 503.
+    DETECT_THREADS: Number of PyTorch threads in every pipeline thread, 0 for PyTorch default.
+    MAX_BATCH_IMAGES: Max number of images in batch request.
+    MAX_MATCH_FEATURES: Max number of features vectors in match request.
+    DETECT_BATCH_SIZE: Max number of same-size images of batch request detected together.
+    MIN_FACE_SIZE: Size in pixels of minimal detected face on original image.
+    DETECT_MAX_SIDE: Max side in pixels of image for detection, larger images are downscaled, 0 to disable.
+    DECODE_MAX_SIDE: Max side in pixels to which JPEG images are reduced while decoding, 0 to disable.
+    TRACK_REFRESH_FRAMES: Number of frames after which tracked face is recognized again.
+    TRACK_MIN_IOU: Min IoU of bounding boxes in consecutive frames to keep the face track.
+    SERVER_TIMING: Add Server-Timing header with stage timings to responses.
+    CACHE_SIZE: Max number of cached results by image content, 0 to disable cache.
+    CACHE_TTL: Time to live of cached result in seconds, 0 for unlimited.
+"""
+
+from typing import Callable, TypeVar
+import os
+
+T = TypeVar('T')
+
+
+def _get(name: str, default: T, cast: Callable[[str], T]) -> T:
+    try:
+        return cast(os.environ[name])
+    except KeyError:
+        return default
+
+
+def _bool(value: str) -> bool:
+    return value.lower() in ('1', 'true', 'yes')
+
+
+THRESHOLD: float = _get('THRESHOLD', 1.0, float)
+INDEX: str = _get('INDEX', 'flat', str)
+IVF_NLIST: int = _get('IVF_NLIST', 0, int)
+IVF_NPROBE: int = _get('IVF_NPROBE', 8, int)
+TEMPLATES: int = _get('TEMPLATES', 0, int)
+RERANK_PERSONS: int = _get('RERANK_PERSONS', 16, int)
+MAX_CANDIDATES: int = _get('MAX_CANDIDATES', 100, int)
+FEATURES_DTYPE: str = _get('FEATURES_DTYPE', 'float32', str)
+SYNC_INTERVAL: float = _get('SYNC_INTERVAL', 10.0, float)
+SNAPSHOT_PATH: str = _get('SNAPSHOT_PATH', '', str)
+SNAPSHOT_TOP_UP: bool = _get('SNAPSHOT_TOP_UP', False, _bool)
+SHARD_INDEX: int = _get('SHARD_INDEX', 0, int)
+SHARD_COUNT: int = _get('SHARD_COUNT', 0, int)
+SHARDS: str = _get('SHARDS', '', str)
+LOCAL_SHARDS: int = _get('LOCAL_SHARDS', 0, int)
+BATCH_MAX_SIZE: int = _get('BATCH_MAX_SIZE', 32, int)
+BATCH_MAX_WAIT_MS: float = _get('BATCH_MAX_WAIT_MS', 5.0, float)
+EMBED_MODE: str = _get('EMBED_MODE', 'fp32', str)
+EMBED_MODEL: str = _get('EMBED_MODEL', '', str)
+MODEL_CACHE: str = _get('MODEL_CACHE', '', str)
+PRELOAD_MODELS: bool = _get('PRELOAD_MODELS', False, _bool)
+START_RETRIES: int = _get('START_RETRIES', 5, int)
+START_RETRY_DELAY: float = _get('START_RETRY_DELAY', 1.0, float)
+EMBED_THREADS: int = _get('EMBED_THREADS', 0, int)
+PIPELINE_WORKERS: int = _get('PIPELINE_WORKERS', 4, int)
+PIPELINE_MAX_PENDING: int = _get('PIPELINE_MAX_PENDING', 64, int)
+DETECT_THREADS: int = _get('DETECT_THREADS', 0, int)
+MAX_BATCH_IMAGES: int = _get('MAX_BATCH_IMAGES', 64, int)
+MAX_MATCH_FEATURES: int = _get('MAX_MATCH_FEATURES', 1024, int)
+DETECT_BATCH_SIZE: int = _get('DETECT_BATCH_SIZE', 16, int)
+MIN_FACE_SIZE: int = _get('MIN_FACE_SIZE', 20, int)
+DETECT_MAX_SIDE: int = _get('DETECT_MAX_SIDE', 0, int)
+DECODE_MAX_SIDE: int = _get('DECODE_MAX_SIDE', 0, int)
+TRACK_REFRESH_FRAMES: int = _get('TRACK_REFRESH_FRAMES', 10, int)
+TRACK_MIN_IOU: float = _get('TRACK_MIN_IOU', 0.3, float)
+SERVER_TIMING: bool = _get('SERVER_TIMING', False, _bool)
+CACHE_SIZE: int = _get('CACHE_SIZE', 1024, int)
+CACHE_TTL: float = _get('CACHE_TTL', 300.0, float)
@@ -24,16 +24,24 @@ Example:
     >>> session, _ = get_connection()
     >>> for face in session.query(Face)
     ...     print(face)
+    >>> count, last_id = count_faces(session)
+    >>> read = read_faces(session, face_ids, person_ids, features, last_id=last_id)
 """
 
-from sqlalchemy import Column, Integer, PickleType, create_engine
+from sqlalchemy import Column, Integer, LargeBinary, create_engine, select, func
 from sqlalchemy.ext.declarative import declarative_base, DeclarativeMeta
 from sqlalchemy.orm import sessionmaker, Session
-from sqlalchemy.engine import Engine
-from typing import List, Tuple
+from sqlalchemy.engine import Engine, Result
+from sqlalchemy.sql.elements import ColumnElement
+from FRMS.config import FEATURES_DTYPE
+from typing import Callable, List, Optional, Tuple
+import numpy as np
 import torch
 import os
 
+FEATURES_DIM: int = 512
+_DTYPES: dict = {4: np.float32, 2: np.float16}
+
 
 def get_connection(database_url: str = '') -> Tuple[Session, Engine]:
     """Gets session and engine to connect to database.
@@ -60,35 +68,207 @@ Base: DeclarativeMeta = declarative_base()
 class Face(Base):
     """Class to work with table 'faces'.
 
+    Features are stored as raw bytes of float32 or float16 vector.
+
     Args:
         tensor: Features tensor.
         person_id: ID of the person.
+        dtype: Type of stored features, 'float32' or 'float16'.
 
     Attributes:
         id: Primary key of table (set automatically).
-        features: Features list.
+        features: Bytes of features vector.
         person_id: ID of the person.
     """
     __tablename__: str = 'faces'
     id: int = Column(Integer, primary_key=True, autoincrement=True)
-    features: List[float] = Column(PickleType)
-    person_id: int = Column(Integer)
+    features: bytes = Column(LargeBinary)
+    person_id: int = Column(Integer, index=True)
 
-    def __init__(self, tensor: torch.Tensor, person_id: int) -> None:
-        self.features = tensor.tolist()
+    def __init__(self, tensor: torch.Tensor, person_id: int, dtype: str = FEATURES_DTYPE) -> None:
+        self.features = encode_features(tensor.detach().cpu().numpy(), dtype)
         self.person_id = person_id
 
+    @property
+    def vector(self) -> np.ndarray:
+        """Decode features bytes to read-only array."""
+        return decode_features(self.features)
+
     @property
     def tensor(self) -> torch.Tensor:
-        """Convert list features to tensor."""
-        return torch.tensor(self.features)
+        """Convert features bytes to float32 tensor."""
+        return torch.tensor(self.vector, dtype=torch.float32)
+
+    def __repr__(self) -> str:
+        return "<Face('%s','%s')>" % (self.vector, self.person_id)
+
+
+class DeletedFace(Base):
+    """Class to work with table 'deleted_faces'.
+
+    Every deleted face leaves a tombstone row, so in-memory galleries
+    can remove it without reloading the table.
+
+    Args:
+        face_id: ID of the deleted face.
+
+    Attributes:
+        id: Primary key of table (set automatically).
+        face_id: ID of the deleted face.
+    """
+    __tablename__: str = 'deleted_faces'
+    id: int = Column(Integer, primary_key=True, autoincrement=True)
+    face_id: int = Column(Integer)
+
+    def __init__(self, face_id: int) -> None:
+        self.face_id = face_id
 
     def __repr__(self) -> str:
-        return "<Face('%s','%s')>" % (self.features, self.person_id)
+        return "<DeletedFace('%s')>" % self.face_id
+
+
+def delete_faces(session: Session, face_ids: List[int]) -> None:
+    """Deletes faces and leaves tombstones for them.
+
+    Args:
+        session: Database session.
+        face_ids: IDs of faces.
+
+    Return:
+        None
+    """
+    session.query(Face).filter(Face.id.in_(face_ids)).delete(synchronize_session=False)
+    session.add_all([DeletedFace(face_id) for face_id in face_ids])
+    session.commit()
+
+
+def in_shard(shard: Tuple[int, int]) -> ColumnElement:
+    """Gets condition selecting faces of the shard.
+
+    Faces are partitioned by person ID modulo number of shards,
+    so all faces of the person are in the same shard.
+
+    Args:
+        shard: Index of the shard and number of shards.
+
+    Return:
+        SQL condition.
+    """
+    index, count = shard
+    return Face.person_id % count == index
+
+
+def count_faces(session: Session, after_id: int = 0, shard: Optional[Tuple[int, int]] = None) -> Tuple[int, int]:
+    """Counts faces with IDs greater than given ID.
+
+    Args:
+        session: Database session.
+        after_id: Faces with IDs not greater than this ID are not counted.
+        shard: Index of the shard and number of shards to count faces of one shard, all faces by default.
+
+    Return:
+        Number of faces and max ID of face, after_id if there are no faces.
+    """
+    query = session.query(func.count(Face.id), func.coalesce(func.max(Face.id), after_id)).filter(Face.id > after_id)
+    if shard is not None:
+        query = query.filter(in_shard(shard))
+    count, last_id = query.one()
+    return count, last_id
+
+
+def read_faces(session: Session, face_ids: np.ndarray, person_ids: np.ndarray, features: np.ndarray,
+               after_id: int = 0, last_id: Optional[int] = None, chunk_size: int = 10000,
+               progress: Optional[Callable[[int, int], None]] = None, shard: Optional[Tuple[int, int]] = None) -> int:
+    """Streams faces ordered by ID into preallocated arrays.
+
+    Only IDs, person IDs and features are selected. Rows are fetched from
+    server-side cursor and decoded by chunks, so no ORM objects or list of
+    all rows are created and peak memory is close to size of arrays.
+    Arrays must have room for all faces counted by count_faces.
+
+    Args:
+        session: Database session.
+        face_ids: Array for IDs of the faces with shape (N,).
+        person_ids: Array for IDs of the persons with shape (N,).
+        features: Matrix for features with shape (N, 512).
+        after_id: Faces with IDs not greater than this ID are not read.
+        last_id: Faces with IDs greater than this ID are not read, all faces by default.
+        chunk_size: Number of rows fetched and decoded at once.
+        progress: Function called after every chunk with number of read faces and size of arrays.
+        shard: Index of the shard and number of shards to read faces of one shard, all faces by default.
+
+    Return:
+        Number of read faces.
+    """
+    query = select(Face.id, Face.person_id, Face.features).where(Face.id > after_id).order_by(Face.id)
+    if last_id is not None:
+        query = query.where(Face.id <= last_id)
+    if shard is not None:
+        query = query.where(in_shard(shard))
+    result: Result = session.connection().execute(query.execution_options(stream_results=True))
+    count: int = 0
+    for rows in result.partitions(chunk_size):
+        if count + len(rows) > len(face_ids):
+            result.close()
+            raise ValueError('Faces table has more than %d rows.' % len(face_ids))
+        for i, (face_id, person_id, data) in enumerate(rows, count):
+            face_ids[i] = face_id
+            person_ids[i] = person_id
+            features[i] = decode_features(data)
+        count += len(rows)
+        if progress is not None:
+            progress(count, len(face_ids))
+    return count
+
+
+def get_person_features(session: Session, person_id: int) -> np.ndarray:
+    """Reads features of all faces of the person by indexed person ID.
+
+    Args:
+        session: Database session.
+        person_id: ID of the person.
+
+    Return:
+        Matrix of float32 features with shape (N, 512).
+    """
+    rows: List[Tuple[bytes]] = session.query(Face.features).filter(Face.person_id == person_id).all()
+    features: np.ndarray = np.empty((len(rows), FEATURES_DIM), dtype=np.float32)
+    for i, (data,) in enumerate(rows):
+        features[i] = decode_features(data)
+    return features
+
+
+def encode_features(features: np.ndarray, dtype: str = FEATURES_DTYPE) -> bytes:
+    """Encode features vector to bytes.
+
+    Args:
+        features: Features vector.
+        dtype: Type of stored features, 'float32' or 'float16'.
+
+    Return:
+        Raw bytes of features vector.
+    """
+    return np.ascontiguousarray(features, dtype=np.dtype(dtype)).tobytes()
+
+
+def decode_features(data: bytes) -> np.ndarray:
+    """Decode bytes to features vector without copying.
+
+    Type of features is determined by length of data.
+
+    Args:
+        data: Raw bytes of float32 or float16 features vector.
+
+    Return:
+        Read-only features vector.
+    """
+    return np.frombuffer(data, dtype=_DTYPES[len(data) // FEATURES_DIM])
 
 
 def create_table(database_url: str = '') -> None:
-    """Creates the table in the database.
+    """Creates the tables in the database.
+
+    Indexes missing in existing tables are created too.
 
     Args:
         database_url: Database connection string.
@@ -98,8 +278,10 @@ def create_table(database_url: str = '') -> None:
     """
     _, engine = get_connection(database_url)
     Base.metadata.create_all(engine)
-    table: str = Face.__tablename__
-    print(table)
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+    print(Face.__tablename__, DeletedFace.__tablename__)
 
 
 if __name__ == '__main__':
@@ -19,7 +19,8 @@
 Data validation provided by Pydantic.
 """
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
+from FRMS.config import MAX_CANDIDATES
 from typing import List, Optional
 
 
@@ -32,6 +33,16 @@ class RequestModel(BaseModel):
     image: str
 
 
+class VerifyRequestModel(RequestModel):
+    """Verification request format to microservice.
+
+    Attributes:
+        image: Base64 image.
+        person_id: ID of the claimed person.
+    """
+    person_id: int
+
+
 class ResponseModel(BaseModel):
     """Response format of microservice.
 
@@ -41,3 +52,117 @@ class ResponseModel(BaseModel):
     """
     bbox: List[int]
     id: Optional[int]
+
+
+class CandidateModel(BaseModel):
+    """Candidate person of face.
+
+    Attributes:
+        id: ID of the person.
+        distance: Distance between features of face and the nearest face of the person.
+    """
+    id: int
+    distance: float
+
+
+class CandidatesResponseModel(ResponseModel):
+    """Response format of microservice with candidate persons.
+
+    Attributes:
+        bbox: Coordinates of bounding box.
+        id: ID of the person.
+        candidates: Nearest persons ranked by distance.
+    """
+    candidates: List[CandidateModel]
+
+
+class VerifyResponseModel(BaseModel):
+    """Verification response format of microservice.
+
+    Attributes:
+        bbox: Coordinates of bounding box.
+        distance: Distance to the nearest face of the claimed person, None if the person has no faces.
+        verified: Face belongs to the claimed person.
+    """
+    bbox: List[int]
+    distance: Optional[float]
+    verified: bool
+
+
+class EmbeddingResponseModel(BaseModel):
+    """Embedding response format of microservice.
+
+    Attributes:
+        bbox: Coordinates of bounding box.
+        features: Base64 little-endian float32 features vector of 512 values.
+    """
+    bbox: List[int]
+    features: str
+
+
+class MatchRequestModel(BaseModel):
+    """Match request format to microservice.
+
+    Attributes:
+        features: Base64 little-endian float32 features matrix with shape (N, 512).
+    """
+    features: str
+
+
+class ShardSearchRequestModel(BaseModel):
+    """Search request format to shard of gallery.
+
+    Attributes:
+        features: Base64 little-endian float32 features matrix with shape (N, 512).
+        k: Number of nearest persons of every features vector.
+    """
+    features: str
+    k: int = Field(1, ge=1, le=MAX_CANDIDATES)
+
+
+class ShardSearchResponseModel(BaseModel):
+    """Search response format of shard of gallery.
+
+    Attributes:
+        shard: Index of the shard and number of shards.
+        version: Gallery version of shard.
+        size: Number of faces in shard.
+        candidates: Nearest persons of every features vector ranked by distance.
+    """
+    shard: List[int]
+    version: int
+    size: int
+    candidates: List[List[CandidateModel]]
+
+
+class BatchRequestModel(BaseModel):
+    """Batch request format to microservice.
+
+    Attributes:
+        images: List of base64 images.
+    """
+    images: List[str]
+
+
+class BatchResponseModel(BaseModel):
+    """Batch response format of microservice.
+
+    Attributes:
+        index: Index of image in request.
+        faces: Faces found on image.
+        error: Error of image which can not be decoded, None if image is recognized.
+    """
+    index: int
+    faces: List[ResponseModel]
+    error: Optional[str] = None
+
+
+class TrackResponseModel(ResponseModel):
+    """Response format of microservice for video stream frame.
+
+    Attributes:
+        bbox: Coordinates of bounding box.
+        id: ID of the person.
+        track: ID of the face track in stream.
+    """
+    track: int
@@ -24,7 +24,7 @@ from torch.utils.data import Dataset
 from FRMS.utils.face_detector import FaceDetector
 import torch
 from pathlib import Path
-from typing import List, Dict, Tuple
+from typing import List, Dict, Tuple, Optional
 from PIL import Image
 import os
 
@@ -32,6 +32,10 @@ import os
 class FacesDataset(Dataset):
     """Dataset of faces.
 
+    Face detector is created on first use in the process which uses it
+    and is not pickled, so DataLoader worker processes never inherit
+    detector (and CUDA context) of the parent process.
+
     Args:
         root: Dataset root directory.
 
@@ -47,7 +51,19 @@ class FacesDataset(Dataset):
         self.labels_names: List[str] = self._list_labels_names()
         self._label_indexes: Dict[str, int] = self._list_label_indexes()
         self._image_labels: List[int] = self._list_labels()
-        self._face_detector: FaceDetector = FaceDetector()
+        self._face_detector: Optional[FaceDetector] = None
+
+    @property
+    def face_detector(self) -> FaceDetector:
+        """Face detector of the current process."""
+        if self._face_detector is None:
+            self._face_detector = FaceDetector()
+        return self._face_detector
+
+    def __getstate__(self) -> Dict[str, object]:
+        state: Dict[str, object] = self.__dict__.copy()
+        state['_face_detector'] = None
+        return state
 
     def __len__(self) -> int:
         """Get dataset length.
@@ -69,11 +85,25 @@ class FacesDataset(Dataset):
             Tuple of tensors.
         """
         label: int = self._image_labels[item]
-        img: Image.Image = Image.open(self.paths[item]).convert('RGB')
-        x: torch.Tensor = self._face_detector.find_faces(img)[0][0]
+        x: torch.Tensor = self.face_detector.find_faces(self._open(item))[0][0]
         y: torch.Tensor = torch.tensor(label)
         return x, y
 
+    def get_face(self, item: int) -> Optional[torch.Tensor]:
+        """Get the first face found on image.
+
+        Args:
+            item: Index of item.
+
+        Return:
+            Face image tensor or None if there are no faces on image.
+        """
+        faces: List[Tuple[torch.Tensor, List[int]]] = self.face_detector.find_faces(self._open(item))
+        return faces[0][0] if faces else None
+
+    def _open(self, item: int) -> Image.Image:
+        return Image.open(self.paths[item]).convert('RGB')
+
     def _list_dirs(self) -> List[str]:
         paths: List[Path] = list(self.root.rglob('*.*'))
         paths: List[str] = [str(path) for path in paths]
@@ -0,0 +1,168 @@
+# FRMS/metrics.py
+#
+# Copyright (C) 2021-2022  Дмитрий Кузнецов
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""This module contains Prometheus metrics of microservice and stage timers.
+
+Every stage of recognition (base64, decode, detect, crop, embed, match,
+verify, serialize) is timed by stage context manager. Time is observed in the
+frms_stage_seconds histogram and added to timings of the current request
+if they were started by start_timings. Timings are kept in context
+variable, so stages running in thread pool must be called in copy of
+the request context.
+
+If PROMETHEUS_MULTIPROC_DIR is set, metrics of all worker processes
+(e.g. gunicorn workers) are written to files in this directory and
+registry collects them, so every scrape returns metrics of all workers.
+
+Example:
+    >>> from FRMS.metrics import stage, start_timings, server_timing
+    >>> timings = start_timings()
+    >>> with stage('decode'):
+    ...     img = decode(data)
+    >>> server_timing(timings)
+    'decode;dur=1.52'
+"""
+
+from prometheus_client import CollectorRegistry, Counter, Histogram, Gauge, REGISTRY, multiprocess
+from contextvars import ContextVar
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional
+import time
+import os
+
+MULTIPROCESS_DIR: str = os.environ.get('PROMETHEUS_MULTIPROC_DIR', os.environ.get('prometheus_multiproc_dir', ''))
+if MULTIPROCESS_DIR:
+    os.makedirs(MULTIPROCESS_DIR, exist_ok=True)
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+STAGE_SECONDS: Histogram = Histogram('frms_stage_seconds', 'Time of recognition stage in seconds.',
+                                     ['stage'], buckets=LATENCY_BUCKETS)
+FACES_PER_IMAGE: Histogram = Histogram('frms_faces_per_image', 'Number of faces found on image.',
+                                       buckets=SIZE_BUCKETS)
+BATCH_IMAGES: Histogram = Histogram('frms_batch_images', 'Number of images in batch request.',
+                                    buckets=SIZE_BUCKETS)
+EMBED_BATCH_SIZE: Histogram = Histogram('frms_embed_batch_size', 'Number of faces in feature extraction batch.',
+                                        buckets=SIZE_BUCKETS)
+EMBED_BATCH_SECONDS: Histogram = Histogram('frms_embed_batch_seconds',
+                                           'Time of feature extraction batch in seconds.', buckets=LATENCY_BUCKETS)
+GALLERY_SIZE: Gauge = Gauge('frms_gallery_size', 'Number of faces in gallery.', multiprocess_mode='liveall')
+QUEUE_DEPTH: Gauge = Gauge('frms_embed_queue_depth', 'Number of requests waiting for feature extraction.',
+                           multiprocess_mode='livesum')
+PENDING_REQUESTS: Gauge = Gauge('frms_pending_requests', 'Number of requests in progress.',
+                                multiprocess_mode='livesum')
+CACHE_HITS: Counter = Counter('frms_cache_hits', 'Number of results found in result cache.')
+CACHE_MISSES: Counter = Counter('frms_cache_misses', 'Number of results not found in result cache.')
+CACHE_SIZE: Gauge = Gauge('frms_cache_size', 'Number of results in result cache.', multiprocess_mode='livesum')
+
+_timings: ContextVar[Optional[Dict[str, float]]] = ContextVar('timings', default=None)
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """Time stage of recognition.
+
+    Args:
+        name: Name of stage.
+
+    Return:
+        Context manager.
+    """
+    start: float = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start)
+
+
+def observe(name: str, seconds: float) -> None:
+    """Observe time of stage.
+
+    Args:
+        name: Name of stage.
+        seconds: Time of stage in seconds.
+
+    Return:
+        None
+    """
+    STAGE_SECONDS.labels(name).observe(seconds)
+    timings: Optional[Dict[str, float]] = _timings.get()
+    if timings is not None:
+        timings[name] = timings.get(name, 0.0) + seconds
+
+
+def start_timings() -> Dict[str, float]:
+    """Start collecting stage timings of the current request.
+
+    Return:
+        Dict of stage names and total times in seconds, filled by stages.
+    """
+    timings: Dict[str, float] = {}
+    _timings.set(timings)
+    return timings
+
+
+def server_timing(timings: Dict[str, float]) -> str:
+    """Format stage timings as value of Server-Timing header.
+
+    Args:
+        timings: Dict of stage names and times in seconds.
+
+    Return:
+        Header value with durations in milliseconds.
+    """
+    return ', '.join('%s;dur=%.2f' % (name, seconds * 1000) for name, seconds in timings.items())
+
+
+def registry() -> CollectorRegistry:
+    """Get registry of metrics to expose.
+
+    Return:
+        Registry of this process or, in multiprocess mode, registry
+        collecting metrics of all processes.
+    """
+    if not MULTIPROCESS_DIR:
+        return REGISTRY
+    collector_registry: CollectorRegistry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(collector_registry, MULTIPROCESS_DIR)
+    return collector_registry
+
+
+def clear_multiprocess_dir() -> None:
+    """Remove metrics files of previous run in multiprocess mode.
+
+    Return:
+        None
+    """
+    if not MULTIPROCESS_DIR:
+        return
+    for name in os.listdir(MULTIPROCESS_DIR):
+        if name.endswith('.db'):
+            os.remove(os.path.join(MULTIPROCESS_DIR, name))
+
+
+def mark_process_dead(pid: int) -> None:
+    """Remove live gauges of exited worker process in multiprocess mode.
+
+    Args:
+        pid: ID of worker process.
+
+    Return:
+        None
+    """
+    if MULTIPROCESS_DIR:
+        multiprocess.mark_process_dead(pid, MULTIPROCESS_DIR)
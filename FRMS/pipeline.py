@@ -0,0 +1,428 @@
+# FRMS/pipeline.py
+#
+# Copyright (C) 2021-2022  Дмитрий Кузнецов
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""This module contains class RecognitionPipeline.
+
+Pipeline runs blocking stages of face recognition (image decoding,
+face detection and feature matching) in a bounded thread pool and
+feature extraction in BatchScheduler, so event loop is never blocked.
+PyTorch and NumPy release GIL in heavy operations, so threads run
+stages in parallel and share one copy of models and gallery.
+
+Example:
+    >>> from FRMS.pipeline import RecognitionPipeline
+    >>> pipeline = RecognitionPipeline(detector, batch_scheduler, feature_matcher)
+    >>> data = await pipeline.recognize(base64_image)
+"""
+
+from FRMS.utils.face_detector import FaceDetector
+from FRMS.utils.batch_scheduler import BatchScheduler
+from FRMS.utils.feature_matcher import FeatureMatcher
+from FRMS.utils.tracker import FaceTracker, Track
+from FRMS.utils.cache import ResultCache, image_key
+from FRMS.metrics import stage, FACES_PER_IMAGE, BATCH_IMAGES
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Hashable, List, Tuple, Dict, Union, AsyncIterator, Optional
+from PIL import Image
+import contextvars
+import asyncio
+import binascii
+import base64
+import torch
+import math
+import io
+
+
+class PipelineSaturated(Exception):
+    """Raised when pipeline has max_pending requests in progress."""
+
+
+class InvalidImage(Exception):
+    """Raised when image data is not valid base64 or image file."""
+
+
+class RecognitionPipeline:
+    """Pipeline of face recognition.
+
+    Args:
+        detector: Face detector.
+        batch_scheduler: Scheduler of feature extraction.
+        feature_matcher: Feature matcher.
+        max_workers: Number of threads for decoding, detection and matching.
+        max_pending: Max number of requests in progress, next requests
+            are rejected with PipelineSaturated.
+        num_threads: Number of PyTorch threads in every worker thread,
+            0 keeps PyTorch default.
+        detect_batch_size: Max number of same-size images of batch
+            request detected by one MTCNN run.
+        cache: Cache of results by image content, results are not
+            cached if not set.
+        decode_max_side: Max side in pixels to which JPEG images are
+            reduced while decoding, 0 to decode in original size.
+
+    Attributes:
+        max_pending: Max number of requests in progress.
+        decode_max_side: Max side in pixels to which JPEG images are reduced while decoding.
+    """
+    def __init__(self, detector: FaceDetector, batch_scheduler: BatchScheduler, feature_matcher: FeatureMatcher,
+                 max_workers: int = 4, max_pending: int = 64, num_threads: int = 0,
+                 detect_batch_size: int = 16, cache: Optional[ResultCache] = None, decode_max_side: int = 0) -> None:
+        self.max_pending: int = max_pending
+        self.decode_max_side: int = decode_max_side
+        self.detect_batch_size: int = detect_batch_size
+        self._cache: Optional[ResultCache] = cache
+        self._pending: int = 0
+        self._detector: FaceDetector = detector
+        self._batch_scheduler: BatchScheduler = batch_scheduler
+        self._feature_matcher: FeatureMatcher = feature_matcher
+        self._executor: ThreadPoolExecutor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='pipeline',
+            initializer=set_num_threads, initargs=(num_threads,)
+        )
+
+    @property
+    def pending(self) -> int:
+        """Number of requests in progress."""
+        return self._pending
+
+    async def recognize(self, data: Union[str, bytes], k: int = 0) -> List[Dict[str, Union[List[int], int, str]]]:
+        """Find and recognize faces on image.
+
+        Args:
+            data: Base64 string or bytes of image file.
+            k: Number of candidate persons of every face, 0 to find only the nearest person.
+
+        Return:
+            List of dicts of person info with bounding boxes.
+        """
+        version: Hashable = self._feature_matcher.version
+        key: Optional[Tuple[bytes, float, int]] = await self._key(data, k)
+        cached: Optional[List[Dict[str, Union[List[int], int, str]]]] = self._cached(key, version)
+        if cached is not None:
+            return cached
+
+        self._admit()
+        try:
+            answers: List[Dict[str, Union[List[int], int, str]]] = await self._process(data, k)
+        finally:
+            self._pending -= 1
+        if key is not None:
+            self._cache.put(key, answers, version)
+        return answers
+
+    def recognize_many(self, images: List[Union[str, bytes]]
+                       ) -> AsyncIterator[Tuple[int, Union[List[Dict[str, Union[List[int], int, str]]], InvalidImage]]]:
+        """Find and recognize faces on many images.
+
+        Images are processed concurrently: images are decoded in parallel
+        threads, images of the same size are detected by batches of
+        detect_batch_size and faces of all images are batched by BatchScheduler.
+        Cached results are returned first, images which can not be decoded
+        are returned with InvalidImage error instead of faces.
+        Saturation is checked immediately, but batch is admitted as one
+        request only when iteration starts, so iterator which is never
+        iterated does not hold the request.
+
+        Args:
+            images: Base64 strings or bytes of image files.
+
+        Return:
+            Async iterator of image index and its list of dicts of person info
+            or error, in order of completion.
+        """
+        if self._pending >= self.max_pending:
+            raise PipelineSaturated()
+        return self._recognize_many(images)
+
+    async def recognize_batch(self, images: List[Union[str, bytes]]
+                              ) -> List[Union[List[Dict[str, Union[List[int], int, str]]], InvalidImage]]:
+        """Find and recognize faces on many images.
+
+        Args:
+            images: Base64 strings or bytes of image files.
+
+        Return:
+            Lists of dicts of person info or InvalidImage errors, in order of images.
+        """
+        results: List[Union[List[Dict[str, Union[List[int], int, str]]], InvalidImage]] = [[] for _ in images]
+        async for i, answers in self.recognize_many(images):
+            results[i] = answers
+        return results
+
+    async def recognize_frame(self, tracker: FaceTracker, data: Union[str, bytes]
+                              ) -> List[Dict[str, Union[List[int], int, str]]]:
+        """Find faces on video frame and recognize only stale tracks.
+
+        Faces are detected in every frame, but features are extracted
+        and matched only for faces of new or stale tracks, other faces
+        keep person ID of their track.
+
+        Args:
+            tracker: Tracker of faces in video stream.
+            data: Base64 string or bytes of frame image file.
+
+        Return:
+            List of dicts of person info with bounding boxes and track IDs.
+        """
+        self._admit()
+        try:
+            faces: List[Tuple[torch.Tensor, List[int]]] = await self._run(self.detect, data)
+            FACES_PER_IMAGE.observe(len(faces))
+            tracks: List[Track] = tracker.update([bb for _, bb in faces])
+            stale: List[int] = [i for i, track in enumerate(tracks) if track.stale]
+            answers: List[Dict[str, Union[List[int], int, str]]] = await self._embed_and_match(
+                [faces[i] for i in stale]
+            )
+        finally:
+            self._pending -= 1
+
+        for i, answer in zip(stale, answers):
+            tracks[i].recognized(answer['id'])
+        return [{'bbox': bb, 'id': track.person_id, 'track': track.track_id} for (_, bb), track in zip(faces, tracks)]
+
+    async def verify(self, data: Union[str, bytes], person_id: int
+                     ) -> List[Dict[str, Union[List[int], float, bool, None]]]:
+        """Find faces on image and verify that they belong to the person.
+
+        Features are compared only with faces of the claimed person,
+        gallery is not searched.
+
+        Args:
+            data: Base64 string or bytes of image file.
+            person_id: ID of the claimed person.
+
+        Return:
+            List of dicts of distance and decision with bounding boxes.
+        """
+        self._admit()
+        try:
+            faces: List[Tuple[torch.Tensor, List[int]]] = await self._run(self.detect, data)
+            FACES_PER_IMAGE.observe(len(faces))
+            if not faces:
+                return []
+            answers: List[Dict[str, Union[List[int], float, bool, None]]] = await self._run(
+                self._feature_matcher.verify_features_batch, await self._embed(faces), person_id
+            )
+        finally:
+            self._pending -= 1
+        for answer, (_, bb) in zip(answers, faces):
+            answer['bbox'] = bb
+        return answers
+
+    async def embed(self, data: Union[str, bytes]) -> List[Dict[str, Union[List[int], torch.Tensor]]]:
+        """Find faces on image and extract their features without matching.
+
+        Args:
+            data: Base64 string or bytes of image file.
+
+        Return:
+            List of dicts of features vector with bounding boxes.
+        """
+        self._admit()
+        try:
+            faces: List[Tuple[torch.Tensor, List[int]]] = await self._run(self.detect, data)
+            FACES_PER_IMAGE.observe(len(faces))
+            if not faces:
+                return []
+            features: torch.Tensor = await self._embed(faces)
+        finally:
+            self._pending -= 1
+        return [{'bbox': bb, 'features': vector} for (_, bb), vector in zip(faces, features)]
+
+    async def match(self, features: torch.Tensor, k: int = 0) -> List[Dict[str, Union[List[int], int, str]]]:
+        """Match features extracted by client, without detection and extraction.
+
+        Args:
+            features: Tensor of features with shape (N, 512).
+            k: Number of candidate persons of every features vector, 0 to find only the nearest person.
+
+        Return:
+            List of dicts of person info, one dict per features vector.
+        """
+        self._admit()
+        try:
+            return await self._run(self._feature_matcher.match_features_batch, features, k)
+        finally:
+            self._pending -= 1
+
+    def _admit(self) -> None:
+        if self._pending >= self.max_pending:
+            raise PipelineSaturated()
+        self._pending += 1
+
+    async def _recognize_many(self, images: List[Union[str, bytes]]
+                              ) -> AsyncIterator[Tuple[int, Union[List[Dict[str, Union[List[int], int, str]]],
+                                                                  InvalidImage]]]:
+        self._pending += 1
+        BATCH_IMAGES.observe(len(images))
+        version: Hashable = self._feature_matcher.version
+        detections: List[asyncio.Future] = []
+        tasks: List[asyncio.Task] = []
+        try:
+            keys: List[Optional[Tuple[bytes, float, int]]] = await asyncio.gather(*[self._key(data) for data in images])
+            missed: List[int] = []
+            for i, key in enumerate(keys):
+                cached: Optional[List[Dict[str, Union[List[int], int, str]]]] = self._cached(key, version)
+                if cached is not None:
+                    yield i, cached
+                else:
+                    missed.append(i)
+
+            detections = [self._run(decode_image, images[i], self.decode_max_side) for i in missed]
+            decoded: Dict[int, Tuple[Image.Image, float]] = {}
+            for i, result in zip(missed, await asyncio.gather(*detections, return_exceptions=True)):
+                if isinstance(result, InvalidImage):
+                    yield i, result
+                elif isinstance(result, BaseException):
+                    raise result
+                else:
+                    decoded[i] = result
+            groups: Dict[Tuple[int, int], List[int]] = {}
+            for i, (img, _) in decoded.items():
+                groups.setdefault(img.size, []).append(i)
+
+            detections = []
+            for indexes in groups.values():
+                for start in range(0, len(indexes), self.detect_batch_size):
+                    chunk: List[int] = indexes[start:start + self.detect_batch_size]
+                    detections.append(self._run(
+                        self._detector.find_faces_batch, [decoded[i][0] for i in chunk]
+                    ))
+                    tasks.extend(asyncio.ensure_future(self._finish(i, detections[-1], position, decoded[i][1]))
+                                 for position, i in enumerate(chunk))
+            del decoded
+            for task in asyncio.as_completed(tasks):
+                i, answers = await task
+                if keys[i] is not None:
+                    self._cache.put(keys[i], answers, version)
+                yield i, answers
+        finally:
+            for future in detections + tasks:
+                future.cancel()
+            self._pending -= 1
+
+    async def _key(self, data: Union[str, bytes], k: int = 0) -> Optional[Tuple[bytes, float, int]]:
+        if self._cache is None or self._cache.max_size <= 0:
+            return None
+        return await self._run(image_key, data, self._feature_matcher.max_distance, k)
+
+    def _cached(self, key: Optional[Tuple[bytes, float, int]], version: Hashable
+                ) -> Optional[List[Dict[str, Union[List[int], int, str]]]]:
+        return self._cache.get(key, version) if key is not None else None
+
+    async def _finish(self, index: int, detection: asyncio.Future, position: int, scale: float
+                      ) -> Tuple[int, List[Dict[str, Union[List[int], int, str]]]]:
+        faces: List[Tuple[torch.Tensor, List[int]]] = restore_bboxes((await asyncio.shield(detection))[position], scale)
+        FACES_PER_IMAGE.observe(len(faces))
+        return index, await self._embed_and_match(faces)
+
+    async def _process(self, data: Union[str, bytes], k: int = 0) -> List[Dict[str, Union[List[int], int, str]]]:
+        faces: List[Tuple[torch.Tensor, List[int]]] = await self._run(self.detect, data)
+        FACES_PER_IMAGE.observe(len(faces))
+        return await self._embed_and_match(faces, k)
+
+    async def _embed_and_match(self, faces: List[Tuple[torch.Tensor, List[int]]], k: int = 0
+                               ) -> List[Dict[str, Union[List[int], int, str]]]:
+        if not faces:
+            return []
+        answers: List[Dict[str, Union[List[int], int, str]]] = await self._run(
+            self._feature_matcher.match_features_batch, await self._embed(faces), k
+        )
+        for answer, (_, bb) in zip(answers, faces):
+            answer['bbox'] = bb
+        return answers
+
+    async def _embed(self, faces: List[Tuple[torch.Tensor, List[int]]]) -> torch.Tensor:
+        with stage('embed'):
+            return await self._batch_scheduler.extract_features(torch.stack([face for face, _ in faces]))
+
+    def _run(self, func: Callable, *args: Any) -> asyncio.Future:
+        return asyncio.get_running_loop().run_in_executor(
+            self._executor, contextvars.copy_context().run, func, *args
+        )
+
+    def detect(self, data: Union[str, bytes]) -> List[Tuple[torch.Tensor, List[int]]]:
+        """Decode image and find faces on it.
+
+        Args:
+            data: Base64 string or bytes of image file.
+
+        Return:
+            List of tuples image -- tensor and list of bounding box coordinates.
+        """
+        img, scale = decode_image(data, self.decode_max_side)
+        return restore_bboxes(self._detector.find_faces(img), scale)
+
+
+def decode_image(data: Union[str, bytes], max_side: int = 0) -> Tuple[Image.Image, float]:
+    """Decode image file to RGB PIL Image.
+
+    JPEG image larger than max_side is reduced by JPEG decoder (by 1/2,
+    1/4 or 1/8) while decoding, its larger side stays not less than max_side.
+    InvalidImage is raised if data is not valid base64 or image file
+    is unknown, truncated or too large.
+
+    Args:
+        data: Base64 string or bytes of image file.
+        max_side: Max side in pixels of decoded JPEG image, 0 to decode in original size.
+
+    Return:
+        PIL Image and its scale relative to original image.
+    """
+    if isinstance(data, str):
+        with stage('base64'):
+            try:
+                data = base64.b64decode(data)
+            except binascii.Error:
+                raise InvalidImage('Image is not valid base64.') from None
+    try:
+        with stage('decode'):
+            img: Image.Image = Image.open(io.BytesIO(data))
+            width: int = img.width
+            if 0 < max_side < max(img.size):
+                scale: float = max_side / max(img.size)
+                img.draft('RGB', (math.ceil(img.width * scale), math.ceil(img.height * scale)))
+            return img.convert('RGB'), img.width / width
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        raise InvalidImage('Image can not be decoded (%s).' % type(e).__name__) from e
+
+
+def restore_bboxes(faces: List[Tuple[torch.Tensor, List[int]]], scale: float) -> List[Tuple[torch.Tensor, List[int]]]:
+    """Scale bounding boxes found on reduced image back to original image.
+
+    Args:
+        faces: List of tuples image -- tensor and list of bounding box coordinates.
+        scale: Scale of reduced image relative to original image.
+
+    Return:
+        List of tuples image -- tensor and list of bounding box coordinates on original image.
+    """
+    if scale == 1.0:
+        return faces
+    return [(face, [coordinate / scale for coordinate in bb]) for face, bb in faces]
+
+
+def set_num_threads(num_threads: int) -> None:
+    """Set number of PyTorch threads.
+
+    Args:
+        num_threads: Number of threads, 0 keeps PyTorch default.
+
+    Return:
+        None
+    """
+    if num_threads > 0:
+        torch.set_num_threads(num_threads)
@@ -0,0 +1,193 @@
+# FRMS/service.py
+#
+# Copyright (C) 2021-2022  Дмитрий Кузнецов
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""This module contains class Service.
+
+Service creates components of microservice lazily, so importing the
+application is fast and the server binds before models are loaded.
+Models may be loaded in gunicorn master before fork to share their
+weights between workers, threads and database connections are created
+only in workers.
+
+Example:
+    >>> from FRMS.service import Service
+    >>> service = Service()
+    >>> service.load_models()  # optional, in gunicorn master
+    >>> service.start()  # in every worker
+    >>> service.ready
+    True
+"""
+
+from FRMS.utils.face_detector import FaceDetector
+from FRMS.utils.feature_extractor import FeatureExtractor
+from FRMS.utils.feature_matcher import FeatureMatcher
+from FRMS.utils.batch_scheduler import BatchScheduler
+from FRMS.utils.sharding import ShardedMatcher, ProcessShard, HTTPShard
+from FRMS.utils.index import Index, create_index
+from FRMS.utils.cache import ResultCache
+from FRMS.pipeline import RecognitionPipeline
+from FRMS.config import THRESHOLD, INDEX, IVF_NLIST, IVF_NPROBE, TEMPLATES, RERANK_PERSONS, SYNC_INTERVAL, \
+    SNAPSHOT_PATH, SNAPSHOT_TOP_UP, BATCH_MAX_SIZE, BATCH_MAX_WAIT_MS, EMBED_MODE, EMBED_MODEL, EMBED_THREADS, \
+    MODEL_CACHE, PIPELINE_WORKERS, PIPELINE_MAX_PENDING, DETECT_THREADS, DETECT_BATCH_SIZE, CACHE_SIZE, CACHE_TTL, \
+    MIN_FACE_SIZE, DETECT_MAX_SIDE, DECODE_MAX_SIDE, SHARD_INDEX, SHARD_COUNT, SHARDS, LOCAL_SHARDS, START_RETRIES, \
+    START_RETRY_DELAY
+from typing import Any, Dict, List, Optional, Union
+from PIL import Image
+import logging
+import torch
+import time
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+
+class Service:
+    """Lazily created components of microservice.
+
+    Attributes:
+        detector: Face detector.
+        feature_extractor: Feature extractor.
+        batch_scheduler: Scheduler of feature extraction.
+        feature_matcher: Feature matcher of the whole gallery, of one shard or of all shards.
+        cache: Cache of results by image content.
+        pipeline: Pipeline of face recognition.
+        ready: Components are created and warmed up.
+        error: Error of the last start attempt, None if service is starting or started.
+        failed: All start attempts failed, service will never be ready.
+    """
+    def __init__(self) -> None:
+        self.detector: Optional[FaceDetector] = None
+        self.feature_extractor: Optional[FeatureExtractor] = None
+        self.batch_scheduler: Optional[BatchScheduler] = None
+        self.feature_matcher: Optional[Union[FeatureMatcher, ShardedMatcher]] = None
+        self.cache: Optional[ResultCache] = None
+        self.pipeline: Optional[RecognitionPipeline] = None
+        self.ready: bool = False
+        self.error: Optional[str] = None
+        self.failed: bool = False
+        self._started: float = time.monotonic()
+        self._startup_time: Optional[float] = None
+
+    def load_models(self) -> None:
+        """Load face detection and feature extraction models.
+
+        Models are loaded once, the method is safe to call before fork.
+
+        Return:
+            None
+        """
+        if self.detector is None:
+            self.detector = FaceDetector(min_face_size=MIN_FACE_SIZE, max_side=DETECT_MAX_SIDE)
+        if self.feature_extractor is None:
+            self.feature_extractor = FeatureExtractor(mode=EMBED_MODE, model_path=EMBED_MODEL, cache_dir=MODEL_CACHE)
+
+    def start(self, retries: int = START_RETRIES, retry_delay: float = START_RETRY_DELAY) -> None:
+        """Create all components, load gallery and warm up models.
+
+        Failed start (e.g. database or shards are not reachable yet) is
+        retried with exponential backoff, components created by failed
+        attempts are reused. Error of every attempt is logged and saved
+        to error attribute, failed attribute is set after the last attempt.
+
+        Args:
+            retries: Number of retries of failed start.
+            retry_delay: Delay in seconds before the first retry, doubled after every retry up to 60 seconds.
+
+        Return:
+            None
+        """
+        for attempt in range(retries + 1):
+            try:
+                self._create()
+                break
+            except Exception as e:
+                logger.exception('Service failed to start (attempt %d of %d).', attempt + 1, retries + 1)
+                self.error = '%s: %s' % (type(e).__name__, e)
+            if attempt < retries:
+                time.sleep(min(retry_delay * 2 ** attempt, 60.0))
+        else:
+            self.failed = True
+            return
+        self.error = None
+        self._startup_time = time.monotonic() - self._started
+        self.ready = True
+        logger.info('Service is ready in %.1f s.', self._startup_time)
+
+    def _create(self) -> None:
+        self.load_models()
+        if self.batch_scheduler is None:
+            self.batch_scheduler = BatchScheduler(self.feature_extractor, max_batch_size=BATCH_MAX_SIZE,
+                                                  max_wait_ms=BATCH_MAX_WAIT_MS, num_threads=EMBED_THREADS)
+        if self.feature_matcher is None:
+            self.feature_matcher = self.create_matcher()
+        if self.pipeline is None:
+            self.cache = ResultCache(max_size=CACHE_SIZE, ttl=CACHE_TTL)
+            self.pipeline = RecognitionPipeline(
+                self.detector, self.batch_scheduler, self.feature_matcher,
+                max_workers=PIPELINE_WORKERS, max_pending=PIPELINE_MAX_PENDING, num_threads=DETECT_THREADS,
+                detect_batch_size=DETECT_BATCH_SIZE, cache=self.cache, decode_max_side=DECODE_MAX_SIDE
+            )
+        self.warm_up()
+
+    def create_matcher(self) -> Union[FeatureMatcher, ShardedMatcher]:
+        """Create matcher of the whole gallery, of one shard or of shards served by other processes.
+
+        Return:
+            Feature matcher.
+        """
+        index: Index = create_index(INDEX, nlist=IVF_NLIST or None, nprobe=IVF_NPROBE,
+                                    templates=TEMPLATES, rerank=RERANK_PERSONS)
+        if SHARDS:
+            urls: List[str] = [url.strip() for url in SHARDS.split(',') if url.strip()]
+            return ShardedMatcher([HTTPShard(url, i, len(urls)) for i, url in enumerate(urls)],
+                                  max_distance=THRESHOLD, sync_interval=SYNC_INTERVAL)
+        if LOCAL_SHARDS > 0:
+            kwargs: Dict[str, Any] = {'max_distance': THRESHOLD, 'index': index, 'sync_interval': SYNC_INTERVAL}
+            return ShardedMatcher([ProcessShard(i, LOCAL_SHARDS, kwargs) for i in range(LOCAL_SHARDS)],
+                                  max_distance=THRESHOLD, sync_interval=SYNC_INTERVAL)
+        return FeatureMatcher(
+            max_distance=THRESHOLD,
+            index=index,
+            sync_interval=SYNC_INTERVAL,
+            snapshot_path=SNAPSHOT_PATH,
+            snapshot_top_up=SNAPSHOT_TOP_UP,
+            shard=(SHARD_INDEX, SHARD_COUNT) if SHARD_COUNT > 0 else None
+        )
+
+    def shard(self) -> List[int]:
+        """Get shard of gallery served by this instance.
+
+        Return:
+            Index of the shard and number of shards, shard 0 of 1 if instance serves the whole gallery.
+        """
+        return [SHARD_INDEX, SHARD_COUNT] if SHARD_COUNT > 0 else [0, 1]
+
+    def warm_up(self) -> None:
+        """Run every stage once, so the first request does not pay for lazy initialization.
+
+        Return:
+            None
+        """
+        self.detector.find_faces(Image.new('RGB', (160, 160)))
+        features: torch.Tensor = self.batch_scheduler.submit(torch.zeros((1, 3, 160, 160))).result()
+        self.feature_matcher.match_features_batch(features)
+
+    def status(self) -> Dict[str, Union[bool, float, str, None]]:
+        """Get state of service.
+
+        Return:
+            Dict with readiness, startup time in seconds, error and failure of all start attempts.
+        """
+        return {'ready': self.ready, 'startup_time': self._startup_time, 'error': self.error, 'failed': self.failed}
@@ -0,0 +1,141 @@
+# FRMS/utils/batch_scheduler.py
+#
+# Copyright (C) 2021-2022  Дмитрий Кузнецов
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""This module contains class BatchScheduler.
+
+BatchScheduler collects face images from concurrent requests into
+batches and extracts their features in a worker thread.
+"""
+
+from FRMS.utils.feature_extractor import FeatureExtractor
+from FRMS.metrics import EMBED_BATCH_SIZE, EMBED_BATCH_SECONDS
+from concurrent.futures import Future
+from typing import List, Optional, Tuple
+import threading
+import asyncio
+import queue
+import torch
+import time
+
+
+class BatchScheduler:
+    """Dynamic micro-batching of feature extraction.
+
+    Worker thread takes the first waiting request and then collects
+    more requests until the next request does not fit in max_batch_size
+    faces or max_wait_ms milliseconds passed. Request with more than
+    max_batch_size faces makes a batch on its own. Features of the whole
+    batch are extracted by one forward pass and split back between requests.
+
+    Args:
+        feature_extractor: Feature extractor.
+        max_batch_size: Max number of faces in batch.
+        max_wait_ms: Max time in milliseconds to wait for more requests.
+        num_threads: Number of PyTorch threads in worker thread,
+            0 keeps PyTorch default.
+
+    Example:
+        >>> import torch
+        >>> from FRMS.utils.feature_extractor import FeatureExtractor
+        >>> from FRMS.utils.batch_scheduler import BatchScheduler
+        >>> scheduler = BatchScheduler(FeatureExtractor(), max_batch_size=32, max_wait_ms=5.0)
+        >>> features = await scheduler.extract_features(torch.rand((4, 3, 160, 160)))
+    """
+    def __init__(self, feature_extractor: FeatureExtractor, max_batch_size: int = 32,
+                 max_wait_ms: float = 5.0, num_threads: int = 0) -> None:
+        self.max_batch_size: int = max_batch_size
+        self.max_wait_ms: float = max_wait_ms
+        self.num_threads: int = num_threads
+        self._feature_extractor: FeatureExtractor = feature_extractor
+        self._queue: queue.Queue = queue.Queue()
+        self._carry: Optional[Tuple[torch.Tensor, Future]] = None
+        self._thread: threading.Thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, faces: torch.Tensor) -> Future:
+        """Put face images to queue.
+
+        Args:
+            faces: Tensor of face images with shape (N, 3, H, W).
+
+        Return:
+            Future of features tensor with shape (N, 512).
+        """
+        future: Future = Future()
+        self._queue.put((faces, future))
+        return future
+
+    async def extract_features(self, faces: torch.Tensor) -> torch.Tensor:
+        """Extract features in the next batch without blocking event loop.
+
+        Args:
+            faces: Tensor of face images with shape (N, 3, H, W).
+
+        Return:
+            Tensor of features with shape (N, 512).
+        """
+        return await asyncio.wrap_future(self.submit(faces))
+
+    def qsize(self) -> int:
+        """Get number of requests waiting in queue.
+
+        Return:
+            Queue length.
+        """
+        return self._queue.qsize()
+
+    def _collect(self) -> List[Tuple[torch.Tensor, Future]]:
+        first: Tuple[torch.Tensor, Future] = self._carry if self._carry is not None else self._queue.get()
+        self._carry = None
+        batch: List[Tuple[torch.Tensor, Future]] = [first]
+        size: int = first[0].shape[0]
+        deadline: float = time.monotonic() + self.max_wait_ms / 1000
+        while size < self.max_batch_size:
+            timeout: float = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item: Tuple[torch.Tensor, Future] = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if size + item[0].shape[0] > self.max_batch_size:
+                self._carry = item
+                break
+            batch.append(item)
+            size += item[0].shape[0]
+        return batch
+
+    def _run(self) -> None:
+        if self.num_threads > 0:
+            torch.set_num_threads(self.num_threads)
+        while True:
+            batch: List[Tuple[torch.Tensor, Future]] = [
+                (faces, future) for faces, future in self._collect() if future.set_running_or_notify_cancel()
+            ]
+            if not batch:
+                continue
+            try:
+                stacked: torch.Tensor = torch.cat([faces for faces, _ in batch])
+                EMBED_BATCH_SIZE.observe(stacked.shape[0])
+                with EMBED_BATCH_SECONDS.time():
+                    features: torch.Tensor = self._feature_extractor.extract_features_batch(stacked)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            for (_, future), chunk in zip(batch, torch.split(features, [faces.shape[0] for faces, _ in batch])):
+                future.set_result(chunk)
@@ -0,0 +1,146 @@
+# FRMS/utils/cache.py
+#
+# Copyright (C) 2021-2022  Дмитрий Кузнецов
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""This module contains class ResultCache and function image_key.
+
+ResultCache keeps recognition results of recently seen images,
+so resubmitted image skips decoding, detection, extraction and matching.
+Hits and misses are counted by frms_cache_hits_total and
+frms_cache_misses_total Prometheus counters.
+"""
+
+from FRMS.metrics import CACHE_HITS, CACHE_MISSES
+from collections import OrderedDict
+from typing import Any, Hashable, Optional, Tuple, Union
+import threading
+import hashlib
+import copy
+import time
+
+
+class ResultCache:
+    """LRU cache of recognition results with time to live.
+
+    Every entry belongs to gallery version, the whole cache is
+    cleared when get sees another gallery version. Versions are
+    compared only for equality, so any hashable version can be used.
+
+    Args:
+        max_size: Max number of entries, 0 disables cache.
+        ttl: Time to live of entry in seconds, 0 for unlimited.
+
+    Attributes:
+        hits: Number of found entries.
+        misses: Number of not found entries.
+
+    Example:
+        >>> from FRMS.utils.cache import ResultCache, image_key
+        >>> cache = ResultCache(max_size=1024, ttl=300)
+        >>> key = image_key(data, threshold=1.0)
+        >>> cache.put(key, result, version=1)
+        >>> cache.get(key, version=1)
+    """
+    def __init__(self, max_size: int = 1024, ttl: float = 300.0) -> None:
+        self.max_size: int = max_size
+        self.ttl: float = ttl
+        self.hits: int = 0
+        self.misses: int = 0
+        self._version: Optional[Hashable] = None
+        self._entries: OrderedDict = OrderedDict()
+        self._lock: threading.Lock = threading.Lock()
+
+    def __len__(self) -> int:
+        """Get number of entries.
+
+        Return:
+            Cache size.
+        """
+        return len(self._entries)
+
+    def get(self, key: Hashable, version: Hashable) -> Optional[Any]:
+        """Get copy of cached value.
+
+        Args:
+            key: Key of entry.
+            version: Current gallery version.
+
+        Return:
+            Value or None if entry is not found or expired.
+        """
+        if self.max_size <= 0:
+            return None
+        with self._lock:
+            if version != self._version:
+                self._entries.clear()
+                self._version = version
+            entry: Optional[Tuple[float, Any]] = self._entries.get(key)
+            if entry is None or (self.ttl > 0 and time.monotonic() - entry[0] > self.ttl):
+                self.misses += 1
+                CACHE_MISSES.inc()
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            CACHE_HITS.inc()
+            return copy.deepcopy(entry[1])
+
+    def put(self, key: Hashable, value: Any, version: Hashable) -> None:
+        """Put copy of value to cache, least recently used entry is evicted if cache is full.
+
+        Value is not cached if get has seen another gallery version since
+        value was calculated.
+
+        Args:
+            key: Key of entry.
+            value: Value of entry.
+            version: Gallery version used to calculate value.
+
+        Return:
+            None
+        """
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            if version != self._version:
+                return
+            self._entries[key] = (time.monotonic(), copy.deepcopy(value))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        """Remove all entries.
+
+        Return:
+            None
+        """
+        with self._lock:
+            self._entries.clear()
+
+
+def image_key(data: Union[str, bytes], threshold: float, k: int = 0) -> Tuple[bytes, float, int]:
+    """Get cache key of image.
+
+    Args:
+        data: Base64 string or bytes of image file.
+        threshold: Max distance between features used for matching.
+        k: Number of requested candidates.
+
+    Return:
+        BLAKE2 digest of image data, threshold and number of candidates.
+    """
+    if isinstance(data, str):
+        return hashlib.blake2b(data.encode('ascii'), digest_size=16, person=b'base64').digest(), threshold, k
+    return hashlib.blake2b(data, digest_size=16, person=b'raw').digest(), threshold, k
@@ -16,23 +16,40 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """This module contains class FaceDetector.
 
-MTCNN uses for face detection.
+MTCNN uses for face detection. Large images may be detected on downscaled
+copy, faces are cropped from the original image anyway.
 """
 
 from facenet_pytorch import MTCNN
-from facenet_pytorch.models.utils.detect_face import extract_face
+from facenet_pytorch.models.utils.detect_face import detect_face, extract_face
 from facenet_pytorch.models.mtcnn import fixed_image_standardization
-from PIL.Image import Image
-from typing import List, Tuple
+from torchvision.ops import roi_align
+from FRMS.metrics import stage
+from PIL.Image import Image, BILINEAR
+from typing import List, Optional, Tuple, Union
+import numpy as np
 import torch
 
+PNET_SIZE: int = 12
+
 
 class FaceDetector:
     """Class for face detection.
 
+    Images with a side larger than max_side are detected on a copy
+    downscaled to max_side, but not further than faces of min_face_size
+    shrink to the smallest face found by MTCNN (12 pixels). Bounding boxes
+    are mapped back to the original image and faces are cropped from it.
+
     Args:
         img_size: Size in pixels of cropped face image.
         min_face_size: Size in pixels of minimal face on image.
+        max_side: Max side in pixels of image for detection, 0 to detect
+            on images of original size.
+
+    Attributes:
+        min_face_size: Size in pixels of minimal face on image.
+        max_side: Max side in pixels of image for detection.
 
     Example:
         >>> import PIL
@@ -40,9 +57,12 @@ class FaceDetector:
         >>> detector = FaceDetector()
         >>> img = PIL.Image.open('path/to/img').convert('RGB')
         >>> faces = detector.find_faces(img)
+        >>> faces_per_image = detector.find_faces_batch([img, img])
     """
-    def __init__(self, img_size: int = 160, min_face_size: int = 20) -> None:
+    def __init__(self, img_size: int = 160, min_face_size: int = 20, max_side: int = 0) -> None:
         self._img_size: int = img_size
+        self.min_face_size: int = min_face_size
+        self.max_side: int = max_side
         self._device: torch.device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
         self._mtcnn: MTCNN = MTCNN(
             image_size=self._img_size, margin=0, min_face_size=min_face_size,
@@ -59,10 +79,107 @@ class FaceDetector:
         Return:
             List of tuples image -- tensor and list of bounding box coordinates.
         """
-        bboxes, _ = self._mtcnn.detect(img, landmarks=False)
+        scale: float = self.scale(img.width, img.height)
+        with stage('detect'):
+            if scale < 1.0:
+                small: Image = img.resize((max(1, round(img.width * scale)), max(1, round(img.height * scale))),
+                                          BILINEAR)
+                bboxes: Optional[np.ndarray] = self._detect([small], self.min_face_size * scale)[0]
+                if bboxes is not None:
+                    bboxes = bboxes * np.tile([img.width / small.width, img.height / small.height], 2)
+            else:
+                bboxes: Optional[np.ndarray] = self._detect([img], self.min_face_size)[0]
         faces_and_bboxes: List[Tuple[torch.Tensor, List[int]]] = []
         if bboxes is not None:
-            for bb in bboxes:
-                face: torch.Tensor = extract_face(img, bb, image_size=self._img_size)
-                faces_and_bboxes.append((fixed_image_standardization(face), list(bb)))
+            with stage('crop'):
+                faces_and_bboxes.extend(self._extract_faces(img, bboxes))
+        return faces_and_bboxes
+
+    def scale(self, width: int, height: int) -> float:
+        """Get scale of image for detection.
+
+        Args:
+            width: Width of image.
+            height: Height of image.
+
+        Return:
+            Scale not greater than 1.
+        """
+        if self.max_side <= 0 or max(width, height) <= self.max_side:
+            return 1.0
+        return min(max(self.max_side / max(width, height), PNET_SIZE / self.min_face_size), 1.0)
+
+    def find_faces_batch(self, imgs: List[Image], size: Optional[Tuple[int, int]] = None
+                         ) -> List[List[Tuple[torch.Tensor, List[int]]]]:
+        """Find faces on batch of images by one MTCNN run.
+
+        Images are padded at the bottom and right to common size, images
+        larger than given size are downscaled to fit it first. Faces are
+        cropped from padded batch by RoIAlign and bounding boxes are
+        scaled back to coordinates of original images. If common size is
+        downscaled to max_side, faces are cropped from original images.
+
+        Args:
+            imgs: List of PIL Images.
+            size: Common width and height, by default max width and
+                max height of images.
+
+        Return:
+            List of faces for every image, every face is tuple
+            image -- tensor and list of bounding box coordinates.
+        """
+        if not imgs:
+            return []
+
+        width, height = size if size is not None else (max(img.width for img in imgs), max(img.height for img in imgs))
+        scale: float = self.scale(width, height)
+        width, height = max(1, round(width * scale)), max(1, round(height * scale))
+        batch: np.ndarray = np.zeros((len(imgs), height, width, 3), dtype=np.uint8)
+        scales: np.ndarray = np.ones(len(imgs), dtype=np.float32)
+        sizes: np.ndarray = np.empty((len(imgs), 2), dtype=np.float32)
+        for i, img in enumerate(imgs):
+            scales[i] = min(width / img.width, height / img.height, 1.0)
+            if scales[i] < 1.0:
+                img = img.resize((max(1, int(img.width * scales[i])), max(1, int(img.height * scales[i]))), BILINEAR)
+            batch[i, :img.height, :img.width] = np.asarray(img)
+            sizes[i] = img.width, img.height
+
+        with stage('detect'):
+            batch_boxes: List[Optional[np.ndarray]] = self._detect(batch, self.min_face_size * scale)
+        rois: List[np.ndarray] = [
+            np.column_stack([np.full(len(boxes), i, dtype=np.float32), boxes.astype(np.float32)])
+            for i, boxes in enumerate(batch_boxes) if boxes is not None
+        ]
+        faces_and_bboxes: List[List[Tuple[torch.Tensor, List[int]]]] = [[] for _ in imgs]
+        if not rois:
+            return faces_and_bboxes
+
+        if scale < 1.0:
+            with stage('crop'):
+                for i, (img, boxes) in enumerate(zip(imgs, batch_boxes)):
+                    if boxes is not None:
+                        faces_and_bboxes[i] = self._extract_faces(img, boxes / scales[i])
+            return faces_and_bboxes
+
+        with stage('crop'):
+            boxes: np.ndarray = np.concatenate(rois)
+            owners: np.ndarray = boxes[:, 0].astype(np.int64)
+            boxes[:, 1:] = np.trunc(np.clip(boxes[:, 1:], 0, np.tile(sizes[owners], 2)))
+            images: torch.Tensor = torch.from_numpy(batch).to(self._device).permute(0, 3, 1, 2).float()
+            faces: torch.Tensor = roi_align(images, torch.from_numpy(boxes).to(self._device),
+                                            output_size=self._img_size, aligned=True)
+            faces = fixed_image_standardization(faces).cpu()
+        bboxes: np.ndarray = boxes[:, 1:] / scales[owners, np.newaxis]
+        for face, bb, owner in zip(faces, bboxes, owners):
+            faces_and_bboxes[owner].append((face, bb.tolist()))
         return faces_and_bboxes
+
+    def _detect(self, imgs: Union[List[Image], np.ndarray], min_face_size: float) -> List[Optional[np.ndarray]]:
+        with torch.no_grad():
+            batch_boxes, _ = detect_face(imgs, min_face_size, self._mtcnn.pnet, self._mtcnn.rnet,
+                                         self._mtcnn.onet, self._mtcnn.thresholds, self._mtcnn.factor, self._device)
+        return [np.array(boxes)[:, :4] if len(boxes) > 0 else None for boxes in batch_boxes]
+
+    def _extract_faces(self, img: Image, bboxes: np.ndarray) -> List[Tuple[torch.Tensor, List[int]]]:
+        return [(fixed_image_standardization(extract_face(img, bb, image_size=self._img_size)), list(bb))
+                for bb in bboxes]
@@ -14,28 +14,73 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-"""This module contains class FeatureExtractor.
+"""This module contains class FeatureExtractor and function optimize_model.
 
-InceptionResnetV1 uses for feature extraction.
+InceptionResnetV1 uses for feature extraction. Model may run in eager
+float32 mode, as frozen TorchScript graph or as frozen TorchScript graph
+with static int8 quantization (CPU only). Optimized modes change
+features slightly, use validate_extractor.py to measure the drift.
 """
 
 from facenet_pytorch import InceptionResnetV1
+from torch.ao.quantization import get_default_qconfig
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+from typing import Optional
+import inspect
 import torch
+import os
+
+MODES = ('fp32', 'script', 'int8')
 
 
 class FeatureExtractor:
     """Class for feature extraction.
 
+    Args:
+        mode: Inference mode, 'fp32' (eager), 'script' (frozen TorchScript)
+            or 'int8' (frozen TorchScript with static int8 quantization).
+        model_path: Path to TorchScript model saved by validate_extractor.py,
+            mode only selects whether model is optimized for inference
+            ('script') if set.
+        calibration: Tensor of face images with shape (N, 3, 160, 160) to
+            calibrate int8 quantization.
+        cache_dir: Directory of serialized TorchScript models. Model of
+            'script' or 'int8' mode is loaded from it if saved before,
+            otherwise it is optimized and saved there.
+
     Example:
         >>> import torch
         >>> from FRMS.utils.feature_extractor import FeatureExtractor
         >>> img = torch.rand((3, 160, 160))
         >>> feature_extractor = FeatureExtractor()
         >>> features = feature_extractor.extract_features(img)
+        >>> batch_features = feature_extractor.extract_features_batch(torch.stack([img, img]))
     """
-    def __init__(self):
+    def __init__(self, mode: str = 'fp32', model_path: str = '', calibration: Optional[torch.Tensor] = None,
+                 cache_dir: str = '') -> None:
         self._device: torch.device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
-        self._resnet: InceptionResnetV1 = InceptionResnetV1(pretrained='vggface2').eval().to(self._device)
+        cached_path: str = ''
+        if not model_path and cache_dir and mode != 'fp32':
+            cached_path = os.path.join(cache_dir, 'resnet-%s-%s.pt' % (mode, self._device.type))
+        if model_path or os.path.exists(cached_path):
+            self._resnet: torch.nn.Module = torch.jit.load(model_path or cached_path, map_location=self._device)
+        else:
+            self._resnet: torch.nn.Module = optimize_model(
+                InceptionResnetV1(pretrained='vggface2').eval().to(self._device), mode, calibration
+            )
+            if cached_path:
+                os.makedirs(cache_dir, exist_ok=True)
+                tmp_path: str = '%s.%d.tmp' % (cached_path, os.getpid())
+                torch.jit.save(self._resnet, tmp_path)
+                os.replace(tmp_path, cached_path)
+        if mode == 'script':
+            with torch.inference_mode():
+                self._resnet = torch.jit.optimize_for_inference(self._resnet)
+
+    @property
+    def model(self) -> torch.nn.Module:
+        """Model used for feature extraction."""
+        return self._resnet
 
     def extract_features(self, face: torch.Tensor) -> torch.Tensor:
         """Extract features from given face image tensor.
@@ -46,6 +91,62 @@ class FeatureExtractor:
         Return:
             Tensor of features.
         """
-        face: torch.Tensor = face.to(self._device)
-        features: torch.Tensor = self._resnet(face.unsqueeze(0)).detach().cpu()
-        return features[0]
+        return self.extract_features_batch(face.unsqueeze(0))[0]
+
+    def extract_features_batch(self, faces: torch.Tensor) -> torch.Tensor:
+        """Extract features from stacked batch of face image tensors.
+
+        Args:
+            faces: Tensor of face images with shape (N, 3, H, W).
+
+        Return:
+            Tensor of features with shape (N, 512).
+        """
+        faces: torch.Tensor = faces.to(self._device)
+        with torch.inference_mode():
+            features: torch.Tensor = self._resnet(faces).cpu()
+        return features
+
+
+def optimize_model(model: torch.nn.Module, mode: str, calibration: Optional[torch.Tensor] = None,
+                   batch_size: int = 32) -> torch.nn.Module:
+    """Optimize model for inference.
+
+    Returned TorchScript model is frozen and may be saved. Frozen model of
+    'script' mode runs faster after torch.jit.optimize_for_inference, which
+    modifies model in place and makes it unserializable.
+
+    Args:
+        model: InceptionResnetV1 in eval mode.
+        mode: Inference mode, 'fp32', 'script' or 'int8'.
+        calibration: Tensor of face images to calibrate int8 quantization.
+        batch_size: Number of calibration images in batch.
+
+    Return:
+        Model in given mode.
+    """
+    if mode not in MODES:
+        raise ValueError('Unknown inference mode %r, expected one of %s.' % (mode, ', '.join(MODES)))
+    if mode == 'fp32':
+        return model
+
+    device: torch.device = next(model.parameters()).device
+    example: torch.Tensor = torch.zeros((1, 3, 160, 160), device=device)
+    if mode == 'int8':
+        if device.type != 'cpu':
+            raise ValueError('int8 inference mode is supported only on CPU.')
+        if calibration is None or calibration.shape[0] == 0:
+            raise ValueError('int8 inference mode requires calibration faces.')
+        engine: str = 'fbgemm' if 'fbgemm' in torch.backends.quantized.supported_engines else 'qnnpack'
+        torch.backends.quantized.engine = engine
+        kwargs: dict = {}
+        if 'example_inputs' in inspect.signature(prepare_fx).parameters:
+            kwargs['example_inputs'] = (example,)
+        model = prepare_fx(model, {'': get_default_qconfig(engine)}, **kwargs)
+        with torch.inference_mode():
+            for i in range(0, calibration.shape[0], batch_size):
+                model(calibration[i:i + batch_size])
+        model = convert_fx(model)
+
+    with torch.inference_mode():
+        return torch.jit.freeze(torch.jit.trace(model, example))
@@ -14,17 +14,46 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-"""This module contains class FeatureMatcher and function distance.
+"""This module contains class FeatureMatcher and functions verify_features and distance.
 
 Features matches by calculating distance between given features tensor
-and features tensors from database.
+and features matrix of in-memory gallery loaded from database. Features
+are verified against faces of one person read from database.
 """
 
-from FRMS.database import get_connection, Face
-from sqlalchemy.orm import Query
-from sqlalchemy.exc import InvalidRequestError
-from typing import Dict, Union, List, Optional
+from FRMS.database import get_connection, get_person_features
+from FRMS.utils.gallery import Gallery, GalleryUpdate
+from FRMS.utils.index import Index, FlatIndex, squared_distances, top_k
+from FRMS.utils.snapshot import load_snapshot, snapshot_signature
+from FRMS.metrics import stage
+from sqlalchemy.exc import InvalidRequestError, SQLAlchemyError
+from sqlalchemy.orm import Session
+from sqlalchemy.engine import Engine
+from typing import Dict, NamedTuple, Union, List, Optional, Tuple
+import numpy as np
+import threading
+import copy
+import logging
 import torch
+import time
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+
+class MatcherState(NamedTuple):
+    """Gallery searched by matcher with its index and version.
+
+    State is never changed after it is published by matcher, gallery
+    update publishes new state, so searches need no lock.
+
+    Attributes:
+        gallery: In-memory gallery of faces.
+        index: Nearest neighbour index over gallery.
+        version: Gallery version.
+    """
+    gallery: Gallery
+    index: Index
+    version: int
 
 
 class FeatureMatcher:
@@ -32,11 +61,27 @@ class FeatureMatcher:
 
     Args:
         max_distance: Max distance between features.
+        index: Nearest neighbour index over gallery,
+            exact FlatIndex by default.
+        sync_interval: Interval in seconds between background
+            gallery updates, 0 disables background updates.
+        compact_ratio: Share of removed rows in gallery after
+            which gallery is compacted and index is rebuilt.
+        snapshot_path: Path to gallery snapshot. If set, gallery is
+            memory-mapped from snapshot instead of loading from database
+            and is reloaded when snapshot is replaced.
+        snapshot_top_up: Load gallery from snapshot once and update it
+            from database with newer rows, instead of following snapshot.
+            Gallery is loaded from database if snapshot is missing or invalid.
+        shard: Index of the shard and number of shards to match only faces
+            of one shard of database, all faces by default.
 
     Attributes:
         max_distance: Max distance between features,
             if distance higher the this value, face is
             unrecognized.
+        state: Current gallery, index and version searched by matcher.
+        shard: Index of the shard and number of shards.
 
     Example:
         >>> import torch
@@ -44,47 +89,260 @@ class FeatureMatcher:
         >>> features = torch.rand(512)
         >>> feature_matcher = FeatureMatcher(max_distance=1.0)
         >>> result = feature_matcher.match_features(features)
+        >>> results = feature_matcher.match_features_batch(torch.rand((4, 512)))
+        >>> results = feature_matcher.verify_features_batch(torch.rand((1, 512)), person_id=1)
     """
-    def __init__(self, max_distance: float = 0.03):
+    def __init__(self, max_distance: float = 0.03, index: Optional[Index] = None,
+                 sync_interval: float = 0.0, compact_ratio: float = 0.25, snapshot_path: str = '',
+                 snapshot_top_up: bool = False, shard: Optional[Tuple[int, int]] = None):
+        if shard is not None and snapshot_path:
+            raise ValueError('Gallery snapshot has faces of all shards, set either shard or snapshot path.')
         self.max_distance: float = max_distance
-        self._session, _ = get_connection()
+        self.shard: Optional[Tuple[int, int]] = shard
+        self.compact_ratio: float = compact_ratio
+        self.snapshot_path: str = snapshot_path
+        self.snapshot_top_up: bool = snapshot_top_up
+        self._snapshot_signature: Optional[Tuple[int, int, int]] = None
+        self._session, self._engine = get_connection()
+        self._lock: threading.Lock = threading.Lock()
+        self.state: MatcherState = MatcherState(Gallery(shard=shard), index if index is not None else FlatIndex(), 0)
+        self.load_gallery()
+        if sync_interval > 0:
+            threading.Thread(target=self._sync_forever, args=(sync_interval,), daemon=True).start()
 
-    def match_features(self, features: torch.Tensor) -> Dict[str, Union[List[int], int, str]]:
-        """Match given features tensor with features tensor from database.
+    def load_gallery(self) -> None:
+        """Load gallery from snapshot or database.
 
-        Args:
-            features: Tensor of features.
+        Index for new gallery is built aside and replaces old one
+        after build, so matching is not blocked while loading.
 
         Return:
-            Dict of person info.
+            None
         """
-        min_dist: float = 1000000.0
-        idx: int = -1
+        with self._lock:
+            self._load_gallery()
+
+    @property
+    def gallery(self) -> Gallery:
+        """In-memory gallery of faces from database or snapshot."""
+        return self.state.gallery
+
+    @property
+    def index(self) -> Index:
+        """Nearest neighbour index over gallery."""
+        return self.state.index
+
+    @property
+    def version(self) -> int:
+        """Gallery version, incremented on every gallery change."""
+        return self.state.version
+
+    @property
+    def size(self) -> int:
+        """Number of faces in gallery."""
+        state: MatcherState = self.state
+        return len(state.gallery) - state.gallery.removed
+
+    def sync_gallery(self) -> None:
+        """Update gallery with faces added and deleted since last update.
+
+        Only new faces and tombstones are read from database. If gallery
+        follows snapshot, it is reloaded only when snapshot is replaced.
+        Update is applied to copies of gallery and index, gallery with
+        too many removed rows is compacted and its index is rebuilt.
+        Matching continues on the current state until copies replace it.
 
+        Return:
+            None
+        """
+        with self._lock:
+            if self.snapshot_path and not self.snapshot_top_up:
+                if snapshot_signature(self.snapshot_path) != self._snapshot_signature:
+                    self._load_gallery()
+                return
+
+            state: MatcherState = self.state
+            self._begin()
+            update: GalleryUpdate = state.gallery.fetch_update(self._session)
+            self._session.close()
+
+            if len(update.face_ids) == 0 and update.last_tombstone_id == state.gallery.last_tombstone_id:
+                return
+
+            gallery: Gallery = copy.copy(state.gallery)
+            gallery.update(update)
+            index: Index = copy.copy(state.index)
+            if gallery.removed > self.compact_ratio * len(gallery):
+                gallery.compact()
+                index.build(gallery)
+            else:
+                index.add(gallery, len(state.gallery))
+            self.state = MatcherState(gallery, index, state.version + 1)
+
+    def _load_gallery(self) -> None:
+        if self.snapshot_top_up:
+            gallery: Gallery = self._top_up_snapshot()
+        elif self.snapshot_path:
+            self._snapshot_signature = snapshot_signature(self.snapshot_path)
+            gallery: Gallery = load_snapshot(self.snapshot_path)
+        else:
+            gallery: Gallery = Gallery(self.gallery.dim, self.shard)
+            self._begin()
+            gallery.load(self._session)
+            self._session.close()
+
+        index: Index = copy.copy(self.index)
+        index.build(gallery)
+        self.state = MatcherState(gallery, index, self.version + 1)
+
+    def _top_up_snapshot(self) -> Gallery:
+        gallery: Gallery = Gallery(self.gallery.dim)
+        self._begin()
+        try:
+            gallery = load_snapshot(self.snapshot_path)
+        except (OSError, ValueError) as e:
+            logger.warning('Gallery snapshot is not loaded (%s), loading gallery from database.', e)
+            gallery.load(self._session)
+        else:
+            gallery.update(gallery.fetch_update(self._session))
+        finally:
+            self._session.close()
+        return gallery
+
+    def _begin(self) -> None:
         try:
             self._session.begin()
         except InvalidRequestError:
             self._session.close()
 
-        query: Query = self._session.query(Face)
-        
-        for t in query:
-            dist: float = distance(features, t.tensor)
-            if dist < min_dist:
-                min_dist = dist
-                idx: int = t.person_id
+    def _sync_forever(self, interval: float) -> None:
+        while True:
+            time.sleep(interval)
+            try:
+                self.sync_gallery()
+            except (SQLAlchemyError, OSError, ValueError):
+                logger.exception('Gallery update failed')
+
+    def match_features(self, features: torch.Tensor) -> Dict[str, Union[List[int], int, str]]:
+        """Match given features tensor with features matrix of gallery.
 
-        self._session.close()
+        Args:
+            features: Tensor of features.
 
-        if min_dist <= self.max_distance:
-            id_: int = idx
-        else:
-            id_: int = None
-        
-        data: Dict[str, Union[List[int], Optional[int]]] = {'bbox': [],
-                                                            'id': id_}
+        Return:
+            Dict of person info.
+        """
+        return self.match_features_batch(features.unsqueeze(0))[0]
+
+    def match_features_batch(self, features: torch.Tensor, k: int = 0) -> List[Dict[str, Union[List[int], int, str]]]:
+        """Match given batch of features with features matrix of gallery.
+
+        All queries are searched in index at once. If k is set, every dict
+        also has candidates: up to k nearest distinct persons with distances
+        ranked by distance, regardless of max_distance. Candidates are
+        selected from 4 * k nearest faces, search is widened for queries
+        with less than k distinct persons until gallery is exhausted.
+
+        Args:
+            features: Tensor of features with shape (N, 512).
+            k: Number of candidates, 0 to return only the nearest person.
+
+        Return:
+            List of dicts of person info, one dict per features vector.
+        """
+        data: List[Dict[str, Union[List, Optional[int]]]] = [{'bbox': [], 'id': None} for _ in range(features.shape[0])]
+        if k > 0:
+            for answer in data:
+                answer['candidates'] = []
+
+        state: MatcherState = self.state
+        if len(state.gallery) > 0 and features.shape[0] > 0:
+            queries: np.ndarray = features.detach().cpu().numpy().astype(np.float32)
+            with stage('match'):
+                distances, rows = self._search_persons(state, queries, k)
+                person_ids: np.ndarray = state.gallery.person_ids[np.maximum(rows, 0)]
+            for answer, found, dists, persons in zip(data, rows >= 0, distances, person_ids):
+                if found[0] and dists[0] <= self.max_distance:
+                    answer['id'] = int(persons[0])
+                if k > 0:
+                    nearest: Dict[int, float] = {}
+                    for person_id, dist in zip(persons[found].tolist(), dists[found].tolist()):
+                        nearest.setdefault(person_id, dist)
+                    answer['candidates'] = [{'id': person_id, 'distance': dist}
+                                            for person_id, dist in list(nearest.items())[:k]]
         return data
 
+    def _search_persons(self, state: MatcherState, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        n_faces: int = max(1, 4 * k)
+        distances, rows = state.index.search(queries, n_faces)
+        while k > 1 and n_faces < len(state.gallery):
+            person_ids: np.ndarray = state.gallery.person_ids[np.maximum(rows, 0)]
+            short: List[int] = [i for i, (found, persons) in enumerate(zip(rows >= 0, person_ids))
+                                if found[-1] and len(np.unique(persons[found])) < k]
+            if not short:
+                break
+            n_faces = min(2 * n_faces, len(state.gallery))
+            wider_distances, wider_rows = state.index.search(queries[short], n_faces)
+            distances = np.pad(distances, ((0, 0), (0, n_faces - distances.shape[1])), constant_values=np.inf)
+            rows = np.pad(rows, ((0, 0), (0, n_faces - rows.shape[1])), constant_values=-1)
+            distances[short] = wider_distances
+            rows[short] = wider_rows
+        return distances, rows
+
+    def verify_features_batch(self, features: torch.Tensor, person_id: int
+                              ) -> List[Dict[str, Union[List[int], float, bool, None]]]:
+        """Verify that given batch of features belongs to the person.
+
+        Features are compared only with faces of the person read from
+        database by indexed person ID, so time of verification does not
+        depend on gallery size and faces added after the last gallery
+        update are verified too.
+
+        Args:
+            features: Tensor of features with shape (N, 512).
+            person_id: ID of the claimed person.
+
+        Return:
+            List of dicts with distance to the nearest face of the person
+            (None if the person has no faces) and decision, one dict per features vector.
+        """
+        return verify_features(self._engine, features, person_id, self.max_distance)
+
+
+def verify_features(engine: Engine, features: torch.Tensor, person_id: int, max_distance: float
+                    ) -> List[Dict[str, Union[List[int], float, bool, None]]]:
+    """Verify that given batch of features belongs to the person.
+
+    Every verification uses its own session, so it is safe to call from many threads.
+
+    Args:
+        engine: Database engine.
+        features: Tensor of features with shape (N, 512).
+        person_id: ID of the claimed person.
+        max_distance: Max distance between features of the same person.
+
+    Return:
+        List of dicts with distance to the nearest face of the person
+        (None if the person has no faces) and decision, one dict per features vector.
+    """
+    data: List[Dict[str, Union[List[int], float, bool, None]]] = [
+        {'bbox': [], 'distance': None, 'verified': False} for _ in range(features.shape[0])
+    ]
+    if features.shape[0] == 0:
+        return data
+
+    with stage('verify'):
+        with Session(engine) as session:
+            vectors: np.ndarray = get_person_features(session, person_id)
+        if len(vectors) == 0:
+            return data
+        queries: np.ndarray = features.detach().cpu().numpy().astype(np.float32)
+        distances, _ = top_k(squared_distances(queries, vectors, np.einsum('ij,ij->i', vectors, vectors)), 1)
+    for answer, dist in zip(data, distances[:, 0].tolist()):
+        answer['distance'] = dist
+        answer['verified'] = dist <= max_distance
+    return data
+
 
 def distance(features1: torch.Tensor, features2: torch.Tensor) -> float:
     """Calculate distance between given features tensors.
@@ -0,0 +1,268 @@
+# FRMS/utils/gallery.py
+#
+# Copyright (C) 2021-2022  Дмитрий Кузнецов
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""This module contains classes Gallery and GalleryUpdate.
+
+Gallery keeps features of all faces from database in memory
+as one contiguous float32 matrix. Gallery is kept up to date
+incrementally: new faces are found by high-water mark on face ID
+and deleted faces are found by tombstones.
+"""
+
+from FRMS.database import Face, DeletedFace, decode_features, count_faces, read_faces, in_shard
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+from typing import Callable, List, NamedTuple, Optional, Tuple
+import numpy as np
+
+
+class GalleryUpdate(NamedTuple):
+    """Changes of database since last gallery update.
+
+    Attributes:
+        face_ids: IDs of new faces.
+        person_ids: IDs of the persons of new faces.
+        features: Features of new faces.
+        deleted_face_ids: IDs of deleted faces.
+        last_tombstone_id: ID of the last read tombstone.
+    """
+    face_ids: np.ndarray
+    person_ids: np.ndarray
+    features: np.ndarray
+    deleted_face_ids: np.ndarray
+    last_tombstone_id: int
+
+
+class Gallery:
+    """In-memory gallery of face features.
+
+    Rows are sorted by face ID. Removed rows stay in matrix until
+    compaction but have infinite squared norm, so they are infinitely
+    far from any query.
+
+    Args:
+        dim: Size of features vector.
+        shard: Index of the shard and number of shards to load faces
+            of one shard, all faces by default.
+
+    Attributes:
+        dim: Size of features vector.
+        shard: Index of the shard and number of shards.
+        last_face_id: Max ID of face loaded from database.
+        last_tombstone_id: Max ID of tombstone loaded from database.
+        removed: Number of removed rows waiting for compaction.
+
+    Example:
+        >>> from FRMS.database import get_connection
+        >>> from FRMS.utils.gallery import Gallery
+        >>> session, _ = get_connection()
+        >>> gallery = Gallery()
+        >>> gallery.load(session)
+        >>> gallery.update(gallery.fetch_update(session))
+    """
+    def __init__(self, dim: int = 512, shard: Optional[Tuple[int, int]] = None) -> None:
+        self.dim: int = dim
+        self.shard: Optional[Tuple[int, int]] = shard
+        self.last_face_id: int = 0
+        self.last_tombstone_id: int = 0
+        self.removed: int = 0
+        self._size: int = 0
+        self._face_ids: np.ndarray = np.empty(0, dtype=np.int64)
+        self._person_ids: np.ndarray = np.empty(0, dtype=np.int64)
+        self._features: np.ndarray = np.empty((0, dim), dtype=np.float32)
+        self._sq_norms: np.ndarray = np.empty(0, dtype=np.float32)
+
+    def __len__(self) -> int:
+        """Get gallery size.
+
+        Return:
+            Number of rows in gallery, including removed rows.
+        """
+        return self._size
+
+    @property
+    def face_ids(self) -> np.ndarray:
+        """IDs of the faces with shape (N,)."""
+        return self._face_ids[:self._size]
+
+    @property
+    def person_ids(self) -> np.ndarray:
+        """IDs of the persons with shape (N,)."""
+        return self._person_ids[:self._size]
+
+    @property
+    def features(self) -> np.ndarray:
+        """Matrix of features with shape (N, dim)."""
+        return self._features[:self._size]
+
+    @property
+    def sq_norms(self) -> np.ndarray:
+        """Squared L2 norms of features with shape (N,), infinite for removed rows."""
+        return self._sq_norms[:self._size]
+
+    def load(self, session: Session, chunk_size: int = 10000,
+             progress: Optional[Callable[[int, int], None]] = None) -> None:
+        """Load all faces from database.
+
+        Faces are counted first and streamed by chunks into arrays of
+        final size, so peak memory is close to size of gallery.
+
+        Args:
+            session: Database session.
+            chunk_size: Number of rows fetched and decoded at once.
+            progress: Function called after every chunk with number of loaded faces and total number of faces.
+
+        Return:
+            None
+        """
+        last_tombstone_id: int = session.query(func.coalesce(func.max(DeletedFace.id), 0)).scalar()
+        count, last_id = count_faces(session, shard=self.shard)
+        self.__init__(self.dim, self.shard)
+        self._reserve(count)
+        self._size = read_faces(session, self._face_ids, self._person_ids, self._features,
+                                last_id=last_id, chunk_size=chunk_size, progress=progress, shard=self.shard)
+        self._sq_norms[:self._size] = np.einsum('ij,ij->i', self.features, self.features)
+        self.last_face_id = int(self.face_ids[-1]) if self._size > 0 else 0
+        self.last_tombstone_id = last_tombstone_id
+
+    def fetch_update(self, session: Session) -> GalleryUpdate:
+        """Fetch faces added and deleted since last load or update.
+
+        Tombstones are read before faces, so face deleted between
+        the two queries is removed by the next update.
+
+        Args:
+            session: Database session.
+
+        Return:
+            Changes of database.
+        """
+        tombstones: List[Tuple[int, int]] = session.query(DeletedFace.id, DeletedFace.face_id) \
+            .filter(DeletedFace.id > self.last_tombstone_id).order_by(DeletedFace.id).all()
+        query = session.query(Face.id, Face.person_id, Face.features).filter(Face.id > self.last_face_id)
+        if self.shard is not None:
+            query = query.filter(in_shard(self.shard))
+        rows: List[Tuple[int, int, bytes]] = query.order_by(Face.id).all()
+        face_ids, person_ids, features = self._decode(rows)
+        return GalleryUpdate(
+            face_ids=face_ids, person_ids=person_ids, features=features,
+            deleted_face_ids=np.array([face_id for _, face_id in tombstones], dtype=np.int64),
+            last_tombstone_id=tombstones[-1][0] if tombstones else self.last_tombstone_id
+        )
+
+    def update(self, update: GalleryUpdate) -> None:
+        """Apply changes of database to gallery.
+
+        Args:
+            update: Changes of database.
+
+        Return:
+            None
+        """
+        self.append(update.face_ids, update.person_ids, update.features)
+        self.remove(update.deleted_face_ids)
+        self.last_tombstone_id = update.last_tombstone_id
+
+    def append(self, face_ids: np.ndarray, person_ids: np.ndarray, features: np.ndarray) -> None:
+        """Append faces to the end of gallery.
+
+        Face IDs must be greater than IDs of faces in gallery. Rows are
+        written after the last row, so shallow copy of gallery made
+        before append does not see them.
+
+        Args:
+            face_ids: IDs of the faces with shape (M,).
+            person_ids: IDs of the persons with shape (M,).
+            features: Matrix of features with shape (M, dim).
+
+        Return:
+            None
+        """
+        count: int = len(face_ids)
+        if count == 0:
+            return
+        if self._size + count > len(self._face_ids):
+            self._reserve(max(self._size + count, 2 * len(self._face_ids)))
+
+        end: int = self._size + count
+        self._face_ids[self._size:end] = face_ids
+        self._person_ids[self._size:end] = person_ids
+        self._features[self._size:end] = features
+        self._sq_norms[self._size:end] = np.einsum('ij,ij->i', self._features[self._size:end],
+                                                   self._features[self._size:end])
+        self._size = end
+        self.last_face_id = int(face_ids[-1])
+
+    def remove(self, face_ids: np.ndarray) -> int:
+        """Mark faces as removed.
+
+        Rows are marked in a copy of squared norms, so shallow copy
+        of gallery made before removal is not changed.
+
+        Args:
+            face_ids: IDs of the faces.
+
+        Return:
+            Number of removed rows.
+        """
+        if len(face_ids) == 0 or self._size == 0:
+            return 0
+        rows: np.ndarray = np.unique(np.searchsorted(self.face_ids, face_ids))
+        rows = rows[rows < self._size]
+        rows = rows[np.isin(self.face_ids[rows], face_ids) & np.isfinite(self.sq_norms[rows])]
+        if len(rows) > 0:
+            self._sq_norms = np.array(self._sq_norms)
+            self._sq_norms[rows] = np.inf
+        self.removed += len(rows)
+        return len(rows)
+
+    def compact(self) -> None:
+        """Drop removed rows from gallery.
+
+        Kept rows are copied to new arrays, so shallow copy of gallery
+        can be compacted while the original gallery is searched.
+
+        Return:
+            None
+        """
+        keep: np.ndarray = np.isfinite(self.sq_norms)
+        self._face_ids = self.face_ids[keep]
+        self._person_ids = self.person_ids[keep]
+        self._features = self.features[keep]
+        self._sq_norms = self.sq_norms[keep]
+        self._size = len(self._face_ids)
+        self.removed = 0
+
+    def _reserve(self, capacity: int) -> None:
+        face_ids: np.ndarray = np.empty(capacity, dtype=np.int64)
+        person_ids: np.ndarray = np.empty(capacity, dtype=np.int64)
+        features: np.ndarray = np.empty((capacity, self.dim), dtype=np.float32)
+        sq_norms: np.ndarray = np.empty(capacity, dtype=np.float32)
+        face_ids[:self._size] = self.face_ids
+        person_ids[:self._size] = self.person_ids
+        features[:self._size] = self.features
+        sq_norms[:self._size] = self.sq_norms
+        self._face_ids, self._person_ids, self._features, self._sq_norms = face_ids, person_ids, features, sq_norms
+
+    def _decode(self, rows: List[Tuple[int, int, bytes]]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        face_ids: np.ndarray = np.empty(len(rows), dtype=np.int64)
+        person_ids: np.ndarray = np.empty(len(rows), dtype=np.int64)
+        features: np.ndarray = np.empty((len(rows), self.dim), dtype=np.float32)
+        for i, (face_id, person_id, data) in enumerate(rows):
+            face_ids[i] = face_id
+            person_ids[i] = person_id
+            features[i] = decode_features(data)
+        return face_ids, person_ids, features
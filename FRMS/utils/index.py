@@ -0,0 +1,435 @@
+# FRMS/utils/index.py
+#
+# Copyright (C) 2021-2022  Дмитрий Кузнецов
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""This module contains nearest neighbour indexes over gallery.
+
+FlatIndex makes exact search by brute force. IVFIndex makes approximate
+search: gallery is split into clusters by k-means and only the nprobe
+clusters nearest to the query are scanned. TemplateIndex searches
+per-person templates and re-ranks faces of the nearest persons.
+
+Shallow copy of index does not share mutable state with the original,
+so the copy can be updated while the original is searched.
+"""
+
+from FRMS.utils.gallery import Gallery
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+import copy
+
+
+class Index(ABC):
+    """Base class for nearest neighbour indexes.
+
+    Example:
+        >>> from FRMS.utils.index import create_index
+        >>> index = create_index('ivf', nlist=1024, nprobe=16)
+        >>> index.build(gallery)
+        >>> distances, rows = index.search(queries, k=5)
+    """
+    def __init__(self) -> None:
+        self._gallery: Gallery = Gallery()
+
+    def build(self, gallery: Gallery) -> None:
+        """Build index over given gallery.
+
+        Args:
+            gallery: Gallery of faces.
+
+        Return:
+            None
+        """
+        self._gallery = gallery
+
+    def add(self, gallery: Gallery, start: int) -> None:
+        """Add rows appended to gallery to index.
+
+        Args:
+            gallery: Indexed gallery or its updated copy, replaces indexed gallery.
+            start: First appended row.
+
+        Return:
+            None
+        """
+        self._gallery = gallery
+
+    @abstractmethod
+    def search(self, queries: np.ndarray, k: int = 1) -> Tuple[np.ndarray, np.ndarray]:
+        """Search k nearest gallery rows for every query.
+
+        Args:
+            queries: Matrix of features with shape (N, dim).
+            k: Number of neighbours.
+
+        Return:
+            Distances and gallery rows, both with shape (N, k), sorted by
+            distance. Missing neighbours have infinite distance and row -1.
+        """
+
+
+class FlatIndex(Index):
+    """Exact index, compares query with every row of gallery."""
+    def search(self, queries: np.ndarray, k: int = 1) -> Tuple[np.ndarray, np.ndarray]:
+        sq_dists: np.ndarray = squared_distances(queries, self._gallery.features, self._gallery.sq_norms)
+        return top_k(sq_dists, k)
+
+
+class IVFIndex(Index):
+    """Approximate inverted file index with k-means coarse quantizer.
+
+    Args:
+        nlist: Number of clusters, by default 4 * sqrt(gallery size).
+        nprobe: Number of clusters scanned for every query. Higher value
+            gives higher recall and higher latency.
+        train_size: Max number of gallery rows used for k-means training.
+        iterations: Number of k-means iterations.
+        seed: Random seed of k-means initialization.
+    """
+    def __init__(self, nlist: Optional[int] = None, nprobe: int = 8, train_size: int = 65536,
+                 iterations: int = 10, seed: int = 0) -> None:
+        super(IVFIndex, self).__init__()
+        self.nlist: Optional[int] = nlist
+        self.nprobe: int = nprobe
+        self.train_size: int = train_size
+        self.iterations: int = iterations
+        self.seed: int = seed
+        self._centroids: np.ndarray = np.empty((0, self._gallery.dim), dtype=np.float32)
+        self._centroids_sq_norms: np.ndarray = np.empty(0, dtype=np.float32)
+        self._lists: List[np.ndarray] = []
+
+    def build(self, gallery: Gallery) -> None:
+        super(IVFIndex, self).build(gallery)
+        size: int = len(gallery)
+        if size == 0:
+            self._centroids = np.empty((0, gallery.dim), dtype=np.float32)
+            self._centroids_sq_norms = np.empty(0, dtype=np.float32)
+            self._lists = []
+            return
+
+        nlist: int = self.nlist if self.nlist is not None else int(4 * np.sqrt(size))
+        nlist = min(max(nlist, 1), size)
+        rng: np.random.Generator = np.random.default_rng(self.seed)
+        if size > self.train_size:
+            sample: np.ndarray = gallery.features[np.sort(rng.choice(size, self.train_size, replace=False))]
+        else:
+            sample: np.ndarray = gallery.features
+        self._centroids = kmeans(sample, nlist, self.iterations, rng)
+        self._centroids_sq_norms = np.einsum('ij,ij->i', self._centroids, self._centroids)
+
+        assignment: np.ndarray = nearest_centroids(gallery.features, self._centroids, self._centroids_sq_norms)
+        order: np.ndarray = np.argsort(assignment, kind='stable')
+        bounds: np.ndarray = np.cumsum(np.bincount(assignment, minlength=nlist))
+        self._lists = np.split(order, bounds[:-1])
+
+    def search(self, queries: np.ndarray, k: int = 1) -> Tuple[np.ndarray, np.ndarray]:
+        distances: np.ndarray = np.full((queries.shape[0], k), np.inf, dtype=np.float32)
+        rows: np.ndarray = np.full((queries.shape[0], k), -1, dtype=np.int64)
+        if len(self._lists) == 0:
+            return distances, rows
+
+        nprobe: int = min(self.nprobe, len(self._lists))
+        coarse: np.ndarray = squared_distances(queries, self._centroids, self._centroids_sq_norms)
+        probes: np.ndarray = np.argpartition(coarse, nprobe - 1, axis=1)[:, :nprobe]
+        for i, query in enumerate(queries):
+            candidates: np.ndarray = np.concatenate([self._lists[probe] for probe in probes[i]])
+            if len(candidates) == 0:
+                continue
+            sq_dists: np.ndarray = squared_distances(query[np.newaxis, :], self._gallery.features[candidates],
+                                                     self._gallery.sq_norms[candidates])
+            found_distances, found_positions = top_k(sq_dists, k)
+            found: np.ndarray = found_positions[0] >= 0
+            distances[i, :found.sum()] = found_distances[0, found]
+            rows[i, :found.sum()] = candidates[found_positions[0, found]]
+        return distances, rows
+
+    def add(self, gallery: Gallery, start: int) -> None:
+        super(IVFIndex, self).add(gallery, start)
+        if len(self._lists) == 0:
+            self.build(gallery)
+            return
+
+        assignment: np.ndarray = nearest_centroids(self._gallery.features[start:], self._centroids,
+                                                   self._centroids_sq_norms)
+        for centroid in np.unique(assignment):
+            rows: np.ndarray = start + np.flatnonzero(assignment == centroid)
+            self._lists[centroid] = np.concatenate([self._lists[centroid], rows])
+
+    def __copy__(self) -> 'IVFIndex':
+        index: IVFIndex = IVFIndex.__new__(IVFIndex)
+        index.__dict__.update(self.__dict__)
+        index._lists = list(self._lists)
+        return index
+
+
+class TemplateIndex(Index):
+    """Index over per-person templates with re-ranking by raw features.
+
+    Every person is represented by up to n_templates templates: centroids
+    of k-means clusters of person's features (the mean for one template),
+    persons with not more than n_templates faces keep their raw features.
+    Base index searches templates of the rerank nearest persons, then raw
+    features of these persons are compared with query exactly. Searched
+    matrix shrinks by the mean number of faces per person divided by n_templates.
+
+    Templates are recalculated for persons of appended rows. Templates of
+    persons with removed rows are recalculated on the next build, removed
+    rows themselves are never found.
+
+    Args:
+        index: Base index over templates, FlatIndex by default.
+        n_templates: Max number of templates of every person.
+        rerank: Number of nearest persons re-ranked by raw features, not less than k.
+        iterations: Number of k-means iterations.
+        seed: Random seed of k-means initialization.
+        compact_ratio: Share of outdated templates after which templates
+            are compacted and base index is rebuilt.
+    """
+    def __init__(self, index: Optional[Index] = None, n_templates: int = 1, rerank: int = 16,
+                 iterations: int = 10, seed: int = 0, compact_ratio: float = 0.25) -> None:
+        super(TemplateIndex, self).__init__()
+        self.index: Index = index if index is not None else FlatIndex()
+        self.n_templates: int = n_templates
+        self.rerank: int = rerank
+        self.iterations: int = iterations
+        self.seed: int = seed
+        self.compact_ratio: float = compact_ratio
+        self._templates: Gallery = Gallery()
+        self._order: np.ndarray = np.empty(0, dtype=np.int64)
+        self._sorted_person_ids: np.ndarray = np.empty(0, dtype=np.int64)
+        self._appended: Dict[int, List[int]] = {}
+        self._rng: np.random.Generator = np.random.default_rng(seed)
+
+    @property
+    def templates(self) -> Gallery:
+        """Gallery of templates, face IDs are IDs of templates."""
+        return self._templates
+
+    def build(self, gallery: Gallery) -> None:
+        super(TemplateIndex, self).build(gallery)
+        self.index = copy.copy(self.index)
+        self._rng = np.random.default_rng(self.seed)
+        self._appended = {}
+        order: np.ndarray = np.argsort(gallery.person_ids, kind='stable')
+        self._order = order[np.isfinite(gallery.sq_norms[order])]
+        self._sorted_person_ids = gallery.person_ids[self._order]
+        self._templates = Gallery(gallery.dim)
+        if len(self._order) > 0:
+            person_ids, starts, counts = np.unique(self._sorted_person_ids, return_index=True, return_counts=True)
+            if self.n_templates == 1:
+                features: np.ndarray = np.add.reduceat(gallery.features[self._order], starts, axis=0)
+                features /= counts[:, np.newaxis]
+                self._templates.append(np.arange(1, len(person_ids) + 1), person_ids, features)
+            else:
+                self._append_templates(person_ids)
+        self.index.build(self._templates)
+
+    def add(self, gallery: Gallery, start: int) -> None:
+        super(TemplateIndex, self).add(gallery, start)
+        if len(self._templates) == 0:
+            self.build(gallery)
+            return
+
+        person_ids: np.ndarray = gallery.person_ids[start:]
+        for row, person_id in enumerate(person_ids.tolist(), start):
+            self._appended.setdefault(person_id, []).append(row)
+        person_ids = np.unique(person_ids)
+        old: np.ndarray = np.isin(self._templates.person_ids, person_ids) & np.isfinite(self._templates.sq_norms)
+        self._templates.remove(self._templates.face_ids[old])
+        template_start: int = len(self._templates)
+        self._append_templates(person_ids)
+        if self._templates.removed > self.compact_ratio * len(self._templates):
+            self._templates.compact()
+            self.index.build(self._templates)
+        else:
+            self.index.add(self._templates, template_start)
+
+    def __copy__(self) -> 'TemplateIndex':
+        index: TemplateIndex = TemplateIndex.__new__(TemplateIndex)
+        index.__dict__.update(self.__dict__)
+        index.index = copy.copy(self.index)
+        index._templates = copy.copy(self._templates)
+        index._appended = {person_id: list(rows) for person_id, rows in self._appended.items()}
+        return index
+
+    def search(self, queries: np.ndarray, k: int = 1) -> Tuple[np.ndarray, np.ndarray]:
+        distances: np.ndarray = np.full((queries.shape[0], k), np.inf, dtype=np.float32)
+        rows: np.ndarray = np.full((queries.shape[0], k), -1, dtype=np.int64)
+        if len(self._templates) == 0:
+            return distances, rows
+
+        n_persons: int = max(k, self.rerank)
+        _, template_rows = self.index.search(queries, n_persons * self.n_templates)
+        for i, query in enumerate(queries):
+            found_templates: np.ndarray = template_rows[i][template_rows[i] >= 0]
+            person_ids: List[int] = list(dict.fromkeys(self._templates.person_ids[found_templates].tolist()))
+            if not person_ids:
+                continue
+            candidates: np.ndarray = np.concatenate([self._rows(person_id) for person_id in person_ids[:n_persons]])
+            sq_dists: np.ndarray = squared_distances(query[np.newaxis, :], self._gallery.features[candidates],
+                                                     self._gallery.sq_norms[candidates])
+            found_distances, found_positions = top_k(sq_dists, k)
+            found: np.ndarray = found_positions[0] >= 0
+            distances[i, :found.sum()] = found_distances[0, found]
+            rows[i, :found.sum()] = candidates[found_positions[0, found]]
+        return distances, rows
+
+    def _rows(self, person_id: int) -> np.ndarray:
+        start, end = np.searchsorted(self._sorted_person_ids, [person_id, person_id + 1])
+        appended: Optional[List[int]] = self._appended.get(person_id)
+        if appended is None:
+            return self._order[start:end]
+        return np.concatenate([self._order[start:end], np.array(appended, dtype=np.int64)])
+
+    def _append_templates(self, person_ids: np.ndarray) -> None:
+        features: List[np.ndarray] = []
+        for person_id in person_ids.tolist():
+            rows: np.ndarray = self._rows(person_id)
+            vectors: np.ndarray = self._gallery.features[rows[np.isfinite(self._gallery.sq_norms[rows])]]
+            if len(vectors) <= self.n_templates:
+                features.append(vectors)
+            elif self.n_templates == 1:
+                features.append(vectors.mean(axis=0, keepdims=True))
+            else:
+                features.append(kmeans(vectors, self.n_templates, self.iterations, self._rng))
+        if not features:
+            return
+        counts: np.ndarray = np.array([len(f) for f in features])
+        first_id: int = self._templates.last_face_id + 1
+        self._templates.append(np.arange(first_id, first_id + counts.sum()), np.repeat(person_ids, counts),
+                               np.concatenate(features))
+
+
+def create_index(name: str = 'flat', nlist: Optional[int] = None, nprobe: int = 8,
+                 templates: int = 0, rerank: int = 16) -> Index:
+    """Create index by name.
+
+    Args:
+        name: Index name, 'flat' or 'ivf'.
+        nlist: Number of clusters of IVF index.
+        nprobe: Number of scanned clusters of IVF index.
+        templates: Max number of templates of every person, 0 to search raw features.
+        rerank: Number of nearest persons re-ranked by raw features in template mode.
+
+    Return:
+        Index instance.
+    """
+    if name == 'flat':
+        index: Index = FlatIndex()
+    elif name == 'ivf':
+        index: Index = IVFIndex(nlist=nlist, nprobe=nprobe)
+    else:
+        raise ValueError("Unknown index '%s', expected 'flat' or 'ivf'." % name)
+    if templates > 0:
+        return TemplateIndex(index, n_templates=templates, rerank=rerank)
+    return index
+
+
+def squared_distances(queries: np.ndarray, vectors: np.ndarray, sq_norms: np.ndarray) -> np.ndarray:
+    """Calculate squared L2 distances between queries and vectors.
+
+    Args:
+        queries: Matrix with shape (N, dim).
+        vectors: Matrix with shape (M, dim).
+        sq_norms: Squared L2 norms of vectors with shape (M,).
+
+    Return:
+        Matrix of squared distances with shape (N, M).
+    """
+    sq_dists: np.ndarray = queries @ vectors.T
+    sq_dists *= -2.0
+    sq_dists += sq_norms[np.newaxis, :]
+    sq_dists += np.einsum('ij,ij->i', queries, queries)[:, np.newaxis]
+    np.maximum(sq_dists, 0.0, out=sq_dists)
+    return sq_dists
+
+
+def top_k(sq_dists: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Select k smallest squared distances in every row.
+
+    Args:
+        sq_dists: Matrix of squared distances with shape (N, M).
+        k: Number of neighbours.
+
+    Return:
+        Distances and column indexes with shape (N, k), sorted by distance.
+        Missing neighbours (if M < k) and infinitely far neighbours
+        (removed gallery rows) have infinite distance and index -1.
+    """
+    n, m = sq_dists.shape
+    distances: np.ndarray = np.full((n, k), np.inf, dtype=np.float32)
+    indexes: np.ndarray = np.full((n, k), -1, dtype=np.int64)
+    found: int = min(k, m)
+    if found == 0:
+        return distances, indexes
+
+    if found < m:
+        part: np.ndarray = np.argpartition(sq_dists, found - 1, axis=1)[:, :found]
+    else:
+        part: np.ndarray = np.broadcast_to(np.arange(m), (n, m))
+    part_dists: np.ndarray = np.take_along_axis(sq_dists, part, axis=1)
+    order: np.ndarray = np.argsort(part_dists, axis=1)
+    distances[:, :found] = np.sqrt(np.take_along_axis(part_dists, order, axis=1))
+    indexes[:, :found] = np.take_along_axis(part, order, axis=1)
+    indexes[np.isinf(distances)] = -1
+    return distances, indexes
+
+
+def nearest_centroids(vectors: np.ndarray, centroids: np.ndarray, sq_norms: np.ndarray,
+                      chunk_size: int = 4096) -> np.ndarray:
+    """Find nearest centroid for every vector.
+
+    Vectors are processed by chunks to bound size of distances matrix.
+
+    Args:
+        vectors: Matrix with shape (N, dim).
+        centroids: Matrix with shape (M, dim).
+        sq_norms: Squared L2 norms of centroids with shape (M,).
+        chunk_size: Number of vectors in chunk.
+
+    Return:
+        Indexes of nearest centroids with shape (N,).
+    """
+    assignment: np.ndarray = np.empty(vectors.shape[0], dtype=np.int64)
+    for start in range(0, vectors.shape[0], chunk_size):
+        sq_dists: np.ndarray = squared_distances(vectors[start:start + chunk_size], centroids, sq_norms)
+        assignment[start:start + chunk_size] = np.argmin(sq_dists, axis=1)
+    return assignment
+
+
+def kmeans(vectors: np.ndarray, n_clusters: int, iterations: int, rng: np.random.Generator) -> np.ndarray:
+    """Cluster vectors by Lloyd's k-means algorithm.
+
+    Args:
+        vectors: Matrix with shape (N, dim).
+        n_clusters: Number of clusters, not greater than N.
+        iterations: Number of iterations.
+        rng: Random generator for centroids initialization.
+
+    Return:
+        Matrix of centroids with shape (n_clusters, dim).
+    """
+    centroids: np.ndarray = vectors[rng.choice(vectors.shape[0], n_clusters, replace=False)].astype(np.float32)
+    for _ in range(iterations):
+        sq_norms: np.ndarray = np.einsum('ij,ij->i', centroids, centroids)
+        assignment: np.ndarray = nearest_centroids(vectors, centroids, sq_norms)
+        order: np.ndarray = np.argsort(assignment, kind='stable')
+        counts: np.ndarray = np.bincount(assignment, minlength=n_clusters)
+        starts: np.ndarray = np.cumsum(counts) - counts
+        filled: np.ndarray = counts > 0
+        sums: np.ndarray = np.add.reduceat(vectors[order], starts[filled], axis=0)
+        centroids[filled] = sums / counts[filled, np.newaxis]
+    return centroids
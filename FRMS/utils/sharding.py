@@ -0,0 +1,436 @@
+# FRMS/utils/sharding.py
+#
+# Copyright (C) 2021-2022  Дмитрий Кузнецов
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""This module contains classes of sharded gallery search.
+
+Faces are partitioned by person ID modulo number of shards, so all faces
+of the person are in one shard. Every shard is searched by FeatureMatcher
+of shard worker: local process started by ProcessShard or FRMS instance
+started with SHARD_INDEX and SHARD_COUNT and searched over HTTP by
+HTTPShard. ShardedMatcher sends queries to all shards in parallel and
+merges nearest persons found by shards.
+
+Example:
+    >>> import torch
+    >>> from FRMS.utils.sharding import ShardedMatcher, ProcessShard, HTTPShard
+    >>> matcher = ShardedMatcher([ProcessShard(i, 4, {'max_distance': 1.0}) for i in range(4)], max_distance=1.0)
+    >>> matcher = ShardedMatcher([HTTPShard('http://shard-0:5000', 0, 2), HTTPShard('http://shard-1:5000', 1, 2)])
+    >>> results = matcher.match_features_batch(torch.rand((4, 512)), k=5)
+"""
+
+from FRMS.database import get_connection
+from FRMS.utils.feature_matcher import FeatureMatcher, verify_features
+from FRMS.metrics import stage
+from abc import ABC, abstractmethod
+from concurrent.futures import Future, ThreadPoolExecutor
+from multiprocessing.connection import Connection
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple, Union
+import multiprocessing
+import http.client
+import logging
+import urllib.parse
+import threading
+import itertools
+import base64
+import json
+import numpy as np
+import torch
+import time
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+
+class ShardUnavailable(Exception):
+    """Raised when shard process stopped or shard instance is not reachable."""
+
+
+class ShardResult(NamedTuple):
+    """Result of shard search.
+
+    Attributes:
+        candidates: Nearest persons of every query, lists of person ID and distance ranked by distance.
+        version: Gallery version of shard.
+        size: Number of faces in shard.
+    """
+    candidates: List[List[Tuple[int, float]]]
+    version: int
+    size: int
+
+
+class Shard(ABC):
+    """Base class of gallery shard.
+
+    Args:
+        index: Index of the shard.
+        count: Number of shards.
+
+    Attributes:
+        index: Index of the shard.
+        count: Number of shards.
+    """
+    def __init__(self, index: int, count: int) -> None:
+        self.index: int = index
+        self.count: int = count
+
+    @abstractmethod
+    def search(self, queries: np.ndarray, k: int) -> ShardResult:
+        """Find k nearest persons of every query in shard.
+
+        Args:
+            queries: Matrix of features with shape (N, 512).
+            k: Number of persons.
+
+        Return:
+            Result of shard search.
+        """
+
+
+class ProcessShard(Shard):
+    """Shard searched by local process.
+
+    Process is spawned on creation and loads faces of the shard from
+    database. Searches of the shard are sent to process one by one.
+    Stopped process is spawned again by the search which finds it stopped.
+
+    Args:
+        index: Index of the shard.
+        count: Number of shards.
+        kwargs: Arguments of FeatureMatcher of shard process.
+    """
+    def __init__(self, index: int, count: int, kwargs: Optional[Dict[str, Any]] = None) -> None:
+        super(ProcessShard, self).__init__(index, count)
+        self._kwargs: Dict[str, Any] = kwargs or {}
+        self._lock: threading.Lock = threading.Lock()
+        self._spawn()
+
+    def search(self, queries: np.ndarray, k: int) -> ShardResult:
+        with self._lock:
+            try:
+                self._connection.send((queries, k))
+                result: Union[ShardResult, str] = self._connection.recv()
+            except (EOFError, OSError) as e:
+                logger.error('Process of shard %d stopped (%s: %s), spawning it again.',
+                             self.index, type(e).__name__, e)
+                self._stop()
+                self._spawn()
+                raise ShardUnavailable('Process of shard %d stopped and is restarted.' % self.index) from e
+        if isinstance(result, str):
+            raise RuntimeError('Shard %d failed: %s' % (self.index, result))
+        return result
+
+    def _spawn(self) -> None:
+        context = multiprocessing.get_context('spawn')
+        self._connection, child = context.Pipe()
+        self._process = context.Process(target=serve_shard, args=(child, self.index, self.count, self._kwargs),
+                                        name='shard-%d' % self.index, daemon=True)
+        self._process.start()
+        child.close()
+
+    def _stop(self) -> None:
+        self._connection.close()
+        if self._process.is_alive():
+            self._process.kill()
+        self._process.join()
+
+    def close(self) -> None:
+        """Stop shard process.
+
+        Return:
+            None
+        """
+        with self._lock:
+            self._connection.close()
+            self._process.join()
+
+
+class HTTPShard(Shard):
+    """Shard searched by FRMS instance over HTTP.
+
+    Instance is started with SHARD_INDEX and SHARD_COUNT of the shard,
+    every thread keeps its own connection to instance. Search fails with
+    ShardUnavailable if instance is not reachable or is not ready.
+
+    Args:
+        url: Base URL of instance.
+        index: Index of the shard.
+        count: Number of shards.
+        timeout: Timeout of request in seconds.
+
+    Attributes:
+        url: Base URL of instance.
+    """
+    def __init__(self, url: str, index: int, count: int, timeout: float = 10.0) -> None:
+        super(HTTPShard, self).__init__(index, count)
+        self.url: str = url
+        self._timeout: float = timeout
+        self._address: urllib.parse.SplitResult = urllib.parse.urlsplit(url)
+        self._path: str = self._address.path.rstrip('/') + '/shard/search'
+        self._local: threading.local = threading.local()
+
+    def search(self, queries: np.ndarray, k: int) -> ShardResult:
+        response: Dict[str, Any] = self._post(json.dumps({'features': encode_embeddings(queries), 'k': k}))
+        if response['shard'] != [self.index, self.count]:
+            raise RuntimeError('Instance %s serves shard %d of %d, expected shard %d of %d.' % (
+                self.url, response['shard'][0], response['shard'][1], self.index, self.count))
+        candidates: List[List[Tuple[int, float]]] = [
+            [(candidate['id'], candidate['distance']) for candidate in query] for query in response['candidates']
+        ]
+        return ShardResult(candidates, response['version'], response['size'])
+
+    def _post(self, body: str) -> Dict[str, Any]:
+        for attempt in range(2):
+            connection: Optional[http.client.HTTPConnection] = getattr(self._local, 'connection', None)
+            if connection is None:
+                connection_class = http.client.HTTPSConnection if self._address.scheme == 'https' \
+                    else http.client.HTTPConnection
+                connection = connection_class(self._address.hostname, self._address.port, timeout=self._timeout)
+                self._local.connection = connection
+            try:
+                connection.request('POST', self._path, body, {'Content-Type': 'application/json'})
+                response: http.client.HTTPResponse = connection.getresponse()
+                data: bytes = response.read()
+            except (http.client.HTTPException, OSError) as e:
+                connection.close()
+                self._local.connection = None
+                if attempt > 0:
+                    raise ShardUnavailable('Shard %s is not reachable: %s: %s' % (self.url, type(e).__name__, e)) \
+                        from e
+                continue
+            if response.status == 503:
+                raise ShardUnavailable('Shard %s is not ready: %s' % (self.url, data[:200]))
+            if response.status != 200:
+                raise RuntimeError('Shard %s answered %d: %s' % (self.url, response.status, data[:200]))
+            return json.loads(data)
+
+
+class ShardedMatcher:
+    """Class for feature matching in sharded gallery.
+
+    Matcher has interface of FeatureMatcher. Every shard finds k nearest
+    persons, persons of all shards are merged by distance. Persons of
+    different shards never repeat, so merged persons are exact k nearest
+    persons of the whole gallery. Features are verified against faces
+    of the person read from database, as by FeatureMatcher.
+
+    Args:
+        shards: Shards of gallery in order of shard index.
+        max_distance: Max distance between features.
+        max_workers: Number of threads sending queries to shards,
+            4 threads per shard by default.
+        sync_interval: Interval in seconds between background polls
+            of shard versions, 0 disables background polls.
+
+    Attributes:
+        shards: Shards of gallery.
+        max_distance: Max distance between features.
+    """
+    def __init__(self, shards: List[Shard], max_distance: float = 0.03, max_workers: int = 0,
+                 sync_interval: float = 0.0) -> None:
+        for i, shard in enumerate(shards):
+            if (shard.index, shard.count) != (i, len(shards)):
+                raise ValueError('Shard %d of %d is at position %d of %d shards.' % (
+                    shard.index, shard.count, i, len(shards)))
+        self.shards: List[Shard] = shards
+        self.max_distance: float = max_distance
+        self._versions: List[int] = [0] * len(shards)
+        self._sizes: List[int] = [0] * len(shards)
+        session, self._engine = get_connection()
+        session.close()
+        self._executor: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=max_workers or 4 * len(shards),
+                                                                thread_name_prefix='shards')
+        if sync_interval > 0:
+            threading.Thread(target=self._sync_forever, args=(sync_interval,), daemon=True).start()
+
+    @property
+    def version(self) -> Tuple[Tuple[int, int, int], ...]:
+        """Gallery version, the last seen version and size of every shard.
+
+        Version of restarted shard starts again from 1, so version of
+        sharded gallery is compared only for equality.
+        """
+        return tuple(zip(range(len(self.shards)), self._versions, self._sizes))
+
+    @property
+    def size(self) -> int:
+        """Number of faces in gallery, sum of the last seen sizes of shards."""
+        return sum(self._sizes)
+
+    def sync_versions(self) -> None:
+        """Refresh the last seen versions and sizes of shards by empty search.
+
+        Searches refresh versions too, but cached results are served
+        without search, so versions are polled to expire cached results
+        after gallery of any shard is changed.
+
+        Return:
+            None
+        """
+        queries: np.ndarray = np.empty((0, 512), dtype=np.float32)
+        futures: List[Future] = [self._executor.submit(shard.search, queries, 1) for shard in self.shards]
+        for i, future in enumerate(futures):
+            try:
+                result: ShardResult = future.result()
+            except Exception as e:
+                logger.warning('Version of shard %d is not refreshed: %s: %s', i, type(e).__name__, e)
+                continue
+            self._versions[i] = result.version
+            self._sizes[i] = result.size
+
+    def _sync_forever(self, interval: float) -> None:
+        while True:
+            time.sleep(interval)
+            self.sync_versions()
+
+    def match_features(self, features: torch.Tensor) -> Dict[str, Union[List[int], int, str]]:
+        """Match given features tensor with faces of all shards.
+
+        Args:
+            features: Tensor of features.
+
+        Return:
+            Dict of person info.
+        """
+        return self.match_features_batch(features.unsqueeze(0))[0]
+
+    def match_features_batch(self, features: torch.Tensor, k: int = 0) -> List[Dict[str, Union[List[int], int, str]]]:
+        """Match given batch of features with faces of all shards.
+
+        Args:
+            features: Tensor of features with shape (N, 512).
+            k: Number of candidates, 0 to return only the nearest person.
+
+        Return:
+            List of dicts of person info, one dict per features vector.
+        """
+        data: List[Dict[str, Union[List, Optional[int]]]] = [{'bbox': [], 'id': None} for _ in range(features.shape[0])]
+        if k > 0:
+            for answer in data:
+                answer['candidates'] = []
+        if features.shape[0] == 0:
+            return data
+
+        queries: np.ndarray = features.detach().cpu().numpy().astype(np.float32)
+        with stage('match'):
+            results: List[ShardResult] = list(self._executor.map(lambda shard: shard.search(queries, max(1, k)),
+                                                                 self.shards))
+        for i, result in enumerate(results):
+            self._versions[i] = result.version
+            self._sizes[i] = result.size
+
+        for q, answer in enumerate(data):
+            nearest: List[Tuple[int, float]] = sorted(
+                itertools.chain.from_iterable(result.candidates[q] for result in results), key=lambda c: c[1]
+            )
+            if nearest and nearest[0][1] <= self.max_distance:
+                answer['id'] = nearest[0][0]
+            if k > 0:
+                answer['candidates'] = [{'id': person_id, 'distance': dist} for person_id, dist in nearest[:k]]
+        return data
+
+    def verify_features_batch(self, features: torch.Tensor, person_id: int
+                              ) -> List[Dict[str, Union[List[int], float, bool, None]]]:
+        """Verify that given batch of features belongs to the person.
+
+        Args:
+            features: Tensor of features with shape (N, 512).
+            person_id: ID of the claimed person.
+
+        Return:
+            List of dicts with distance to the nearest face of the person
+            (None if the person has no faces) and decision, one dict per features vector.
+        """
+        return verify_features(self._engine, features, person_id, self.max_distance)
+
+
+def search_shard(matcher: FeatureMatcher, queries: np.ndarray, k: int) -> ShardResult:
+    """Find k nearest persons of every query by matcher of shard worker.
+
+    Version is read before search, as by RecognitionPipeline, so result
+    is never cached with version newer than gallery it was found in.
+
+    Args:
+        matcher: Feature matcher of shard.
+        queries: Matrix of features with shape (N, 512).
+        k: Number of persons.
+
+    Return:
+        Result of shard search.
+    """
+    version: int = matcher.version
+    answers: List[Dict[str, Union[List, Optional[int]]]] = matcher.match_features_batch(torch.from_numpy(queries), k)
+    candidates: List[List[Tuple[int, float]]] = [
+        [(candidate['id'], candidate['distance']) for candidate in answer['candidates']] for answer in answers
+    ]
+    return ShardResult(candidates, version, matcher.size)
+
+
+def serve_shard(connection: Connection, index: int, count: int, kwargs: Dict[str, Any]) -> None:
+    """Serve searches of shard in shard process until connection is closed.
+
+    Error of search is sent back as string.
+
+    Args:
+        connection: Connection to front process.
+        index: Index of the shard.
+        count: Number of shards.
+        kwargs: Arguments of FeatureMatcher.
+
+    Return:
+        None
+    """
+    matcher: FeatureMatcher = FeatureMatcher(shard=(index, count), **kwargs)
+    while True:
+        try:
+            queries, k = connection.recv()
+        except EOFError:
+            return
+        try:
+            result: Union[ShardResult, str] = search_shard(matcher, queries, k)
+        except Exception as e:
+            result = '%s: %s' % (type(e).__name__, e)
+        connection.send(result)
+
+
+def encode_embeddings(features: np.ndarray) -> str:
+    """Encode features matrix as base64 string of little-endian float32 values.
+
+    Args:
+        features: Matrix of features with shape (N, dim).
+
+    Return:
+        Base64 string.
+    """
+    return base64.b64encode(np.ascontiguousarray(features, dtype='<f4').tobytes()).decode('ascii')
+
+
+def decode_embeddings(data: Union[str, bytes], dim: int = 512) -> np.ndarray:
+    """Decode features matrix from base64 string or bytes of little-endian float32 values.
+
+    Args:
+        data: Base64 string or raw bytes.
+        dim: Size of features vector.
+
+    Return:
+        Matrix of features with shape (N, dim).
+    """
+    if isinstance(data, str):
+        data = base64.b64decode(data, validate=True)
+    if len(data) % (4 * dim) != 0:
+        raise ValueError('Size of features data is not a multiple of %d float32 values.' % dim)
+    features: np.ndarray = np.frombuffer(data, dtype='<f4').astype(np.float32).reshape(-1, dim)
+    if not np.isfinite(features).all():
+        raise ValueError('Features data has NaN or infinite values.')
+    return features
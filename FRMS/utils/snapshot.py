@@ -0,0 +1,163 @@
+# FRMS/utils/snapshot.py
+#
+# Copyright (C) 2021-2022  Дмитрий Кузнецов
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""This module contains functions to save and load gallery snapshots.
+
+Snapshot is a single file with versioned header followed by face IDs,
+person IDs, squared norms and features matrix stored as float32 or
+float16. Header has max face ID and tombstone ID of the gallery, so the
+gallery loaded from snapshot is updated from database with newer rows
+only, and CRC32 checksum of data. Loaded float32 snapshot is memory-mapped,
+so processes loading the same snapshot share its pages in RAM, float16
+snapshot is read at once and converted to float32.
+Snapshot is replaced atomically: new snapshot is written to temporary
+file which is renamed over the old one, processes which still map
+the old file keep reading it until they reload.
+
+Example:
+    >>> from FRMS.utils.snapshot import save_snapshot, load_snapshot
+    >>> save_snapshot(gallery, 'gallery.snapshot', dtype='float16')
+    >>> gallery = load_snapshot('gallery.snapshot')
+"""
+
+from FRMS.utils.gallery import Gallery
+from typing import Iterable, Tuple
+import numpy as np
+import struct
+import zlib
+import os
+
+MAGIC: bytes = b'FRMSGAL\0'
+VERSION: int = 2
+_PREFIX: struct.Struct = struct.Struct('<8sI')
+_HEADERS: dict = {1: struct.Struct('<8sIIqqq'), 2: struct.Struct('<8sIIqqqII')}
+_DTYPES: dict = {4: np.float32, 2: np.float16}
+_ALIGNMENT: int = 64
+
+
+def save_snapshot(gallery: Gallery, path: str, dtype: str = 'float32') -> None:
+    """Save gallery to snapshot file atomically.
+
+    Removed rows of gallery are not saved.
+
+    Args:
+        gallery: Gallery of faces.
+        path: Path to snapshot file.
+        dtype: Type of stored features, 'float32' or 'float16'.
+
+    Return:
+        None
+    """
+    keep: np.ndarray = np.isfinite(gallery.sq_norms)
+    count: int = int(keep.sum())
+    itemsize: int = np.dtype(dtype).itemsize
+    if itemsize not in _DTYPES:
+        raise ValueError("Unsupported features type '%s', expected 'float32' or 'float16'." % dtype)
+    arrays: Tuple[np.ndarray, ...] = (gallery.face_ids[keep], gallery.person_ids[keep], gallery.sq_norms[keep],
+                                      gallery.features[keep].astype(_DTYPES[itemsize], copy=False))
+    offsets: Tuple[int, int, int, int, int] = _offsets(count, gallery.dim, itemsize)
+    header: bytes = _HEADERS[VERSION].pack(MAGIC, VERSION, gallery.dim, count, gallery.last_face_id,
+                                           gallery.last_tombstone_id, itemsize, _checksum(arrays))
+
+    tmp_path: str = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(header)
+        for offset, array in zip(offsets, arrays):
+            f.seek(offset)
+            f.write(np.ascontiguousarray(array).tobytes())
+        f.truncate(offsets[-1])
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def load_snapshot(path: str, verify: bool = True) -> Gallery:
+    """Load gallery from snapshot file.
+
+    Arrays of float32 snapshot are copy-on-write memory maps of the file:
+    pages are shared between processes until gallery modifies them.
+    Snapshots of version 1 (float32 without checksum) are loaded too.
+
+    Args:
+        path: Path to snapshot file.
+        verify: Compare checksum of data with checksum in header.
+
+    Return:
+        Gallery of faces.
+    """
+    with open(path, 'rb') as f:
+        magic, version = _PREFIX.unpack(f.read(_PREFIX.size))
+        if magic != MAGIC:
+            raise ValueError('%s is not a gallery snapshot.' % path)
+        if version not in _HEADERS:
+            raise ValueError('Unsupported gallery snapshot version %d, expected %d.' % (version, VERSION))
+        f.seek(0)
+        header: tuple = _HEADERS[version].unpack(f.read(_HEADERS[version].size))
+    _, _, dim, count, last_face_id, last_tombstone_id = header[:6]
+    itemsize, checksum = header[6:] if version > 1 else (4, None)
+
+    gallery: Gallery = Gallery(dim)
+    if count > 0:
+        face_ids, person_ids, sq_norms, features, end = _offsets(count, dim, itemsize)
+        if os.path.getsize(path) < end:
+            raise ValueError('Gallery snapshot %s is truncated.' % path)
+        gallery._face_ids = np.memmap(path, dtype=np.int64, mode='c', offset=face_ids, shape=(count,))
+        gallery._person_ids = np.memmap(path, dtype=np.int64, mode='c', offset=person_ids, shape=(count,))
+        gallery._sq_norms = np.memmap(path, dtype=np.float32, mode='c', offset=sq_norms, shape=(count,))
+        gallery._features = np.memmap(path, dtype=_DTYPES[itemsize], mode='c', offset=features, shape=(count, dim))
+        gallery._size = count
+    if verify and checksum is not None and _checksum((gallery.face_ids, gallery.person_ids, gallery.sq_norms,
+                                                      gallery.features)) != checksum:
+        raise ValueError('Checksum of gallery snapshot %s does not match.' % path)
+    if itemsize != 4 and count > 0:
+        gallery._features = gallery.features.astype(np.float32)
+        gallery._sq_norms = np.einsum('ij,ij->i', gallery.features, gallery.features)
+    gallery.last_face_id = last_face_id
+    gallery.last_tombstone_id = last_tombstone_id
+    return gallery
+
+
+def snapshot_signature(path: str) -> Tuple[int, int, int]:
+    """Get signature of snapshot file which changes when snapshot is replaced.
+
+    Args:
+        path: Path to snapshot file.
+
+    Return:
+        Inode, modification time and size of file.
+    """
+    stat: os.stat_result = os.stat(path)
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+def _align(offset: int) -> int:
+    return (offset + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
+
+
+def _offsets(count: int, dim: int, itemsize: int) -> Tuple[int, int, int, int, int]:
+    face_ids: int = _align(max(header.size for header in _HEADERS.values()))
+    person_ids: int = _align(face_ids + 8 * count)
+    sq_norms: int = _align(person_ids + 8 * count)
+    features: int = _align(sq_norms + 4 * count)
+    end: int = features + itemsize * count * dim
+    return face_ids, person_ids, sq_norms, features, end
+
+
+def _checksum(arrays: Iterable[np.ndarray]) -> int:
+    checksum: int = 0
+    for array in arrays:
+        checksum = zlib.crc32(np.ascontiguousarray(array).data, checksum)
+    return checksum
@@ -0,0 +1,152 @@
+# FRMS/utils/tracker.py
+#
+# Copyright (C) 2021-2022  Дмитрий Кузнецов
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""This module contains classes Track and FaceTracker and function iou.
+
+FaceTracker follows faces across consecutive video frames by overlap
+of bounding boxes, so recognized face is not embedded and matched
+again in every frame.
+"""
+
+from typing import List, Optional
+import numpy as np
+
+
+class Track:
+    """Face tracked across frames.
+
+    Args:
+        track_id: ID of the track.
+        bbox: Coordinates of bounding box.
+
+    Attributes:
+        track_id: ID of the track.
+        bbox: Coordinates of bounding box in the last frame.
+        person_id: ID of the person, None if face is unrecognized.
+        age: Number of frames since the last recognition.
+        missed: Number of consecutive frames without the face.
+        stale: Face must be recognized again in the current frame.
+    """
+    def __init__(self, track_id: int, bbox: List[float]) -> None:
+        self.track_id: int = track_id
+        self.bbox: List[float] = bbox
+        self.person_id: Optional[int] = None
+        self.age: int = 0
+        self.missed: int = 0
+        self.stale: bool = True
+
+    def recognized(self, person_id: Optional[int]) -> None:
+        """Save result of recognition.
+
+        Args:
+            person_id: ID of the person.
+
+        Return:
+            None
+        """
+        self.person_id = person_id
+        self.age = 0
+        self.stale = False
+
+
+class FaceTracker:
+    """Tracker of faces in video stream.
+
+    Detections are associated with tracks greedily by the highest
+    IoU of bounding boxes. Track becomes stale (must be recognized
+    again) when it is new, when it was not recognized for
+    refresh_interval frames or when its face moved so that IoU with
+    the previous bounding box is lower than stable_iou.
+
+    Args:
+        min_iou: Min IoU of detection and track to associate them.
+        stable_iou: Min IoU of detection and track to keep recognition.
+        refresh_interval: Number of frames after which track is recognized again.
+        max_missed: Number of frames without the face after which track is dropped.
+
+    Example:
+        >>> from FRMS.utils.tracker import FaceTracker
+        >>> tracker = FaceTracker(refresh_interval=10)
+        >>> tracks = tracker.update([[10, 10, 60, 70]])
+        >>> tracks[0].stale
+        True
+    """
+    def __init__(self, min_iou: float = 0.3, stable_iou: float = 0.6, refresh_interval: int = 10,
+                 max_missed: int = 5) -> None:
+        self.min_iou: float = min_iou
+        self.stable_iou: float = stable_iou
+        self.refresh_interval: int = refresh_interval
+        self.max_missed: int = max_missed
+        self.tracks: List[Track] = []
+        self._next_id: int = 0
+
+    def update(self, bboxes: List[List[float]]) -> List[Track]:
+        """Associate detections of the next frame with tracks.
+
+        Args:
+            bboxes: Bounding boxes of faces in frame.
+
+        Return:
+            Track of every bounding box.
+        """
+        tracks: List[Optional[Track]] = [None] * len(bboxes)
+        matched: np.ndarray = np.zeros(len(self.tracks), dtype=bool)
+        if self.tracks and bboxes:
+            ious: np.ndarray = iou(np.array(bboxes, dtype=np.float32),
+                                   np.array([track.bbox for track in self.tracks], dtype=np.float32))
+            for flat in np.argsort(ious, axis=None)[::-1]:
+                i, j = np.unravel_index(flat, ious.shape)
+                if ious[i, j] < self.min_iou:
+                    break
+                if tracks[i] is not None or matched[j]:
+                    continue
+                track: Track = self.tracks[j]
+                track.age += 1
+                track.stale = track.stale or ious[i, j] < self.stable_iou or track.age >= self.refresh_interval
+                track.bbox = bboxes[i]
+                track.missed = 0
+                tracks[i] = track
+                matched[j] = True
+
+        for track in (track for track, found in zip(self.tracks, matched) if not found):
+            track.missed += 1
+        self.tracks = [track for track in self.tracks if track.missed <= self.max_missed]
+
+        for i, bbox in enumerate(bboxes):
+            if tracks[i] is None:
+                tracks[i] = Track(self._next_id, bbox)
+                self._next_id += 1
+                self.tracks.append(tracks[i])
+        return tracks
+
+
+def iou(boxes1: np.ndarray, boxes2: np.ndarray) -> np.ndarray:
+    """Calculate intersection over union of bounding boxes.
+
+    Args:
+        boxes1: Bounding boxes with shape (N, 4).
+        boxes2: Bounding boxes with shape (M, 4).
+
+    Return:
+        Matrix of IoU with shape (N, M).
+    """
+    left_top: np.ndarray = np.maximum(boxes1[:, np.newaxis, :2], boxes2[np.newaxis, :, :2])
+    right_bottom: np.ndarray = np.minimum(boxes1[:, np.newaxis, 2:], boxes2[np.newaxis, :, 2:])
+    intersection: np.ndarray = np.prod(np.clip(right_bottom - left_top, 0, None), axis=2)
+    area1: np.ndarray = np.prod(boxes1[:, 2:] - boxes1[:, :2], axis=1)
+    area2: np.ndarray = np.prod(boxes2[:, 2:] - boxes2[:, :2], axis=1)
+    union: np.ndarray = area1[:, np.newaxis] + area2[np.newaxis, :] - intersection
+    return intersection / np.maximum(union, 1e-9)
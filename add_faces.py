@@ -17,42 +17,153 @@
 """
 This file contains the script to fill the database of a face features.
 
+Images are decoded and faces are detected by DataLoader worker processes,
+which are spawned instead of forked if CUDA is available, because CUDA
+initialized in this process can not be used in forked processes. Features
+are extracted by batches and inserted by chunks, every chunk is
+committed in its own transaction. Progress is saved to the checkpoint file
+after every commit, so interrupted script continues from the last commit.
+
 Note:
     Set the environment variable DATABASE_URL to correct work of this script.
 
 Example:
-    >>> python add_faces.py path/to/dataset
+    >>> python add_faces.py path/to/dataset --workers 8 --batch-size 64
 """
 
-from FRMS.database import get_connection, Face, create_table
+from FRMS.database import get_connection, encode_features, Face, create_table
 from FRMS.dataset import FacesDataset
 from FRMS.utils.feature_extractor import FeatureExtractor
+from torch.utils.data import Dataset, DataLoader
+from typing import Dict, List, Optional, Tuple, Union
 from torch import Tensor
 from tqdm import tqdm
 import argparse
+import torch
+import json
+import time
 import os
 
 
-def fill_database(path_to_dataset: str) -> None:
+class EnrollmentItems(Dataset):
+    """Items of FacesDataset for enrollment.
+
+    Args:
+        dataset: Dataset of faces.
+        start: Index of the first item.
+    """
+    def __init__(self, dataset: FacesDataset, start: int = 0) -> None:
+        self.dataset: FacesDataset = dataset
+        self.start: int = start
+
+    def __len__(self) -> int:
+        return len(self.dataset) - self.start
+
+    def __getitem__(self, item: int) -> Tuple[int, Optional[Tensor], int]:
+        index: int = self.start + item
+        return index, self.dataset.get_face(index), self.dataset.get_face_id(index)
+
+
+def collate(items: List[Tuple[int, Optional[Tensor], int]]) -> Tuple[int, int, Optional[Tensor], List[int]]:
+    """Stacks faces of batch, images without faces are skipped.
+
+    Args:
+        items: Items of EnrollmentItems.
+
+    Return:
+        Index of the last item, number of items, stacked faces and IDs of the persons.
+    """
+    faces: List[Tensor] = [face for _, face, _ in items if face is not None]
+    face_ids: List[int] = [face_id for _, face, face_id in items if face is not None]
+    return items[-1][0], len(items), torch.stack(faces) if faces else None, face_ids
+
+
+def init_worker(_: int) -> None:
+    """Limits PyTorch threads of DataLoader worker process."""
+    torch.set_num_threads(1)
+
+
+def read_checkpoint(checkpoint: str, path_to_dataset: str) -> int:
+    """Reads index of the first not enrolled item.
+
+    Args:
+        checkpoint: The path to the checkpoint file.
+        path_to_dataset: The path to a dataset root directory.
+
+    Return:
+        Index of item.
+    """
+    if not checkpoint or not os.path.exists(checkpoint):
+        return 0
+    with open(checkpoint) as f:
+        state: Dict[str, Union[str, int]] = json.load(f)
+    if state['path'] != os.path.abspath(path_to_dataset):
+        raise ValueError('The checkpoint %s belongs to the dataset %s.' % (checkpoint, state['path']))
+    return state['next_item']
+
+
+def write_checkpoint(checkpoint: str, path_to_dataset: str, next_item: int) -> None:
+    """Writes index of the first not enrolled item.
+
+    Args:
+        checkpoint: The path to the checkpoint file.
+        path_to_dataset: The path to a dataset root directory.
+        next_item: Index of item.
+
+    Return:
+        None
+    """
+    if not checkpoint:
+        return
+    with open(checkpoint + '.tmp', 'w') as f:
+        json.dump({'path': os.path.abspath(path_to_dataset), 'next_item': next_item}, f)
+    os.replace(checkpoint + '.tmp', checkpoint)
+
+
+def fill_database(path_to_dataset: str, batch_size: int = 64, workers: int = 4,
+                  commit_every: int = 1024, checkpoint: str = '') -> None:
     """Fills the database of a face features.
 
     Args:
         path_to_dataset: The path to a dataset root directory.
+        batch_size: Number of images in feature extraction batch.
+        workers: Number of processes for image decoding and face detection.
+        commit_every: Number of faces inserted in one transaction.
+        checkpoint: The path to the checkpoint file, empty to disable resuming.
 
     Return:
         None
     """
     ds: FacesDataset = FacesDataset(path_to_dataset)
+    start: int = read_checkpoint(checkpoint, path_to_dataset)
+    items: EnrollmentItems = EnrollmentItems(ds, start)
+    context: Optional[str] = 'spawn' if workers > 0 and torch.cuda.is_available() else None
+    loader: DataLoader = DataLoader(items, batch_size=batch_size, num_workers=workers, collate_fn=collate,
+                                    worker_init_fn=init_worker if workers > 0 else None,
+                                    multiprocessing_context=context)
     session, _ = get_connection()
     feature_extractor: FeatureExtractor = FeatureExtractor()
-    faces_count: int = len(ds)
-
-    for i in tqdm(range(faces_count)):
+    rows: List[Dict[str, Union[bytes, int]]] = []
+    enrolled: int = 0
+    started: float = time.perf_counter()
 
-        features: Tensor = feature_extractor.extract_features(ds[i][0])
-        session.add(Face(features, ds.get_face_id(i)))
+    with tqdm(total=len(items), unit='img') as progress:
+        for last_item, count, faces, face_ids in loader:
+            if faces is not None:
+                features: Tensor = feature_extractor.extract_features_batch(faces)
+                rows.extend({'features': encode_features(vector.numpy()), 'person_id': face_id}
+                            for vector, face_id in zip(features, face_ids))
+            progress.update(count)
+            if len(rows) >= commit_every or last_item + 1 == len(ds):
+                session.bulk_insert_mappings(Face, rows)
+                session.commit()
+                enrolled += len(rows)
+                rows = []
+                write_checkpoint(checkpoint, path_to_dataset, last_item + 1)
 
-    session.commit()
+    elapsed: float = time.perf_counter() - started
+    print('Enrolled %d faces from %d images in %.1f s (%.1f images/s).' % (
+        enrolled, len(items), elapsed, len(items) / max(elapsed, 1e-9)))
 
 
 if __name__ == '__main__':
@@ -68,12 +179,17 @@ Dataset format:
     ...................
     |--N
         |--somename.jpg""")
+    parser.add_argument('--batch-size', type=int, default=64, help='Number of images in feature extraction batch.')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='Number of processes for image decoding and face detection.')
+    parser.add_argument('--commit-every', type=int, default=1024, help='Number of faces inserted in one transaction.')
+    parser.add_argument('--checkpoint', type=str, default='add_faces.checkpoint',
+                        help='The path to the checkpoint file, empty string to disable resuming.')
     args = parser.parse_args()
     try:
         if not os.path.exists(args.path):
             raise FileNotFoundError
         create_table()
-        fill_database(args.path)
+        fill_database(args.path, args.batch_size, args.workers, args.commit_every, args.checkpoint)
     except FileNotFoundError:
         print('The path to the dataset is incorrect.')
-    
\ No newline at end of file
@@ -0,0 +1,508 @@
+# benchmark.py
+#
+# Copyright (C) 2021-2022  Дмитрий Кузнецов
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+This file contains the benchmark suite of the recognition pipeline.
+
+Synthetic galleries of random normalized embeddings are generated in local SQLite
+databases and reused by later runs, synthetic images contain drawn faces which
+MTCNN detects. The suite measures latency, throughput and memory of the feature
+matcher, the face detector, the feature extractor and the POST / endpoint of
+a microservice started in a subprocess under concurrent load, with per-stage
+latency from the Server-Timing header. Results are written to JSON file to
+compare versions.
+
+Example:
+    >>> python benchmark.py --gallery-sizes 10000 100000 --concurrency 1 4 16 --output results.json
+"""
+
+from FRMS.database import Base, FEATURES_DIM
+from FRMS.utils.feature_matcher import FeatureMatcher
+from FRMS.utils.face_detector import FaceDetector
+from FRMS.utils.feature_extractor import FeatureExtractor
+from FRMS.utils.index import create_index
+from FRMS import __version__
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import create_engine, func, select
+from sqlalchemy.engine import Engine
+from PIL import Image, ImageDraw, ImageFilter
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import urllib.request
+import urllib.error
+import numpy as np
+import http.client
+import subprocess
+import datetime
+import platform
+import argparse
+import resource
+import base64
+import torch
+import json
+import time
+import sys
+import os
+import io
+
+Result = Dict[str, Any]
+
+
+def rss_mb(pid: Optional[int] = None) -> float:
+    """Get resident set size of process.
+
+    Args:
+        pid: Process ID, the current process by default.
+
+    Return:
+        Resident set size in megabytes.
+    """
+    try:
+        with open('/proc/%s/statm' % (pid or 'self')) as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def latency_stats(seconds: List[float]) -> Dict[str, float]:
+    """Summarize latencies.
+
+    Args:
+        seconds: Latencies in seconds.
+
+    Return:
+        Mean, median, 95th and 99th percentiles in milliseconds.
+    """
+    ms: np.ndarray = np.array(seconds, dtype=np.float64) * 1000
+    return {'mean_ms': float(ms.mean()), 'p50_ms': float(np.percentile(ms, 50)),
+            'p95_ms': float(np.percentile(ms, 95)), 'p99_ms': float(np.percentile(ms, 99))}
+
+
+def timed(function: Callable[[], Any], repeats: int) -> List[float]:
+    """Call function repeatedly after one warm-up call.
+
+    Args:
+        function: Function without arguments.
+        repeats: Number of timed calls.
+
+    Return:
+        Latencies in seconds.
+    """
+    function()
+    latencies: List[float] = []
+    for _ in range(repeats):
+        start: float = time.perf_counter()
+        function()
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def draw_face(draw: ImageDraw.ImageDraw, x: float, y: float, size: float, rng: np.random.Generator) -> None:
+    """Draw simple face which MTCNN detects.
+
+    Args:
+        draw: Drawing context of image.
+        x: Left coordinate of face.
+        y: Top coordinate of face.
+        size: Width of face.
+        rng: Random generator of skin tone.
+
+    Return:
+        None
+    """
+    skin: Tuple[int, ...] = tuple(int(c) for c in rng.integers(-20, 20, 3) + (224, 172, 140))
+    draw.ellipse([x, y, x + size, y + size * 1.3], fill=skin)
+    eye: float = size / 8
+    ey: float = y + size * 0.45
+    for ex in (x + size * 0.3, x + size * 0.7):
+        draw.ellipse([ex - eye, ey - eye * 0.6, ex + eye, ey + eye * 0.6], fill=(255, 255, 255))
+        draw.ellipse([ex - eye / 2, ey - eye / 2, ex + eye / 2, ey + eye / 2], fill=(40, 30, 20))
+        draw.line([ex - eye * 1.3, y + size * 0.32, ex + eye * 1.3, y + size * 0.3], fill=(60, 40, 30),
+                  width=max(2, int(size / 30)))
+    draw.polygon([(x + size * 0.5, y + size * 0.5), (x + size * 0.42, y + size * 0.78),
+                  (x + size * 0.58, y + size * 0.78)], fill=(200, 140, 110))
+    draw.ellipse([x + size * 0.35, y + size * 0.92, x + size * 0.65, y + size * 1.02], fill=(170, 70, 70))
+
+
+def make_image(n_faces: int, rng: np.random.Generator, width: int = 640, height: int = 480) -> bytes:
+    """Make JPEG image with drawn faces on a grid.
+
+    Args:
+        n_faces: Number of faces.
+        rng: Random generator.
+        width: Width of image.
+        height: Height of image.
+
+    Return:
+        Bytes of JPEG file.
+    """
+    img: Image.Image = Image.new('RGB', (width, height), tuple(int(c) for c in rng.integers(60, 160, 3)))
+    draw: ImageDraw.ImageDraw = ImageDraw.Draw(img)
+    columns: int = max(1, int(np.ceil(np.sqrt(n_faces * width / height))))
+    rows: int = max(1, int(np.ceil(n_faces / columns)))
+    size: float = min(width / columns, height / rows / 1.3) * 0.7
+    for i in range(n_faces):
+        draw_face(draw, (i % columns + 0.15) * width / columns, (i // columns + 0.1) * height / rows, size, rng)
+    buffer: io.BytesIO = io.BytesIO()
+    img.filter(ImageFilter.GaussianBlur(2)).save(buffer, 'JPEG', quality=90)
+    return buffer.getvalue()
+
+
+def make_gallery(directory: str, size: int, faces_per_person: int, seed: int, chunk_size: int = 50000) -> str:
+    """Generate SQLite database with gallery of random normalized embeddings.
+
+    Database file is named by size, grouping of faces by person and seed,
+    database which already has the gallery of given size is reused.
+
+    Args:
+        directory: Directory of databases.
+        size: Number of faces.
+        faces_per_person: Number of faces of every person.
+        seed: Random seed.
+        chunk_size: Number of faces inserted by one statement.
+
+    Return:
+        Database connection string.
+    """
+    path: str = os.path.join(directory, 'gallery-%d-%d-%d.db' % (size, faces_per_person, seed))
+    database_url: str = 'sqlite:///%s' % os.path.abspath(path)
+    engine: Engine = create_engine(database_url)
+    Base.metadata.create_all(engine)
+    faces = Base.metadata.tables['faces']
+    with engine.begin() as connection:
+        count: int = connection.execute(select(func.count()).select_from(faces)).scalar()
+        if count != size:
+            connection.execute(faces.delete())
+            rng: np.random.Generator = np.random.default_rng(seed)
+            for start in range(0, size, chunk_size):
+                n: int = min(chunk_size, size - start)
+                features: np.ndarray = rng.standard_normal((n, FEATURES_DIM), dtype=np.float32)
+                features /= np.linalg.norm(features, axis=1, keepdims=True)
+                connection.execute(faces.insert(), [
+                    {'features': row.tobytes(), 'person_id': (start + i) // faces_per_person}
+                    for i, row in enumerate(features)
+                ])
+    engine.dispose()
+    return database_url
+
+
+def bench_matcher(database_url: str, size: int, index: str, batch_sizes: List[int], repeats: int,
+                  noise: float, seed: int) -> List[Result]:
+    """Measure gallery loading and matching.
+
+    Args:
+        database_url: Database connection string.
+        size: Number of faces in gallery.
+        index: Gallery index, 'flat' or 'ivf'.
+        batch_sizes: Numbers of queries matched together.
+        repeats: Number of timed calls.
+        noise: Standard deviation of gaussian noise added to queries.
+        seed: Random seed.
+
+    Return:
+        Results.
+    """
+    os.environ['DATABASE_URL'] = database_url
+    rss: float = rss_mb()
+    start: float = time.perf_counter()
+    matcher: FeatureMatcher = FeatureMatcher(max_distance=1.0, index=create_index(index))
+    results: List[Result] = [{
+        'component': 'matcher', 'stage': 'load', 'gallery_size': size, 'index': index,
+        'seconds': time.perf_counter() - start, 'rss_delta_mb': rss_mb() - rss,
+        'gallery_mb': matcher.gallery.features.nbytes / 2 ** 20
+    }]
+
+    rng: np.random.Generator = np.random.default_rng(seed)
+    for batch_size in batch_sizes:
+        rows: np.ndarray = rng.integers(0, len(matcher.gallery), batch_size)
+        queries: torch.Tensor = torch.from_numpy(
+            matcher.gallery.features[rows] + rng.normal(0.0, noise, (batch_size, FEATURES_DIM)).astype(np.float32)
+        )
+        latencies: List[float] = timed(lambda: matcher.match_features_batch(queries), repeats)
+        results.append({
+            'component': 'matcher', 'stage': 'match', 'gallery_size': size, 'index': index,
+            'batch_size': batch_size, 'queries_per_second': batch_size * repeats / sum(latencies),
+            **latency_stats(latencies)
+        })
+    return results
+
+
+def bench_detector(images: Dict[int, bytes], batch_sizes: List[int], repeats: int) -> List[Result]:
+    """Measure face detection by number of faces on image and by batch size.
+
+    Args:
+        images: JPEG images by number of faces.
+        batch_sizes: Numbers of images detected together.
+        repeats: Number of timed calls.
+
+    Return:
+        Results.
+    """
+    rss: float = rss_mb()
+    detector: FaceDetector = FaceDetector()
+    results: List[Result] = [{'component': 'detector', 'stage': 'load', 'rss_delta_mb': rss_mb() - rss}]
+    decoded: Dict[int, Image.Image] = {n: Image.open(io.BytesIO(data)).convert('RGB') for n, data in images.items()}
+    for n_faces, img in decoded.items():
+        latencies: List[float] = timed(lambda: detector.find_faces(img), repeats)
+        results.append({
+            'component': 'detector', 'stage': 'detect', 'faces': n_faces, 'found': len(detector.find_faces(img)),
+            'images_per_second': repeats / sum(latencies), **latency_stats(latencies)
+        })
+    for batch_size in batch_sizes:
+        batch: List[Image.Image] = [decoded[n] for n in decoded] * batch_size
+        batch = batch[:batch_size]
+        latencies: List[float] = timed(lambda: detector.find_faces_batch(batch), repeats)
+        results.append({
+            'component': 'detector', 'stage': 'detect_batch', 'batch_size': batch_size,
+            'images_per_second': batch_size * repeats / sum(latencies), **latency_stats(latencies)
+        })
+    return results
+
+
+def bench_extractor(mode: str, batch_sizes: List[int], repeats: int) -> List[Result]:
+    """Measure feature extraction by batch size.
+
+    Args:
+        mode: Inference mode of feature extractor.
+        batch_sizes: Numbers of faces extracted together.
+        repeats: Number of timed calls.
+
+    Return:
+        Results.
+    """
+    rss: float = rss_mb()
+    start: float = time.perf_counter()
+    extractor: FeatureExtractor = FeatureExtractor(mode=mode)
+    results: List[Result] = [{
+        'component': 'extractor', 'stage': 'load', 'mode': mode,
+        'seconds': time.perf_counter() - start, 'rss_delta_mb': rss_mb() - rss
+    }]
+    for batch_size in batch_sizes:
+        faces: torch.Tensor = torch.rand((batch_size, 3, 160, 160)) * 2 - 1
+        latencies: List[float] = timed(lambda: extractor.extract_features_batch(faces), repeats)
+        results.append({
+            'component': 'extractor', 'stage': 'embed', 'mode': mode, 'batch_size': batch_size,
+            'faces_per_second': batch_size * repeats / sum(latencies), **latency_stats(latencies)
+        })
+    return results
+
+
+def post(port: int, body: bytes) -> Tuple[float, int, Dict[str, float]]:
+    """Send image to POST / route.
+
+    Args:
+        port: Port of microservice.
+        body: JSON body of request.
+
+    Return:
+        Latency in seconds, status code and stage timings in seconds from Server-Timing header.
+    """
+    connection: http.client.HTTPConnection = http.client.HTTPConnection('127.0.0.1', port)
+    start: float = time.perf_counter()
+    connection.request('POST', '/', body=body, headers={'Content-Type': 'application/json'})
+    response: http.client.HTTPResponse = connection.getresponse()
+    response.read()
+    latency: float = time.perf_counter() - start
+    connection.close()
+    stages: Dict[str, float] = {}
+    for item in filter(None, (response.getheader('Server-Timing') or '').split(',')):
+        name, _, duration = item.strip().partition(';dur=')
+        stages[name] = float(duration) / 1000
+    return latency, response.status, stages
+
+
+def bench_endpoint(database_url: str, size: int, images: Dict[int, bytes], concurrency: List[int],
+                   n_requests: int, port: int, env: Dict[str, str], startup_timeout: float = 600.0) -> List[Result]:
+    """Measure POST / route of microservice started in subprocess under concurrent load.
+
+    Result cache is disabled, so every request is processed.
+
+    Args:
+        database_url: Database connection string.
+        size: Number of faces in gallery.
+        images: JPEG images by number of faces.
+        concurrency: Numbers of concurrent clients.
+        n_requests: Number of requests for every concurrency.
+        port: Port of microservice.
+        env: Extra environment variables of microservice.
+        startup_timeout: Max time in seconds to wait for readiness of microservice.
+
+    Return:
+        Results.
+    """
+    server: subprocess.Popen = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'FRMS.app:app', '--port', str(port), '--log-level', 'warning'],
+        env={**os.environ, 'DATABASE_URL': database_url, 'SERVER_TIMING': '1', 'CACHE_SIZE': '0',
+             'SYNC_INTERVAL': '0', **env},
+        cwd=os.path.dirname(os.path.abspath(__file__))
+    )
+    results: List[Result] = []
+    try:
+        start: float = time.perf_counter()
+        status: Dict[str, Any] = {}
+        while True:
+            if server.poll() is not None:
+                raise RuntimeError('Microservice exited with code %d.' % server.returncode)
+            try:
+                with urllib.request.urlopen('http://127.0.0.1:%d/ready' % port, timeout=10) as response:
+                    if response.status == 200:
+                        break
+            except urllib.error.HTTPError as e:
+                try:
+                    status = json.loads(e.read())
+                except ValueError:
+                    status = {}
+                if status.get('failed'):
+                    raise RuntimeError('Microservice failed to start: %s' % status.get('error'))
+            except OSError:
+                pass
+            if time.perf_counter() - start > startup_timeout:
+                raise RuntimeError('Microservice is not ready in %.0f s, last error: %s' % (
+                    startup_timeout, status.get('error')))
+            time.sleep(0.5)
+        results.append({'component': 'endpoint', 'stage': 'startup', 'gallery_size': size,
+                        'seconds': time.perf_counter() - start, 'rss_mb': rss_mb(server.pid)})
+
+        bodies: List[bytes] = [json.dumps({'image': base64.b64encode(data).decode()}).encode()
+                               for data in images.values()]
+        for clients in concurrency:
+            with ThreadPoolExecutor(max_workers=clients) as executor:
+                start = time.perf_counter()
+                responses: List[Tuple[float, int, Dict[str, float]]] = list(executor.map(
+                    lambda i: post(port, bodies[i % len(bodies)]), range(n_requests)
+                ))
+                elapsed: float = time.perf_counter() - start
+            stages: Dict[str, List[float]] = {}
+            for _, _, timings in responses:
+                for name, seconds in timings.items():
+                    stages.setdefault(name, []).append(seconds)
+            results.append({
+                'component': 'endpoint', 'stage': 'POST /', 'gallery_size': size, 'concurrency': clients,
+                'requests': n_requests, 'errors': sum(status != 200 for _, status, _ in responses),
+                'requests_per_second': n_requests / elapsed, 'rss_mb': rss_mb(server.pid),
+                **latency_stats([latency for latency, _, _ in responses]),
+                'stages': {name: latency_stats(seconds) for name, seconds in stages.items()}
+            })
+    finally:
+        server.terminate()
+        server.wait()
+    return results
+
+
+def environment() -> Dict[str, Any]:
+    """Describe versions and hardware of benchmark run.
+
+    Return:
+        Dict of environment info.
+    """
+    try:
+        commit: str = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                     cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit: str = ''
+    return {
+        'version': __version__, 'commit': commit, 'time': datetime.datetime.now().isoformat(),
+        'python': platform.python_version(), 'torch': torch.__version__, 'numpy': np.__version__,
+        'platform': platform.platform(), 'processor': platform.processor(), 'cpu_count': os.cpu_count(),
+        'torch_threads': torch.get_num_threads()
+    }
+
+
+def report(result: Result) -> None:
+    """Print one result.
+
+    Args:
+        result: Result.
+
+    Return:
+        None
+    """
+    print(', '.join('%s=%.3f' % (key, value) if isinstance(value, float) else '%s=%s' % (key, value)
+                    for key, value in result.items() if key != 'stages'))
+
+
+def benchmark(args: argparse.Namespace) -> None:
+    """Run selected benchmarks and write results.
+
+    Args:
+        args: Arguments of command line.
+
+    Return:
+        None
+    """
+    os.makedirs(args.workdir, exist_ok=True)
+    rng: np.random.Generator = np.random.default_rng(args.seed)
+    images: Dict[int, bytes] = {n: make_image(n, rng) for n in args.faces}
+    results: List[Result] = []
+
+    def add(items: List[Result]) -> None:
+        for item in items:
+            report(item)
+        results.extend(items)
+
+    galleries: Dict[int, str] = {}
+    if 'matcher' in args.components or 'endpoint' in args.components:
+        for size in args.gallery_sizes:
+            start: float = time.perf_counter()
+            galleries[size] = make_gallery(args.workdir, size, args.faces_per_person, args.seed)
+            add([{'component': 'gallery', 'stage': 'generate', 'gallery_size': size,
+                  'seconds': time.perf_counter() - start}])
+    if 'matcher' in args.components:
+        for size, database_url in galleries.items():
+            for index in args.index:
+                add(bench_matcher(database_url, size, index, args.batch_sizes, args.repeats, args.noise, args.seed))
+    if 'detector' in args.components:
+        add(bench_detector(images, args.batch_sizes, args.repeats))
+    if 'extractor' in args.components:
+        for mode in args.modes:
+            add(bench_extractor(mode, args.batch_sizes, args.repeats))
+    if 'endpoint' in args.components:
+        size: int = min(galleries)
+        add(bench_endpoint(galleries[size], size, images, args.concurrency, args.requests, args.port,
+                           dict(item.split('=', 1) for item in args.env), args.startup_timeout))
+
+    with open(args.output, 'w') as f:
+        json.dump({'environment': environment(), 'arguments': vars(args), 'results': results}, f, indent=2)
+    print('saved %s' % args.output)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark suite of the recognition pipeline.')
+    parser.add_argument('--components', type=str, nargs='+', choices=['matcher', 'detector', 'extractor', 'endpoint'],
+                        default=['matcher', 'detector', 'extractor', 'endpoint'], help='Benchmarked components.')
+    parser.add_argument('--gallery-sizes', type=int, nargs='+', default=[10000, 100000],
+                        help='Numbers of faces in synthetic galleries.')
+    parser.add_argument('--faces-per-person', type=int, default=4, help='Number of faces of every person.')
+    parser.add_argument('--index', type=str, nargs='+', default=['flat'], choices=['flat', 'ivf'],
+                        help='Gallery indexes.')
+    parser.add_argument('--faces', type=int, nargs='+', default=[0, 1, 4, 8],
+                        help='Numbers of faces on synthetic images.')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 8, 32],
+                        help='Batch sizes of matcher, detector and extractor.')
+    parser.add_argument('--modes', type=str, nargs='+', default=['fp32'], choices=['fp32', 'script'],
+                        help='Inference modes of feature extractor.')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16], help='Numbers of concurrent clients.')
+    parser.add_argument('--requests', type=int, default=200, help='Number of requests for every concurrency.')
+    parser.add_argument('--repeats', type=int, default=20, help='Number of timed calls of components.')
+    parser.add_argument('--noise', type=float, default=0.05, help='Standard deviation of noise added to queries.')
+    parser.add_argument('--port', type=int, default=5055, help='Port of benchmarked microservice.')
+    parser.add_argument('--startup-timeout', type=float, default=600.0,
+                        help='Max time in seconds to wait for readiness of microservice.')
+    parser.add_argument('--env', type=str, nargs='*', default=[],
+                        help='Extra environment variables of microservice as NAME=VALUE.')
+    parser.add_argument('--workdir', type=str, default='benchmark', help='Directory of synthetic galleries.')
+    parser.add_argument('--output', type=str, default='benchmark.json', help='Path to JSON file with results.')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed.')
+    benchmark(parser.parse_args())
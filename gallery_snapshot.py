@@ -0,0 +1,149 @@
+# gallery_snapshot.py
+#
+# Copyright (C) 2021-2022  Дмитрий Кузнецов
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+This file contains the script to export and import the gallery snapshot.
+
+Workers started with the environment variable SNAPSHOT_PATH memory-map the
+snapshot and reload it when the snapshot is replaced. With --interval the
+script keeps running and replaces the snapshot after every database change.
+Workers started with SNAPSHOT_TOP_UP load the snapshot once and read only
+faces newer than the snapshot from the database. With --import faces of the
+snapshot are inserted into the database with the same IDs, e.g. to seed
+a new database.
+
+Note:
+    Set the environment variable DATABASE_URL to correct work of this script.
+
+Example:
+    >>> python gallery_snapshot.py path/to/gallery.snapshot --interval 10
+    >>> python gallery_snapshot.py path/to/gallery.snapshot --dtype float16
+    >>> python gallery_snapshot.py path/to/gallery.snapshot --import
+"""
+
+from FRMS.database import get_connection, encode_features, create_table, Face
+from FRMS.utils.gallery import Gallery, GalleryUpdate
+from FRMS.utils.snapshot import save_snapshot, load_snapshot
+from sqlalchemy import select, func, text
+from typing import Dict, List, Union
+from tqdm import tqdm
+import numpy as np
+import argparse
+import time
+
+
+def write_snapshot(path: str, interval: float, dtype: str = 'float32') -> None:
+    """Writes the gallery snapshot and optionally keeps it up to date.
+
+    Args:
+        path: The path to the snapshot file.
+        interval: Interval in seconds between database checks, 0 to write once.
+        dtype: Type of stored features, 'float32' or 'float16'.
+
+    Return:
+        None
+    """
+    session, _ = get_connection()
+    gallery: Gallery = Gallery()
+    with tqdm(unit='face') as progress:
+        gallery.load(session, progress=lambda count, total: report(progress, count, total))
+    session.close()
+    save_snapshot(gallery, path, dtype)
+    print('Snapshot of %d faces is written to %s.' % (len(gallery), path))
+
+    while interval > 0:
+        time.sleep(interval)
+        update: GalleryUpdate = gallery.fetch_update(session)
+        session.close()
+        if len(update.face_ids) == 0 and update.last_tombstone_id == gallery.last_tombstone_id:
+            continue
+        gallery.update(update)
+        gallery.compact()
+        save_snapshot(gallery, path, dtype)
+        print('Snapshot of %d faces is written to %s.' % (len(gallery), path))
+
+
+def report(progress: tqdm, count: int, total: int) -> None:
+    """Shows progress of gallery loading.
+
+    Args:
+        progress: Progress bar.
+        count: Number of loaded faces.
+        total: Total number of faces.
+
+    Return:
+        None
+    """
+    progress.total = total
+    progress.update(count - progress.n)
+
+
+def import_snapshot(path: str, chunk_size: int, dtype: str) -> None:
+    """Inserts faces of the gallery snapshot into the database.
+
+    Faces keep their IDs, faces with IDs not greater than the max face ID
+    in the database are skipped, so interrupted import continues when restarted.
+
+    Args:
+        path: The path to the snapshot file.
+        chunk_size: Number of faces inserted in one transaction.
+        dtype: Type of stored features, 'float32' or 'float16'.
+
+    Return:
+        None
+    """
+    gallery: Gallery = load_snapshot(path)
+    create_table()
+    _, engine = get_connection()
+    with engine.connect() as connection:
+        last_id: int = connection.execute(select(func.coalesce(func.max(Face.id), 0))).scalar()
+    rows: np.ndarray = np.flatnonzero(gallery.face_ids > last_id)
+
+    for start in tqdm(range(0, len(rows), chunk_size), unit='chunk'):
+        chunk: np.ndarray = rows[start:start + chunk_size]
+        values: List[Dict[str, Union[int, bytes]]] = [
+            {'id': face_id, 'features': encode_features(features, dtype), 'person_id': person_id}
+            for face_id, person_id, features in zip(gallery.face_ids[chunk].tolist(),
+                                                     gallery.person_ids[chunk].tolist(), gallery.features[chunk])
+        ]
+        with engine.begin() as connection:
+            connection.execute(Face.__table__.insert(), values)
+
+    if engine.dialect.name == 'postgresql':
+        with engine.begin() as connection:
+            connection.execute(text(
+                "SELECT setval(pg_get_serial_sequence('{0}', 'id'), COALESCE(MAX(id), 1)) FROM {0}".format(
+                    Face.__tablename__)
+            ))
+    print('%d faces of %s are imported.' % (len(rows), path))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Script to export and import the gallery snapshot.')
+    parser.add_argument('path', metavar='path/to/gallery.snapshot', type=str, help='The path to the snapshot file.')
+    parser.add_argument('--interval', type=float, default=0.0,
+                        help='Interval in seconds between database checks, 0 to write the snapshot once.')
+    parser.add_argument('--dtype', type=str, default='float32', choices=['float32', 'float16'],
+                        help='Type of features stored in the snapshot or, with --import, in the database.')
+    parser.add_argument('--import', dest='import_', action='store_true',
+                        help='Insert faces of the snapshot into the database instead of writing the snapshot.')
+    parser.add_argument('--chunk-size', type=int, default=10000,
+                        help='Number of faces inserted in one transaction by --import.')
+    args = parser.parse_args()
+    if args.import_:
+        import_snapshot(args.path, args.chunk_size, args.dtype)
+    else:
+        write_snapshot(args.path, args.interval, args.dtype)
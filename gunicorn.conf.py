@@ -0,0 +1,36 @@
+# gunicorn.conf.py
+#
+# Copyright (C) 2021-2022  Дмитрий Кузнецов
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Gunicorn hooks of microservice.
+
+Metrics files of previous run are removed on start and live gauges of
+exited workers are removed, when PROMETHEUS_MULTIPROC_DIR is set.
+
+Example:
+    >>> gunicorn main:app -c gunicorn.conf.py -w 4 -k uvicorn.workers.UvicornWorker
+"""
+
+from FRMS.metrics import clear_multiprocess_dir, mark_process_dead
+
+
+def on_starting(server) -> None:
+    """Remove metrics files of previous run before workers are started."""
+    clear_multiprocess_dir()
+
+
+def child_exit(server, worker) -> None:
+    """Remove live gauges of exited worker."""
+    mark_process_dead(worker.pid)
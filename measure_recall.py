@@ -0,0 +1,133 @@
+# measure_recall.py
+#
+# Copyright (C) 2021-2022  Дмитрий Кузнецов
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+This file contains the script to measure recall of the approximate IVF index.
+
+Queries are sampled from the faces table and slightly perturbed, results of
+the IVF index are compared with results of the exact flat index. Template
+indexes are compared with the exact index by persons of found faces.
+
+Note:
+    Set the environment variable DATABASE_URL to correct work of this script.
+
+Example:
+    >>> python measure_recall.py --nprobe 1 4 16 64 -k 10
+    >>> python measure_recall.py --templates 1 3 -k 1
+"""
+
+from FRMS.database import get_connection
+from FRMS.utils.gallery import Gallery
+from FRMS.utils.index import Index, FlatIndex, IVFIndex, TemplateIndex
+from typing import List, Tuple
+import numpy as np
+import argparse
+import time
+
+
+def search(index: Index, queries: np.ndarray, k: int, batch_size: int = 64) -> Tuple[np.ndarray, float]:
+    """Search queries by batches.
+
+    Args:
+        index: Built index.
+        queries: Matrix of queries.
+        k: Number of neighbours.
+        batch_size: Number of queries in batch.
+
+    Return:
+        Found gallery rows and mean latency per query in milliseconds.
+    """
+    rows: List[np.ndarray] = []
+    start: float = time.perf_counter()
+    for i in range(0, queries.shape[0], batch_size):
+        rows.append(index.search(queries[i:i + batch_size], k)[1])
+    elapsed: float = time.perf_counter() - start
+    return np.concatenate(rows), elapsed * 1000 / queries.shape[0]
+
+
+def measure_recall(nlist: int, nprobes: List[int], k: int, n_queries: int, noise: float, seed: int,
+                   templates: List[int], rerank: int) -> None:
+    """Print recall@k and latency of the IVF index for every nprobe and of template indexes.
+
+    Args:
+        nlist: Number of clusters, 0 to choose automatically.
+        nprobes: Numbers of scanned clusters.
+        k: Number of neighbours.
+        n_queries: Number of queries.
+        noise: Standard deviation of gaussian noise added to queries.
+        seed: Random seed.
+        templates: Numbers of templates of every person.
+        rerank: Number of nearest persons re-ranked by raw features.
+
+    Return:
+        None
+    """
+    session, _ = get_connection()
+    gallery: Gallery = Gallery()
+    gallery.load(session)
+    session.close()
+    if len(gallery) == 0:
+        print('The faces table is empty.')
+        return
+
+    rng: np.random.Generator = np.random.default_rng(seed)
+    rows: np.ndarray = rng.choice(len(gallery), min(n_queries, len(gallery)), replace=False)
+    queries: np.ndarray = gallery.features[rows] + rng.normal(0.0, noise, (len(rows), gallery.dim)).astype(np.float32)
+
+    exact: FlatIndex = FlatIndex()
+    exact.build(gallery)
+    exact_rows, exact_latency = search(exact, queries, k)
+    print('gallery size: %d, queries: %d' % (len(gallery), len(rows)))
+    print('flat: %.3f ms/query' % exact_latency)
+
+    ivf: IVFIndex = IVFIndex(nlist=nlist or None)
+    start: float = time.perf_counter()
+    ivf.build(gallery)
+    print('ivf build: %.1f s' % (time.perf_counter() - start))
+    for nprobe in nprobes:
+        ivf.nprobe = nprobe
+        ivf_rows, ivf_latency = search(ivf, queries, k)
+        hits: int = sum(len(np.intersect1d(a[a >= 0], b[b >= 0])) for a, b in zip(exact_rows, ivf_rows))
+        total: int = int((exact_rows >= 0).sum())
+        print('ivf nprobe=%d: recall@%d %.4f, %.3f ms/query' % (nprobe, k, hits / total, ivf_latency))
+
+    exact_persons: np.ndarray = np.where(exact_rows >= 0, gallery.person_ids[np.maximum(exact_rows, 0)], -1)
+    for n_templates in templates:
+        index: TemplateIndex = TemplateIndex(n_templates=n_templates, rerank=rerank)
+        index.build(gallery)
+        template_rows, template_latency = search(index, queries, k)
+        persons: np.ndarray = np.where(template_rows >= 0, gallery.person_ids[np.maximum(template_rows, 0)], -1)
+        hits: int = sum(len(np.intersect1d(a[a >= 0], b[b >= 0])) for a, b in zip(exact_persons, persons))
+        total: int = sum(len(np.unique(a[a >= 0])) for a in exact_persons)
+        print('templates=%d (%d vectors): person recall@%d %.4f, %.3f ms/query'
+              % (n_templates, len(index.templates), k, hits / total, template_latency))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Script to measure recall of the IVF index against the exact index.')
+    parser.add_argument('--nlist', type=int, default=0, help='Number of clusters, 0 to choose automatically.')
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[1, 4, 8, 16, 32],
+                        help='Numbers of scanned clusters.')
+    parser.add_argument('-k', type=int, default=10, help='Number of neighbours.')
+    parser.add_argument('--queries', type=int, default=1000, help='Number of queries.')
+    parser.add_argument('--noise', type=float, default=0.05,
+                        help='Standard deviation of gaussian noise added to queries.')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed.')
+    parser.add_argument('--templates', type=int, nargs='*', default=[],
+                        help='Numbers of templates of every person to measure template indexes.')
+    parser.add_argument('--rerank', type=int, default=16, help='Number of nearest persons re-ranked by raw features.')
+    args = parser.parse_args()
+    measure_recall(args.nlist, args.nprobe, args.k, args.queries, args.noise, args.seed, args.templates, args.rerank)
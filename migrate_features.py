@@ -0,0 +1,184 @@
+# migrate_features.py
+#
+# Copyright (C) 2021-2022  Дмитрий Кузнецов
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+This file contains the script to migrate the faces table from pickled features to binary features.
+
+Rows are copied by chunks into the new table with the same IDs, then the old
+table is locked for writers, rows inserted during the copy are copied and
+the old table is renamed to 'faces_pickle' and the new table is renamed to
+'faces' in the same transaction. MySQL commits before RENAME TABLE, so on
+MySQL tables are unlocked after the copy and swapped by one RENAME TABLE,
+rows inserted between the two statements are left in 'faces_pickle' and
+reported. Interrupted migration continues from the last copied ID when restarted.
+
+Note:
+    Set the environment variable DATABASE_URL to correct work of this script.
+    Only migration of SQLite database has been tested, PostgreSQL and MySQL
+    statements are written by their documentation.
+
+Example:
+    >>> python migrate_features.py --chunk-size 10000 --dtype float16
+"""
+
+from FRMS.database import get_connection, encode_features, Face
+from sqlalchemy import Table, MetaData, Column, Integer, PickleType, LargeBinary, select, func, text
+from sqlalchemy.engine import Connection, Engine
+from typing import Dict, List, Tuple, Union
+from tqdm import tqdm
+import argparse
+
+OLD_TABLE: str = 'faces_pickle'
+NEW_TABLE: str = 'faces_binary'
+
+
+def migrate_features(chunk_size: int, dtype: str) -> None:
+    """Migrates the faces table to binary features.
+
+    Args:
+        chunk_size: Number of rows copied in one transaction.
+        dtype: Type of stored features, 'float32' or 'float16'.
+
+    Return:
+        None
+    """
+    _, engine = get_connection()
+    metadata: MetaData = MetaData()
+    source: Table = Table(Face.__tablename__, metadata,
+                          Column('id', Integer, primary_key=True),
+                          Column('features', PickleType),
+                          Column('person_id', Integer))
+    target: Table = Table(NEW_TABLE, metadata,
+                          Column('id', Integer, primary_key=True, autoincrement=True),
+                          Column('features', LargeBinary),
+                          Column('person_id', Integer))
+    target.create(engine, checkfirst=True)
+
+    with engine.connect() as connection:
+        last_id: int = connection.execute(select(func.coalesce(func.max(target.c.id), 0))).scalar()
+        total: int = connection.execute(select(func.count()).select_from(source).where(source.c.id > last_id)).scalar()
+
+    with tqdm(total=total) as progress:
+        while True:
+            with engine.begin() as connection:
+                count, last_id = copy_rows(connection, source, target, last_id, dtype, chunk_size)
+            if count == 0:
+                break
+            progress.update(count)
+
+    swap_tables(engine, source, target, last_id, dtype, chunk_size)
+
+
+def copy_rows(connection: Connection, source: Table, target: Table, last_id: int, dtype: str,
+              chunk_size: int) -> Tuple[int, int]:
+    """Copies chunk of rows with IDs greater than given ID to the new table.
+
+    Args:
+        connection: Database connection in transaction.
+        source: Table with pickled features.
+        target: Table with binary features.
+        last_id: ID of the last copied row.
+        dtype: Type of stored features, 'float32' or 'float16'.
+        chunk_size: Max number of copied rows.
+
+    Return:
+        Number of copied rows and ID of the last copied row.
+    """
+    rows = connection.execute(
+        select(source).where(source.c.id > last_id).order_by(source.c.id).limit(chunk_size)
+    ).fetchall()
+    if not rows:
+        return 0, last_id
+    values: List[Dict[str, Union[int, bytes]]] = [
+        {'id': row.id, 'features': encode_features(row.features, dtype), 'person_id': row.person_id}
+        for row in rows
+    ]
+    connection.execute(target.insert(), values)
+    return len(rows), rows[-1].id
+
+
+def lock_source(connection: Connection) -> None:
+    """Locks the faces table for writers until the end of transaction.
+
+    Readers are not blocked on PostgreSQL. SQLite locks the whole
+    database for writers on the first write of transaction.
+
+    Args:
+        connection: Database connection in transaction.
+
+    Return:
+        None
+    """
+    dialect: str = connection.engine.dialect.name
+    if dialect == 'postgresql':
+        connection.execute(text('LOCK TABLE %s IN EXCLUSIVE MODE' % Face.__tablename__))
+    elif dialect == 'mysql':
+        connection.execute(text('LOCK TABLES %s WRITE, %s WRITE' % (Face.__tablename__, NEW_TABLE)))
+    else:
+        connection.execute(text('UPDATE %s SET id = id WHERE id < 0' % Face.__tablename__))
+
+
+def swap_tables(engine: Engine, source: Table, target: Table, last_id: int, dtype: str, chunk_size: int) -> None:
+    """Copies rows inserted during migration and renames migrated table to 'faces'.
+
+    Old table is locked for writers, so no row inserted by concurrent
+    writer (e.g. add_faces.py) is left in the old table, which is kept as backup.
+    On MySQL, rows inserted between unlock and rename are left in the old table.
+
+    Args:
+        engine: Database engine.
+        source: Table with pickled features.
+        target: Table with binary features.
+        last_id: ID of the last copied row.
+        dtype: Type of stored features, 'float32' or 'float16'.
+        chunk_size: Number of rows copied at once.
+
+    Return:
+        None
+    """
+    with engine.begin() as connection:
+        lock_source(connection)
+        count: int = 1
+        while count > 0:
+            count, last_id = copy_rows(connection, source, target, last_id, dtype, chunk_size)
+        if engine.dialect.name == 'mysql':
+            connection.execute(text('UNLOCK TABLES'))
+        else:
+            connection.execute(text('ALTER TABLE %s RENAME TO %s' % (Face.__tablename__, OLD_TABLE)))
+            connection.execute(text('ALTER TABLE %s RENAME TO %s' % (NEW_TABLE, Face.__tablename__)))
+        if engine.dialect.name == 'postgresql':
+            connection.execute(text(
+                "SELECT setval(pg_get_serial_sequence('{0}', 'id'), COALESCE(MAX(id), 1)) FROM {0}".format(
+                    Face.__tablename__)
+            ))
+    if engine.dialect.name == 'mysql':
+        with engine.begin() as connection:
+            connection.execute(text('RENAME TABLE {0} TO {1}, {2} TO {0}'.format(
+                Face.__tablename__, OLD_TABLE, NEW_TABLE)))
+            late: int = connection.execute(text('SELECT COUNT(*) FROM %s WHERE id > :last_id' % OLD_TABLE),
+                                           {'last_id': last_id}).scalar()
+        if late > 0:
+            print('%d rows inserted before rename are left in %s.' % (late, OLD_TABLE))
+    print('Table %s is renamed to %s.' % (Face.__tablename__, OLD_TABLE))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Script to migrate the faces table to binary features.')
+    parser.add_argument('--chunk-size', type=int, default=10000, help='Number of rows copied in one transaction.')
+    parser.add_argument('--dtype', type=str, default='float32', choices=['float32', 'float16'],
+                        help='Type of stored features.')
+    args = parser.parse_args()
+    migrate_features(args.chunk_size, args.dtype)
@@ -10,5 +10,5 @@ setup(
     author='Dmitry Kuznetsov',
     author_email='DKuznetsov2000@outlook.com',
     description='Microservice for face recognition',
-    install_requires=['fastapi', 'torch', 'torchvision', 'facenet_pytorch', 'SQLAlchemy', 'psycopg2-binary', 'mysqlclient', 'uvicorn']
+    install_requires=['fastapi', 'numpy', 'torch', 'torchvision', 'facenet_pytorch', 'SQLAlchemy', 'psycopg2-binary', 'mysqlclient', 'python-multipart', 'uvicorn', 'websockets', 'prometheus-client']
 )
@@ -0,0 +1,62 @@
+# tests/test_cache.py
+#
+# Copyright (C) 2021-2022  Дмитрий Кузнецов
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Tests of ResultCache and image_key."""
+
+from FRMS.utils.cache import ResultCache, image_key
+
+
+def test_get_returns_copy_of_cached_value():
+    cache: ResultCache = ResultCache(max_size=2)
+    assert cache.get('a', 1) is None
+    cache.put('a', [{'id': 1}], 1)
+    value: list = cache.get('a', 1)
+    value[0]['id'] = 2
+    assert cache.get('a', 1) == [{'id': 1}]
+    assert cache.hits == 2
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache: ResultCache = ResultCache(max_size=2)
+    cache.get('a', 1)
+    for key in 'abc':
+        cache.put(key, key, 1)
+    assert cache.get('a', 1) is None
+    assert cache.get('c', 1) == 'c'
+
+
+def test_cache_is_cleared_when_version_decreases():
+    cache: ResultCache = ResultCache()
+    cache.get('a', ((0, 5, 10), (1, 3, 10)))
+    cache.put('a', 'old', ((0, 5, 10), (1, 3, 10)))
+    restarted: tuple = ((0, 1, 10), (1, 3, 10))
+    assert cache.get('a', restarted) is None
+    cache.put('a', 'new', restarted)
+    assert cache.get('a', restarted) == 'new'
+
+
+def test_value_of_outdated_version_is_not_cached():
+    cache: ResultCache = ResultCache()
+    cache.get('a', 1)
+    cache.get('b', 2)
+    cache.put('a', 'old', 1)
+    assert cache.get('a', 2) is None
+
+
+def test_image_key_depends_on_threshold_and_k():
+    assert image_key(b'image', 1.0) == image_key(b'image', 1.0)
+    assert image_key(b'image', 1.0) != image_key(b'image', 0.5)
+    assert image_key(b'image', 1.0) != image_key(b'image', 1.0, 3)
@@ -0,0 +1,59 @@
+# tests/test_feature_matcher.py
+#
+# Copyright (C) 2021-2022  Дмитрий Кузнецов
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Tests of FeatureMatcher on temporary SQLite database."""
+
+from FRMS.database import Face, create_table, get_connection
+from FRMS.utils.feature_matcher import FeatureMatcher
+from FRMS.utils.index import TemplateIndex
+import numpy as np
+import pytest
+import torch
+
+
+@pytest.fixture
+def query(tmp_path, monkeypatch) -> torch.Tensor:
+    """Database where person 0 owns 12 near-duplicate faces nearest to the query."""
+    database_url: str = 'sqlite:///%s' % (tmp_path / 'faces.db')
+    monkeypatch.setenv('DATABASE_URL', database_url)
+    create_table(database_url)
+    rng: np.random.Generator = np.random.default_rng(0)
+    query: np.ndarray = rng.normal(size=512).astype(np.float32)
+    session, _ = get_connection()
+    for _ in range(12):
+        session.add(Face(torch.from_numpy(query + rng.normal(0, 0.01, 512).astype(np.float32)), 0))
+    for person_id in range(1, 6):
+        session.add(Face(torch.from_numpy(query + rng.normal(0, 0.5, 512).astype(np.float32)), person_id))
+    session.commit()
+    session.close()
+    return torch.from_numpy(query)
+
+
+@pytest.mark.parametrize('index', [None, TemplateIndex(n_templates=3, rerank=1)])
+def test_candidates_are_k_distinct_persons(query, index):
+    matcher: FeatureMatcher = FeatureMatcher(max_distance=1.0, index=index)
+    answer: dict = matcher.match_features_batch(query.unsqueeze(0), k=2)[0]
+    assert answer['id'] == 0
+    assert [candidate['id'] for candidate in answer['candidates']][0] == 0
+    assert len(answer['candidates']) == 2
+
+
+def test_candidates_stop_when_gallery_is_exhausted(query):
+    matcher: FeatureMatcher = FeatureMatcher(max_distance=1.0)
+    answer: dict = matcher.match_features_batch(query.unsqueeze(0), k=10)[0]
+    assert sorted(candidate['id'] for candidate in answer['candidates']) == list(range(6))
+    distances: list = [candidate['distance'] for candidate in answer['candidates']]
+    assert distances == sorted(distances)
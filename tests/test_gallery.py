@@ -0,0 +1,124 @@
+# tests/test_gallery.py
+#
+# Copyright (C) 2021-2022  Дмитрий Кузнецов
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Tests of Gallery and of incremental gallery updates of FeatureMatcher."""
+
+from FRMS.database import Face, create_table, delete_faces, get_connection
+from FRMS.utils.feature_matcher import FeatureMatcher, MatcherState
+from FRMS.utils.gallery import Gallery, GalleryUpdate
+import numpy as np
+import torch
+import copy
+
+
+def make_gallery(count: int, dim: int = 8) -> Gallery:
+    gallery: Gallery = Gallery(dim)
+    features: np.ndarray = np.random.default_rng(0).normal(size=(count, dim)).astype(np.float32)
+    gallery.append(np.arange(1, count + 1), np.arange(count) // 2, features)
+    return gallery
+
+
+def test_append_grows_capacity_and_keeps_rows():
+    gallery: Gallery = make_gallery(3)
+    gallery.append(np.array([4, 5]), np.array([7, 7]), np.ones((2, 8), dtype=np.float32))
+    assert len(gallery) == 5
+    assert gallery.last_face_id == 5
+    assert gallery.face_ids.tolist() == [1, 2, 3, 4, 5]
+    assert np.allclose(gallery.sq_norms[3:], 8.0)
+
+
+def test_remove_marks_rows_once():
+    gallery: Gallery = make_gallery(4)
+    assert gallery.remove(np.array([2, 4, 9])) == 2
+    assert gallery.remove(np.array([2])) == 0
+    assert gallery.removed == 2
+    assert np.isinf(gallery.sq_norms[[1, 3]]).all()
+
+
+def test_compact_of_copy_keeps_original():
+    gallery: Gallery = make_gallery(4)
+    gallery.remove(np.array([1, 3]))
+    compacted: Gallery = copy.copy(gallery)
+    compacted.compact()
+    assert compacted.face_ids.tolist() == [2, 4]
+    assert compacted.removed == 0
+    assert gallery.face_ids.tolist() == [1, 2, 3, 4]
+    assert gallery.removed == 2
+
+
+def test_update_of_copy_keeps_original():
+    gallery: Gallery = make_gallery(4)
+    updated: Gallery = copy.copy(gallery)
+    updated.update(GalleryUpdate(np.array([5]), np.array([5]), np.zeros((1, 8), dtype=np.float32),
+                                 np.array([1]), 10))
+    assert len(gallery) == 4
+    assert np.isfinite(gallery.sq_norms).all()
+    assert len(updated) == 5
+    assert np.isinf(updated.sq_norms[0])
+
+
+def test_update_appends_removes_and_moves_tombstone():
+    gallery: Gallery = make_gallery(2)
+    gallery.update(GalleryUpdate(np.array([3]), np.array([5]), np.zeros((1, 8), dtype=np.float32),
+                                 np.array([1]), 10))
+    assert len(gallery) == 3
+    assert gallery.removed == 1
+    assert gallery.last_tombstone_id == 10
+
+
+def test_sync_compacts_gallery_and_rebuilds_index(tmp_path, monkeypatch):
+    database_url: str = 'sqlite:///%s' % (tmp_path / 'faces.db')
+    monkeypatch.setenv('DATABASE_URL', database_url)
+    create_table(database_url)
+    features: np.ndarray = np.random.default_rng(0).normal(size=(8, 512)).astype(np.float32)
+    session, _ = get_connection()
+    session.add_all([Face(torch.from_numpy(vector), person_id) for person_id, vector in enumerate(features)])
+    session.commit()
+
+    matcher: FeatureMatcher = FeatureMatcher(max_distance=0.1, compact_ratio=0.25)
+    delete_faces(session, [1, 2, 3])
+    session.add(Face(torch.from_numpy(features[0]), 100))
+    session.commit()
+    session.close()
+    matcher.sync_gallery()
+
+    assert matcher.gallery.removed == 0
+    assert matcher.gallery.face_ids.tolist() == [4, 5, 6, 7, 8, 9]
+    assert [answer['id'] for answer in matcher.match_features_batch(torch.from_numpy(features[:4]))] == \
+        [100, None, None, 3]
+
+
+def test_sync_keeps_state_taken_by_search(tmp_path, monkeypatch):
+    database_url: str = 'sqlite:///%s' % (tmp_path / 'faces.db')
+    monkeypatch.setenv('DATABASE_URL', database_url)
+    create_table(database_url)
+    features: np.ndarray = np.random.default_rng(0).normal(size=(8, 512)).astype(np.float32)
+    session, _ = get_connection()
+    session.add_all([Face(torch.from_numpy(vector), person_id) for person_id, vector in enumerate(features)])
+    session.commit()
+
+    matcher: FeatureMatcher = FeatureMatcher(max_distance=0.1, compact_ratio=0.5)
+    state: MatcherState = matcher.state
+    delete_faces(session, [1])
+    session.add(Face(torch.from_numpy(features[0]), 100))
+    session.commit()
+    session.close()
+    matcher.sync_gallery()
+
+    assert matcher.version == state.version + 1
+    assert len(state.gallery) == 8 and np.isfinite(state.gallery.sq_norms).all()
+    assert state.index.search(features[:2], 1)[1][:, 0].tolist() == [0, 1]
+    assert [answer['id'] for answer in matcher.match_features_batch(torch.from_numpy(features[:2]))] == [100, 1]
@@ -0,0 +1,98 @@
+# tests/test_index.py
+#
+# Copyright (C) 2021-2022  Дмитрий Кузнецов
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Tests of gallery indexes against exact search."""
+
+from FRMS.utils.gallery import Gallery
+from FRMS.utils.index import FlatIndex, IVFIndex, TemplateIndex, Index
+import numpy as np
+import pytest
+import copy
+
+
+def make_gallery(count: int, persons: int, dim: int = 16, seed: int = 0) -> Gallery:
+    rng: np.random.Generator = np.random.default_rng(seed)
+    person_ids: np.ndarray = rng.integers(0, persons, count)
+    centers: np.ndarray = rng.normal(size=(persons, dim)).astype(np.float32)
+    features: np.ndarray = centers[person_ids] + rng.normal(0, 0.1, (count, dim)).astype(np.float32)
+    gallery: Gallery = Gallery(dim)
+    gallery.append(np.arange(1, count + 1), person_ids, features)
+    return gallery
+
+
+def exact(gallery: Gallery, queries: np.ndarray, k: int) -> np.ndarray:
+    sq_dists: np.ndarray = ((queries[:, np.newaxis, :] - gallery.features[np.newaxis, :, :]) ** 2).sum(axis=2)
+    sq_dists[:, ~np.isfinite(gallery.sq_norms)] = np.inf
+    return np.argsort(sq_dists, axis=1, kind='stable')[:, :k]
+
+
+def test_flat_index_is_exact_and_skips_removed_rows():
+    gallery: Gallery = make_gallery(200, 20)
+    gallery.remove(gallery.face_ids[:50])
+    index: FlatIndex = FlatIndex()
+    index.build(gallery)
+    queries: np.ndarray = gallery.features[:60]
+    distances, rows = index.search(queries, 5)
+    assert (rows == exact(gallery, queries, 5)).all()
+    assert (rows >= 50).all()
+    assert (np.diff(distances, axis=1) >= 0).all()
+
+
+def test_missing_neighbours_have_row_minus_one():
+    gallery: Gallery = make_gallery(3, 1)
+    index: FlatIndex = FlatIndex()
+    index.build(gallery)
+    distances, rows = index.search(gallery.features[:1], 5)
+    assert rows[0, 3:].tolist() == [-1, -1]
+    assert np.isinf(distances[0, 3:]).all()
+
+
+def test_ivf_index_scanning_all_lists_is_exact_after_add():
+    gallery: Gallery = make_gallery(300, 30)
+    index: IVFIndex = IVFIndex(nlist=8, nprobe=8)
+    index.build(gallery)
+    extra: Gallery = make_gallery(50, 30, seed=1)
+    gallery.append(extra.face_ids + 300, extra.person_ids, extra.features)
+    index.add(gallery, 300)
+    queries: np.ndarray = gallery.features[::7]
+    assert (index.search(queries, 3)[1] == exact(gallery, queries, 3)).all()
+
+
+@pytest.mark.parametrize('index', [TemplateIndex(n_templates=1, rerank=30), TemplateIndex(n_templates=3, rerank=30)])
+def test_template_index_reranking_all_persons_is_exact(index: Index):
+    gallery: Gallery = make_gallery(300, 30)
+    index.build(gallery)
+    extra: Gallery = make_gallery(20, 30, seed=1)
+    gallery.append(extra.face_ids + 300, extra.person_ids, extra.features)
+    index.add(gallery, 300)
+    queries: np.ndarray = gallery.features[::7]
+    assert (index.search(queries, 4)[1] == exact(gallery, queries, 4)).all()
+
+
+@pytest.mark.parametrize('index', [FlatIndex(), IVFIndex(nlist=8, nprobe=8), TemplateIndex(n_templates=3, rerank=30)])
+def test_add_to_copy_keeps_original(index: Index):
+    gallery: Gallery = make_gallery(300, 30)
+    index.build(gallery)
+    queries: np.ndarray = gallery.features[::7]
+    rows: np.ndarray = index.search(queries, 4)[1]
+    extra: Gallery = make_gallery(50, 30, seed=1)
+    updated: Gallery = copy.copy(gallery)
+    updated.append(extra.face_ids + 300, extra.person_ids, extra.features)
+    updated.remove(updated.face_ids[:10])
+    updated_index: Index = copy.copy(index)
+    updated_index.add(updated, 300)
+    assert (index.search(queries, 4)[1] == rows).all()
+    assert (updated_index.search(queries, 4)[1] == exact(updated, queries, 4)).all()
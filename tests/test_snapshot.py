@@ -0,0 +1,91 @@
+# tests/test_snapshot.py
+#
+# Copyright (C) 2021-2022  Дмитрий Кузнецов
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Tests of saving and loading of gallery snapshots."""
+
+from FRMS.utils.gallery import Gallery
+from FRMS.utils.snapshot import load_snapshot, save_snapshot
+import numpy as np
+import pytest
+
+
+def make_gallery(count: int, dim: int = 8) -> Gallery:
+    gallery: Gallery = Gallery(dim)
+    features: np.ndarray = np.random.default_rng(0).normal(size=(count, dim)).astype(np.float32)
+    gallery.append(np.arange(1, count + 1), np.arange(count) // 2, features)
+    gallery.last_tombstone_id = 3
+    return gallery
+
+
+def test_float32_snapshot_round_trip(tmp_path):
+    gallery: Gallery = make_gallery(6)
+    path: str = str(tmp_path / 'gallery.snapshot')
+    save_snapshot(gallery, path)
+    loaded: Gallery = load_snapshot(path)
+    assert len(loaded) == 6
+    assert loaded.last_face_id == 6
+    assert loaded.last_tombstone_id == 3
+    assert loaded.face_ids.tolist() == gallery.face_ids.tolist()
+    assert loaded.person_ids.tolist() == gallery.person_ids.tolist()
+    assert np.array_equal(loaded.features, gallery.features)
+    assert np.array_equal(loaded.sq_norms, gallery.sq_norms)
+
+
+def test_float16_snapshot_restores_float32_features(tmp_path):
+    gallery: Gallery = make_gallery(6)
+    path: str = str(tmp_path / 'gallery.snapshot')
+    save_snapshot(gallery, path, dtype='float16')
+    loaded: Gallery = load_snapshot(path)
+    assert loaded.features.dtype == np.float32
+    assert np.allclose(loaded.features, gallery.features, atol=1e-2)
+    assert np.allclose(loaded.sq_norms, np.einsum('ij,ij->i', loaded.features, loaded.features))
+
+
+def test_removed_rows_are_not_saved(tmp_path):
+    gallery: Gallery = make_gallery(6)
+    gallery.remove(np.array([2, 5]))
+    path: str = str(tmp_path / 'gallery.snapshot')
+    save_snapshot(gallery, path)
+    loaded: Gallery = load_snapshot(path)
+    assert loaded.face_ids.tolist() == [1, 3, 4, 6]
+    assert loaded.removed == 0
+    assert loaded.last_face_id == 6
+
+
+def test_empty_gallery_round_trip(tmp_path):
+    path: str = str(tmp_path / 'gallery.snapshot')
+    save_snapshot(Gallery(8), path)
+    loaded: Gallery = load_snapshot(path)
+    assert len(loaded) == 0
+    assert loaded.dim == 8
+
+
+def test_corrupt_snapshot_is_rejected(tmp_path):
+    path: str = str(tmp_path / 'gallery.snapshot')
+    save_snapshot(make_gallery(6), path)
+    with open(path, 'r+b') as f:
+        f.seek(-1, 2)
+        byte: bytes = f.read(1)
+        f.seek(-1, 2)
+        f.write(bytes([byte[0] ^ 0xFF]))
+    with pytest.raises(ValueError, match='Checksum'):
+        load_snapshot(path)
+    load_snapshot(path, verify=False)
+
+
+def test_unsupported_dtype_is_rejected(tmp_path):
+    with pytest.raises(ValueError):
+        save_snapshot(make_gallery(2), str(tmp_path / 'gallery.snapshot'), dtype='float64')
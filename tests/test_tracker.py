@@ -0,0 +1,56 @@
+# tests/test_tracker.py
+#
+# Copyright (C) 2021-2022  Дмитрий Кузнецов
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Tests of FaceTracker and iou."""
+
+from FRMS.utils.tracker import FaceTracker, Track, iou
+from typing import List
+import numpy as np
+
+
+def test_iou_of_same_and_disjoint_boxes():
+    boxes: np.ndarray = np.array([[0, 0, 10, 10], [20, 20, 30, 30]], dtype=np.float32)
+    assert np.allclose(iou(boxes, boxes), np.eye(2))
+    assert np.isclose(iou(boxes[:1], np.array([[5, 0, 15, 10]], dtype=np.float32))[0, 0], 1 / 3)
+
+
+def test_recognized_track_is_kept_until_refresh():
+    tracker: FaceTracker = FaceTracker(refresh_interval=3)
+    tracks: List[Track] = tracker.update([[0, 0, 100, 100]])
+    assert tracks[0].stale
+    tracks[0].recognized(7)
+    for _ in range(2):
+        tracks = tracker.update([[2, 2, 102, 102]])
+        assert not tracks[0].stale
+        assert tracks[0].person_id == 7
+    assert tracker.update([[2, 2, 102, 102]])[0].stale
+
+
+def test_moved_face_becomes_stale_and_new_face_gets_new_track():
+    tracker: FaceTracker = FaceTracker()
+    tracker.update([[0, 0, 100, 100]])[0].recognized(1)
+    moved, new = tracker.update([[30, 0, 130, 100], [500, 500, 600, 600]])
+    assert moved.track_id == 0 and moved.stale
+    assert new.track_id == 1 and new.stale
+
+
+def test_missed_track_is_dropped():
+    tracker: FaceTracker = FaceTracker(max_missed=1)
+    tracker.update([[0, 0, 100, 100]])
+    tracker.update([])
+    assert len(tracker.tracks) == 1
+    tracker.update([])
+    assert tracker.tracks == []
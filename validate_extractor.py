@@ -0,0 +1,182 @@
+# validate_extractor.py
+#
+# Copyright (C) 2021-2022  Дмитрий Кузнецов
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+This file contains the script to validate optimized inference mode of the feature extractor.
+
+Faces are sampled from the dataset directory, their features are extracted by the
+float32 model and by the optimized model. The script reports drift of features,
+agreement of top-1 matches in the gallery and throughput of both models.
+Optimized model may be saved to use it in microservice with EMBED_MODEL.
+
+Note:
+    Set the environment variable DATABASE_URL to correct work of this script.
+
+Example:
+    >>> python validate_extractor.py ./dataset --mode int8 --samples 512 --output resnet-int8.pt
+"""
+
+from FRMS.database import get_connection
+from FRMS.dataset import FacesDataset
+from FRMS.utils.feature_extractor import FeatureExtractor, optimize_model
+from FRMS.utils.gallery import Gallery
+from FRMS.utils.index import FlatIndex
+from FRMS.config import THRESHOLD
+from typing import List, Optional, Tuple
+import numpy as np
+import argparse
+import torch
+import sys
+import copy
+import time
+
+
+def load_faces(path: str, n_faces: int, seed: int) -> torch.Tensor:
+    """Load randomly sampled faces from dataset.
+
+    Args:
+        path: Dataset root directory.
+        n_faces: Number of faces.
+        seed: Random seed.
+
+    Return:
+        Tensor of face images with shape (N, 3, 160, 160).
+    """
+    dataset: FacesDataset = FacesDataset(path)
+    rng: np.random.Generator = np.random.default_rng(seed)
+    faces: List[torch.Tensor] = []
+    for item in rng.permutation(len(dataset)):
+        face: Optional[torch.Tensor] = dataset.get_face(int(item))
+        if face is not None:
+            faces.append(face)
+        if len(faces) == n_faces:
+            break
+    return torch.stack(faces) if faces else torch.empty((0, 3, 160, 160))
+
+
+def extract(model: torch.nn.Module, faces: torch.Tensor, batch_size: int) -> Tuple[np.ndarray, float]:
+    """Extract features by batches.
+
+    Args:
+        model: Feature extraction model.
+        faces: Tensor of face images.
+        batch_size: Number of faces in batch.
+
+    Return:
+        Matrix of features and throughput in faces per second.
+    """
+    features: List[torch.Tensor] = []
+    with torch.inference_mode():
+        model(faces[:batch_size])
+        start: float = time.perf_counter()
+        for i in range(0, faces.shape[0], batch_size):
+            features.append(model(faces[i:i + batch_size]))
+        elapsed: float = time.perf_counter() - start
+    return torch.cat(features).numpy().astype(np.float32), faces.shape[0] / elapsed
+
+
+def match(gallery: Gallery, index: FlatIndex, features: np.ndarray) -> np.ndarray:
+    """Find the nearest person of every features vector.
+
+    Args:
+        gallery: Gallery of faces.
+        index: Built index of gallery.
+        features: Matrix of features.
+
+    Return:
+        Person IDs, -1 if the nearest face is farther than THRESHOLD.
+    """
+    distances, rows = index.search(features, 1)
+    person_ids: np.ndarray = np.where(rows[:, 0] >= 0, gallery.person_ids[rows[:, 0]], -1)
+    return np.where(distances[:, 0] <= THRESHOLD, person_ids, -1)
+
+
+def validate(path: str, mode: str, n_samples: int, n_calibration: int, batch_size: int,
+             output: str, seed: int) -> None:
+    """Print drift, top-1 agreement and throughput of the optimized model.
+
+    Calibration and validation faces are disjoint, script exits if
+    dataset has fewer faces than both sets need.
+
+    Args:
+        path: Dataset root directory.
+        mode: Inference mode, 'script' or 'int8'.
+        n_samples: Number of validation faces.
+        n_calibration: Number of calibration faces for int8 mode.
+        batch_size: Number of faces in batch.
+        output: Path to save optimized TorchScript model, empty to not save.
+        seed: Random seed.
+
+    Return:
+        None
+    """
+    n_calibration = n_calibration if mode == 'int8' else 0
+    if n_samples < 1 or (mode == 'int8' and n_calibration < 1):
+        sys.exit('Number of validation faces and of calibration faces for int8 mode must be positive.')
+    faces: torch.Tensor = load_faces(path, n_calibration + n_samples, seed)
+    if faces.shape[0] < n_calibration + n_samples:
+        sys.exit('Found %d faces in %s, %d validation and %d calibration faces are needed.' % (
+            faces.shape[0], path, n_samples, n_calibration))
+    calibration, faces = faces[:n_calibration], faces[n_calibration:]
+
+    reference: torch.nn.Module = FeatureExtractor().model.cpu()
+    start: float = time.perf_counter()
+    optimized: torch.nn.Module = optimize_model(copy.deepcopy(reference), mode, calibration, batch_size)
+    print('faces: %d, calibration faces: %d' % (faces.shape[0], calibration.shape[0]))
+    print('%s build: %.1f s' % (mode, time.perf_counter() - start))
+
+    if output:
+        torch.jit.save(optimized, output)
+        print('saved %s' % output)
+    if mode == 'script':
+        with torch.inference_mode():
+            optimized = torch.jit.optimize_for_inference(optimized)
+
+    expected, reference_speed = extract(reference, faces, batch_size)
+    actual, optimized_speed = extract(optimized, faces, batch_size)
+    drift: np.ndarray = np.linalg.norm(actual - expected, axis=1)
+    cosine: np.ndarray = (actual * expected).sum(axis=1) / np.maximum(
+        np.linalg.norm(actual, axis=1) * np.linalg.norm(expected, axis=1), 1e-12
+    )
+    print('fp32: %.1f faces/s, %s: %.1f faces/s, speedup %.2fx' %
+          (reference_speed, mode, optimized_speed, optimized_speed / reference_speed))
+    print('L2 drift: mean %.4f, p99 %.4f, max %.4f' % (drift.mean(), np.percentile(drift, 99), drift.max()))
+    print('cosine similarity: mean %.5f, min %.5f' % (cosine.mean(), cosine.min()))
+
+    session, _ = get_connection()
+    gallery: Gallery = Gallery()
+    gallery.load(session)
+    session.close()
+    if len(gallery) == 0:
+        print('The faces table is empty, top-1 agreement is not measured.')
+    else:
+        index: FlatIndex = FlatIndex()
+        index.build(gallery)
+        agreement: float = float((match(gallery, index, expected) == match(gallery, index, actual)).mean())
+        print('gallery size: %d, top-1 agreement: %.4f' % (len(gallery), agreement))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Script to validate optimized inference mode of feature extractor.')
+    parser.add_argument('path', type=str, help='Path to dataset.')
+    parser.add_argument('--mode', type=str, default='int8', choices=['script', 'int8'], help='Inference mode.')
+    parser.add_argument('--samples', type=int, default=512, help='Number of validation faces.')
+    parser.add_argument('--calibration', type=int, default=128, help='Number of calibration faces for int8 mode.')
+    parser.add_argument('--batch-size', type=int, default=32, help='Number of faces in batch.')
+    parser.add_argument('--output', type=str, default='', help='Path to save optimized TorchScript model.')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed.')
+    args = parser.parse_args()
+    validate(args.path, args.mode, args.samples, args.calibration, args.batch_size, args.output, args.seed)